@@ -1,30 +1,65 @@
 # app/bot.py
 import asyncio
-import io
 import os
+import time
 
 from aiogram import Bot, Dispatcher
 from aiogram import Router
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import Command
 from aiogram.types import Message, FSInputFile
 from dotenv import load_dotenv
 
-from app.db_services import get_random_video, delete_video, inactive_video, get_list_chat_id, get_random_user_video, \
-    add_tiktok_user, get_tiktok_user_video_counts, get_tiktok_user_frequency_summary
-from app.decorator.authen import auth_check, roles_check
+from app.broadcast import broadcast
+from app.db_services import delete_video, inactive_video, get_list_chat_id, add_tiktok_user
+from app.decorator.authen import auth_check, roles_check, role_cache
 from app.decorator.rate_limiter import rate_limit
-from app.download_services import get_video_async
-from app.utils import extract_link_from_caption, extract_tiktok_username
+from app.download_scheduler import QueueFullError, PRIORITY_DOWNLOAD, PRIORITY_RANDOM
+from app.download_services import get_video_async, video_cache, url_passthrough
+from app.file_id_cache import file_id_cache
+from app.memory_monitor import HandlerMemoryMiddleware
+from app.metrics import HandlerMetricsMiddleware
+from app.prefetcher import video_prefetcher
+from app.random_index import random_index, pick_random_video
+from app.shared_state import shared_events
+from app.stats_service import stats_service
+from app.throttling import throttle_middleware
+from app.utils import extract_link_from_caption, extract_tiktok_username, extract_tiktok_video_id
 
 load_dotenv()
 
 # Environmental variables
 BOT_TOKEN: str = os.getenv("BOT_TOKEN", "")
 CHAT_ID: str = os.getenv("CHAT_ID", "")
+# Bot API server to talk to instead of api.telegram.org, e.g. a local one or the benchmark fake
+TELEGRAM_API_URL: str = os.getenv("TELEGRAM_API_URL", "")
+
+BUSY_MESSAGE = "Bot đang bận, thử lại sau nhé."
+
+# Uploads stream the file in chunks of this size, nothing else of it is held in memory
+UPLOAD_CHUNK_SIZE: int = 1024 * 1024
+# Telegram allows about one message per second per chat, edits included
+PROGRESS_EDIT_INTERVAL: float = 3.0
 
 user_router = Router()
-bot = Bot(token=BOT_TOKEN)
+bot = Bot(token=BOT_TOKEN,
+          session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None)
+bot.session.middleware(throttle_middleware)
 dp = Dispatcher()
+dp.message.middleware(HandlerMetricsMiddleware())
+dp.message.middleware(HandlerMemoryMiddleware())
+
+
+def _on_video_removed(video_url: str) -> None:
+    random_index.remove_link(video_url)
+    stats_service.record_removed(extract_tiktok_username(video_url))
+
+
+# /d, /i and /reload_roles take effect in every process, not just the one that handled them
+shared_events.subscribe("video_removed", _on_video_removed)
+shared_events.subscribe("roles_changed", lambda payload: role_cache.invalidate())
 
 
 # Command handlers
@@ -63,26 +98,22 @@ async def handle_download(message: Message) -> None:
         await message.reply("Please provide a valid TikTok URL.")
         return
 
-    video_path = await get_video_async(video_url)
+    status = None
     try:
-        await message.reply("Downloading your TikTok video... 📥")
+        status = DownloadStatus(await message.reply("Downloading your TikTok video... 📥"))
 
-        # Load video into memory with BytesIO
-        with open(video_path, "rb") as video_file:
-            video_data = io.BytesIO(video_file.read())
-            video_data.seek(0)  # Reset buffer pointer to start of the file
-
-        # Send the video using InputFile
-        video_to_send = FSInputFile(video_path, filename="video.mp4")
-        await bot.send_video(chat_id=message.chat.id, video=video_to_send)
+        if not await deliver_video(message.chat.id, video_url, priority=PRIORITY_DOWNLOAD,
+                                   on_queued=lambda position: reply_queue_position(message, position),
+                                   status=status):
+            await message.reply("Sorry, couldn't download that video.")
 
+    except QueueFullError:
+        await message.reply(BUSY_MESSAGE)
     except Exception as e:
         await message.reply(f"An error occurred: {e}")
-
     finally:
-        # Clean up: Close buffer and delete the local file
-        if video_path and os.path.exists(video_path):
-            os.remove(video_path)
+        if status:
+            await status.close()
 
 
 @dp.message(Command("r"))
@@ -117,6 +148,7 @@ async def delete_video_command(message: Message) -> None:
 
     try:
         asyncio.create_task(delete_video(video_url))
+        await shared_events.publish("video_removed", video_url)
     except Exception as e:
         print(f"An error occurred: {e}")
         await message.reply(f"An error occurred: {e}")
@@ -141,6 +173,7 @@ async def delete_video_command(message: Message) -> None:
 
     try:
         asyncio.create_task(inactive_video(video_url))
+        await shared_events.publish("video_removed", video_url)
     except Exception as e:
         print(f"An error occurred: {e}")
         await message.reply(f"An error occurred: {e}")
@@ -178,104 +211,90 @@ async def add_tiktok_user_command(message: Message) -> None:
         await message.reply(f"Failed to add tiktok user {tiktok_username}.")
 
 
+# drop cached roles after they were changed in the database
+@dp.message(Command("reload_roles"))
+@roles_check
+async def reload_roles_command(message: Message) -> None:
+    await shared_events.publish("roles_changed")
+    await message.reply("Role cache cleared.")
+
+
 @dp.message(Command("send"))
 @roles_check
 async def send_message_to_chat_id(message: Message) -> None:
-    content = message.text.split(" ", 1)[-1]  # Extract the content after the command
-
-    chat_ids = [item["chat_id"] for item in await get_list_chat_id()]
-    print(f"list chat send video: {chat_ids}")
+    parts = message.text.split(" ", 1)  # Extract the content after the command
+    content = parts[1].strip() if len(parts) > 1 else ""
 
     if not content:
         await message.reply("Please provide a message to send.")
         return
 
-    for chat_id in chat_ids:
-        if chat_id:
-            await bot.send_message(chat_id.strip(), content)
+    chat_ids = [item["chat_id"] for item in await get_list_chat_id()]
+    print(f"list chat send video: {chat_ids}")
+
+    report = await broadcast(bot, chat_ids, content)
+    await message.reply(report.text())
 
 
 @dp.message(Command("total"))
 @auth_check
 async def get_tiktok_user_video_counts_command(message: Message) -> None:
-    data = await get_tiktok_user_video_counts()
+    chunks = await stats_service.total_chunks()
 
-    if not data:
+    if not chunks:
         await message.reply("No TikTok user data available.")
         return
 
-    # Calculate total videos in one pass while building the string
-    total_videos = 0
-    lines = ["Danh sách các bé:\n"]
-
-    for item in data:
-        count = item['number_of_videos']
-        total_videos += count
-        lines.append(f"💃 {item['tiktok_user']}: {count} videos")
-
-    lines.append(f"\n📊 Tổng số videos: {total_videos}")
-
-    # Join all lines at once instead of concatenating strings repeatedly
-    formatted_data = "\n".join(lines)
-    await message.reply(formatted_data)
+    for chunk in chunks:
+        await message.reply(chunk)
 
 
 @dp.message(Command("frequency"))
 @auth_check
 async def get_tiktok_user_frequency_summary_command(message: Message) -> None:
-    data = await get_tiktok_user_frequency_summary()
+    chunks = await stats_service.frequency_chunks()
 
-    # Format the data into a readable string
-    if not data:
-        formatted_data = "No TikTok user data available."
-    else:
-        # Build the string more efficiently using list comprehension and join
-        formatted_data = "Danh sách các bé được ae yêu quý:\n\n"
-        for item in data:
-            formatted_data += f"💃 {item['tiktok_user']}: {item['total_of_frequency']} lượt sục\n"
+    if not chunks:
+        await message.reply("No TikTok user data available.")
+        return
 
-    await message.reply(formatted_data)
+    for chunk in chunks:
+        await message.reply(chunk)
 
 
 async def send_random_video(message: Message, user=None) -> None:
     # Start by notifying the user immediately
     await bot.send_chat_action(chat_id=message.chat.id, action="upload_video")
 
-    # Get random video URL
+    # Serve from the prefetch pool when possible, otherwise pick a random video now
     print(f"user: {user}")
-    video_url = await get_random_user_video(user) if user else await get_random_video()
+    prefetched = video_prefetcher.take(user)
+    if prefetched:
+        video_url, from_index = prefetched.video_url, prefetched.from_index
+    else:
+        video_url, from_index = await pick_random_video(user)
     print(f"video_url: {video_url}")
     if not video_url:
         await message.reply("No video found.")
         return
 
-    video_path = None
     try:
-        # Start the download process and notification
-        download_task = asyncio.create_task(get_video_async(video_url))
-        action_task = asyncio.create_task(
-            bot.send_chat_action(chat_id=message.chat.id, action="upload_video")
+        # Reuse the Telegram copy when we have one, otherwise download and upload
+        delivered = await deliver_video(
+            message.chat.id, video_url, prefetched.video_path if prefetched else None,
+            on_queued=lambda position: reply_queue_position(message, position),
         )
 
-        # Wait for download to complete
-        video_path = await download_task
-        if not video_path:
+        if not delivered:
             await message.reply("Sorry, couldn't download that video.")
             return
 
-        # Wait for notification to complete if it hasn't already
-        await action_task
-
-        # Send the video directly from the file path
-        video_to_send = FSInputFile(video_path, filename="video.mp4")
         # get username in video_url
         username = extract_tiktok_username(video_url)
+        stats_service.record_view(username)
+        if from_index:
+            random_index.record_view(video_url)
 
-        # change send video logic to make video sent smaller
-        await bot.send_video(
-            chat_id=message.chat.id,
-            video=video_to_send,
-        )
         await bot.send_message(
             chat_id=message.chat.id,
             text=f"link: {video_url}, username: {username}",
@@ -283,9 +302,139 @@ async def send_random_video(message: Message, user=None) -> None:
             disable_web_page_preview=True
         )
 
+    except QueueFullError:
+        await message.reply(BUSY_MESSAGE)
     except Exception as e:
         await message.reply(f"An error occurred: {e}")
+
+
+async def send_cached_video(chat_id: int, video_id: str) -> bool:
+    """Re-send a previously uploaded video by its Telegram file_id."""
+    file_id = await file_id_cache.get(video_id)
+    if not file_id:
+        return False
+
+    try:
+        await bot.send_video(chat_id=chat_id, video=file_id)
+        return True
+    except TelegramBadRequest as e:
+        # file_id no longer valid on Telegram's side, fall back to a fresh upload
+        print(f"Cached file_id for {video_id} rejected: {e}")
+        await file_id_cache.delete(video_id)
+        return False
+
+
+async def reply_queue_position(message: Message, position: int) -> None:
+    await message.reply(f"Your video is #{position} in the queue, please wait... ⏳")
+
+
+class DownloadStatus:
+    """Status reply edited in place while a video is downloaded and uploaded."""
+
+    def __init__(self, message: Message):
+        self.message = message
+        self._text = message.text
+        self._edited_at = 0.0
+        self._task = None
+
+    def set(self, text: str, force: bool = False) -> None:
+        """Show text; unless forced, skipped while the last edit is recent or still on its way."""
+        if text == self._text:
+            return
+        # Edits queue up behind the chat's rate limit, so skip progress rather than pile it up
+        if not force and ((self._task and not self._task.done())
+                          or time.monotonic() - self._edited_at < PROGRESS_EDIT_INTERVAL):
+            return
+        self._text = text
+        self._edited_at = time.monotonic()
+        self._task = asyncio.create_task(self._edit(text, self._task))
+
+    def progress(self, downloaded: int, total: int | None) -> None:
+        if total:
+            self.set(f"Downloading your TikTok video... 📥 {downloaded * 100 // total}% "
+                     f"({downloaded / 1024 / 1024:.1f}/{total / 1024 / 1024:.1f} MB)")
+        else:
+            self.set(f"Downloading your TikTok video... 📥 {downloaded / 1024 / 1024:.1f} MB")
+
+    async def _edit(self, text: str, previous: asyncio.Task | None) -> None:
+        if previous:
+            await previous
+        try:
+            await self.message.edit_text(text)
+        except Exception as e:
+            print(f"Failed to update status message: {e}")
+
+    async def close(self) -> None:
+        """Remove the status message once the video was sent or failed."""
+        if self._task:
+            await self._task
+        try:
+            await self.message.delete()
+        except Exception as e:
+            print(f"Failed to delete status message: {e}")
+
+
+async def send_video_url(chat_id: int, video_id: str, direct_url: str) -> bool:
+    """Let Telegram fetch the video from its CDN URL, False if it couldn't."""
+    try:
+        sent = await bot.send_video(chat_id=chat_id, video=direct_url)
+    except TelegramBadRequest as e:
+        # e.g. "failed to get HTTP URL content" when the CDN refuses Telegram
+        print(f"Telegram could not fetch {video_id} by URL: {e}")
+        url_passthrough.record(False)
+        return False
+    url_passthrough.record(True)
+    await remember_file_id(video_id, sent)
+    return True
+
+
+async def remember_file_id(video_id: str, sent: Message) -> None:
+    media = sent.video or sent.animation or sent.document
+    if media:
+        await file_id_cache.put(video_id, media.file_id)
+
+
+async def deliver_video(chat_id: int, video_url: str, video_path: str | None = None,
+                        priority: int = PRIORITY_RANDOM, on_queued=None, status: DownloadStatus = None) -> bool:
+    """Send a TikTok video to a chat, downloading and uploading it only on a file_id cache miss.
+
+    video_path may be an already downloaded (pinned) file, e.g. from the prefetch pool.
+    Otherwise small videos are first offered to Telegram by their CDN URL. priority and
+    on_queued are passed to the download scheduler; status, if given, shows the progress.
+    """
+    video_id = extract_tiktok_video_id(video_url)
+    if video_id and await send_cached_video(chat_id, video_id):
+        if video_path:
+            video_cache.release(video_path)
+        return True
+
+    if not video_path:
+        sent_by_url = []
+
+        async def send_url(url_video_id: str, direct_url: str) -> bool:
+            sent_by_url.append(await send_video_url(chat_id, url_video_id, direct_url))
+            return sent_by_url[-1]
+
+        video_path = await get_video_async(video_url, chat_id, priority, on_queued,
+                                           status.progress if status else None,
+                                           send_url if url_passthrough.available() else None)
+        if any(sent_by_url):
+            return True
+        if not video_path:
+            # Joined another chat's request that Telegram fetched by URL, its file_id is cached now
+            return bool(video_id) and await send_cached_video(chat_id, video_id)
+
+    try:
+        if status:
+            status.set("Uploading your TikTok video... 📤", force=True)
+        # Streamed from disk chunk by chunk while it is sent
+        video_to_send = FSInputFile(video_path, filename="video.mp4", chunk_size=UPLOAD_CHUNK_SIZE)
+        sent = await bot.send_video(chat_id=chat_id, video=video_to_send)
     finally:
-        # Clean up the downloaded file regardless of outcome
-        if video_path and os.path.exists(video_path):
-            os.remove(video_path)
+        # Keep the file in the disk cache, just let eviction reclaim it again
+        video_cache.release(video_path)
+
+    # Short links carry no id, fall back to the yt-dlp output name (%(id)s.%(ext)s)
+    video_id = video_id or os.path.splitext(os.path.basename(video_path))[0]
+    await remember_file_id(video_id, sent)
+    return True
@@ -0,0 +1,116 @@
+# app/broadcast.py
+import asyncio
+import os
+import time
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest, \
+    TelegramMigrateToChat, TelegramNotFound
+from dotenv import load_dotenv
+
+from app.chat_registry import chat_registry
+from app.db_services import delete_chat_id, migrate_chat_id
+from app.throttling import AsyncTokenBucket
+
+load_dotenv()
+
+# Telegram allows about 30 messages per second across all chats
+BROADCAST_RATE: float = float(os.getenv("BROADCAST_RATE", "25"))
+BROADCAST_CONCURRENCY: int = int(os.getenv("BROADCAST_CONCURRENCY", "20"))
+BROADCAST_MAX_RETRIES: int = int(os.getenv("BROADCAST_MAX_RETRIES", "3"))
+
+# Errors meaning the bot can never write to the chat again. Missing rights are not among
+# them: a restricted or muted bot may be allowed to post again later
+DEAD_CHAT_ERRORS = ("chat not found", "bot was kicked", "bot was blocked", "user is deactivated",
+                    "group chat was deleted")
+
+# {old chat id: new chat id} of groups upgraded to supergroups since start, for ids that
+# don't come from the database (e.g. CHAT_ID)
+migrated_chats: dict = {}
+
+
+class BroadcastReport:
+    def __init__(self, total: int):
+        self.total = total
+        self.delivered = 0
+        self.failed = 0
+        self.dead: list = []
+        # [(old chat id, new chat id)]
+        self.migrated: list = []
+        self.started = time.monotonic()
+        self.elapsed = 0.0
+
+    def text(self) -> str:
+        return (
+            f"📣 Broadcast done: {self.delivered}/{self.total} delivered, {self.failed} failed, "
+            f"{len(self.dead)} dead chats removed, {self.elapsed:.1f}s"
+        )
+
+
+def _is_dead(error: Exception) -> bool:
+    if isinstance(error, TelegramNotFound):
+        return True
+    return isinstance(error, (TelegramForbiddenError, TelegramBadRequest)) and any(
+        reason in error.message.lower() for reason in DEAD_CHAT_ERRORS
+    )
+
+
+async def _deliver(bot: Bot, chat_id, text: str, bucket: AsyncTokenBucket, report: BroadcastReport,
+                   kwargs: dict) -> None:
+    for _ in range(BROADCAST_MAX_RETRIES + 1):
+        await bucket.acquire()
+        try:
+            await bot.send_message(chat_id, text, **kwargs)
+            report.delivered += 1
+            return
+        except TelegramRetryAfter as e:
+            # Flood limit hit: slow everyone down, not just this chat
+            bucket.pause(e.retry_after)
+        except TelegramMigrateToChat as e:
+            # Group was upgraded to a supergroup, its id changed
+            report.migrated.append((chat_id, str(e.migrate_to_chat_id)))
+            chat_id = e.migrate_to_chat_id
+        except Exception as e:
+            if _is_dead(e):
+                report.dead.append(chat_id)
+            else:
+                print(f"Failed to send broadcast to {chat_id}: {e}")
+                report.failed += 1
+            return
+
+    print(f"Gave up sending broadcast to {chat_id} after {BROADCAST_MAX_RETRIES} retries")
+    report.failed += 1
+
+
+async def broadcast(bot: Bot, chat_ids, text: str, **kwargs) -> BroadcastReport:
+    """Send a message to many chats as fast as Telegram's flood limits allow.
+
+    Retries after RetryAfter, removes chats the bot can no longer write to, stores the new
+    id of upgraded groups and returns a delivery report. Extra kwargs are passed to
+    bot.send_message.
+    """
+    chat_ids = [str(chat_id).strip() for chat_id in chat_ids if chat_id and str(chat_id).strip()]
+    chat_ids = [migrated_chats.get(chat_id, chat_id) for chat_id in chat_ids]
+    report = BroadcastReport(len(chat_ids))
+    bucket = AsyncTokenBucket(BROADCAST_RATE)
+    semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+
+    async def deliver(chat_id) -> None:
+        async with semaphore:
+            await _deliver(bot, chat_id, text, bucket, report, kwargs)
+
+    await asyncio.gather(*(deliver(chat_id) for chat_id in chat_ids))
+
+    for chat_id in report.dead:
+        if await delete_chat_id(chat_id):
+            chat_registry.forget_chat(chat_id)
+    for old_chat_id, new_chat_id in report.migrated:
+        print(f"Chat {old_chat_id} moved to {new_chat_id}")
+        migrated_chats[old_chat_id] = new_chat_id
+        if await migrate_chat_id(old_chat_id, new_chat_id):
+            # Its pairs are registered again under the new id on the next command
+            chat_registry.forget_chat(old_chat_id)
+
+    report.elapsed = time.monotonic() - report.started
+    print(report.text())
+    return report
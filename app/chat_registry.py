@@ -0,0 +1,132 @@
+# app/chat_registry.py
+import asyncio
+import os
+from array import array
+
+from dotenv import load_dotenv
+
+from app.db_services import add_chat_id_and_user_id
+from app.metrics import Gauge
+
+load_dotenv()
+
+CHAT_REGISTRY_PATH: str = os.getenv("CHAT_REGISTRY_PATH", os.path.join("cache", "registered_pairs.bin"))
+CHAT_REGISTRY_FLUSH_INTERVAL: int = int(os.getenv("CHAT_REGISTRY_FLUSH_INTERVAL", "30"))
+CHAT_REGISTRY_FLUSH_CONCURRENCY: int = int(os.getenv("CHAT_REGISTRY_FLUSH_CONCURRENCY", "5"))
+
+
+def _pack(chat_id: int, user_id: int) -> int:
+    # One int per pair keeps the set small; chat ids are negative for groups
+    return (int(chat_id) << 64) | (int(user_id) & 0xFFFFFFFFFFFFFFFF)
+
+
+class ChatRegistry:
+    """Write-behind registration of (chat_id, user_id) pairs.
+
+    Pairs already stored in Supabase are remembered in memory and in an append-only file,
+    so only pairs never seen before are queued. The queue is written out every
+    `flush_interval` seconds instead of once per command.
+    """
+
+    def __init__(self, path: str, flush_interval: int, flush_concurrency: int):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.flush_concurrency = flush_concurrency
+        self._known: set = set()
+        # {packed pair: (chat_id, user_id)}
+        self._pending: dict = {}
+        self._loaded = False
+
+    def load(self) -> None:
+        if self._loaded:
+            return
+        self._loaded = True
+        if not os.path.exists(self.path):
+            return
+
+        pairs = array("q")
+        with open(self.path, "rb") as f:
+            pairs.frombytes(f.read())
+        for i in range(0, len(pairs) - 1, 2):
+            self._known.add(_pack(pairs[i], pairs[i + 1]))
+        print(f"Loaded {len(self._known)} registered chat/user pairs")
+
+    def register(self, chat_id: int, user_id: int) -> None:
+        """Queue a pair for registration unless it is already known."""
+        self.load()
+        key = _pack(chat_id, user_id)
+        if key in self._known or key in self._pending:
+            return
+        self._pending[key] = (chat_id, user_id)
+
+    def _append(self, pairs: list) -> None:
+        dirname = os.path.dirname(self.path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        with open(self.path, "ab") as f:
+            array("q", [value for pair in pairs for value in pair]).tofile(f)
+
+    def _rewrite(self) -> None:
+        dirname = os.path.dirname(self.path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        pairs = array("q")
+        for key in self._known:
+            user_id = key & 0xFFFFFFFFFFFFFFFF
+            pairs.extend((key >> 64, user_id - (1 << 64) if user_id >= 1 << 63 else user_id))
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "wb") as f:
+            pairs.tofile(f)
+        os.replace(tmp_path, self.path)
+
+    def forget_chat(self, chat_id) -> None:
+        """Drop every pair of a chat that was removed, so it is registered again if it comes back."""
+        self.load()
+        chat_id = int(chat_id)
+        known = {key for key in self._known if key >> 64 == chat_id}
+        self._pending = {key: pair for key, pair in self._pending.items() if key >> 64 != chat_id}
+        if known:
+            self._known.difference_update(known)
+            self._rewrite()
+
+    async def flush(self) -> int:
+        """Send queued pairs to Supabase. Failed ones stay queued for the next flush."""
+        if not self._pending:
+            return 0
+
+        batch, self._pending = self._pending, {}
+        semaphore = asyncio.Semaphore(self.flush_concurrency)
+
+        async def send(key: int, pair: tuple) -> bool:
+            async with semaphore:
+                ok = await add_chat_id_and_user_id(*pair)
+            if not ok:
+                self._pending.setdefault(key, pair)
+            return ok
+
+        results = await asyncio.gather(*(send(key, pair) for key, pair in batch.items()))
+        stored = [pair for (key, pair), ok in zip(batch.items(), results) if ok]
+        self._known.update(key for key, ok in zip(batch, results) if ok)
+        if stored:
+            await asyncio.to_thread(self._append, stored)
+        return len(stored)
+
+    async def run(self) -> None:
+        self.load()
+        try:
+            while True:
+                await asyncio.sleep(self.flush_interval)
+                try:
+                    stored = await self.flush()
+                    if stored:
+                        print(f"Registered {stored} new chat/user pairs")
+                except Exception as e:
+                    print(f"Chat registry flush error: {e}")
+        except asyncio.CancelledError:
+            print("Chat registry task has been stopped.")
+
+
+# Create singleton instance
+chat_registry = ChatRegistry(CHAT_REGISTRY_PATH, CHAT_REGISTRY_FLUSH_INTERVAL, CHAT_REGISTRY_FLUSH_CONCURRENCY)
+
+Gauge("chat_registry_pending", "Chat/user pairs waiting to be registered.", function=lambda: len(chat_registry._pending))
@@ -0,0 +1,169 @@
+# app/cluster.py
+import asyncio
+import json
+import os
+import secrets
+import struct
+
+from aiogram import Bot, Dispatcher
+from aiohttp import web
+from dotenv import load_dotenv
+
+from app.shared_state import SharedState
+
+load_dotenv()
+
+# Handler processes updates are sharded across, 1 = handle updates in the receiving process
+CLUSTER_WORKERS: int = int(os.getenv("CLUSTER_WORKERS", "1"))
+# Set by the router in the shard processes it spawns
+CLUSTER_SHARD: int = int(os.getenv("CLUSTER_SHARD", "-1"))
+CLUSTER_SOCKET_DIR: str = os.getenv("CLUSTER_SOCKET_DIR", os.path.join("cache", "cluster"))
+# Shard N serves /metrics on this port + N, 0 = off (shards have no web server otherwise)
+CLUSTER_METRICS_PORT: int = int(os.getenv("CLUSTER_METRICS_PORT", "0"))
+# Telegram re-delivers an update until it is acknowledged, remember handled ids this long
+UPDATE_DEDUP_TTL: int = int(os.getenv("UPDATE_DEDUP_TTL", "3600"))
+POLLING_TIMEOUT = 30
+
+_HEADER = struct.Struct("!I")
+
+
+def cluster_enabled() -> bool:
+    return CLUSTER_WORKERS > 1
+
+
+def socket_path(shard: int) -> str:
+    return os.path.join(CLUSTER_SOCKET_DIR, f"shard-{shard}.sock")
+
+
+def chat_id_of(update: dict):
+    """Chat (or, failing that, user) an update belongs to, None for updates without one."""
+    for key, event in update.items():
+        if key == "update_id" or not isinstance(event, dict):
+            continue
+        chat = event.get("chat") or (event.get("message") or {}).get("chat")
+        if chat:
+            return chat["id"]
+        user = event.get("from") or event.get("user")
+        if user:
+            return user["id"]
+    return None
+
+
+def shard_for(update: dict, shards: int = CLUSTER_WORKERS) -> int:
+    # Every update of a chat goes to the same shard, so per-chat state and ordering stay local
+    chat_id = chat_id_of(update)
+    return (chat_id if chat_id is not None else update["update_id"]) % shards
+
+
+class ShardRouter:
+    """Receives updates (polling or webhook) and forwards them to shard processes over unix sockets.
+
+    Frames are a 4 byte big-endian length followed by the update as JSON.
+    """
+
+    CONNECT_RETRIES = 50
+
+    def __init__(self, shards: int = CLUSTER_WORKERS, socket_dir: str = CLUSTER_SOCKET_DIR,
+                 secret_token: str = ""):
+        self.shards = shards
+        self.socket_dir = socket_dir
+        self.secret_token = secret_token
+        self.routed = 0
+        self._writers: dict = {}
+        self._locks = [asyncio.Lock() for _ in range(shards)]
+
+    async def _connect(self, shard: int) -> asyncio.StreamWriter:
+        path = os.path.join(self.socket_dir, f"shard-{shard}.sock")
+        for attempt in range(self.CONNECT_RETRIES):
+            try:
+                _, writer = await asyncio.open_unix_connection(path)
+                return writer
+            except (ConnectionError, FileNotFoundError):
+                # Shard still starting or restarting
+                if attempt == self.CONNECT_RETRIES - 1:
+                    raise
+                await asyncio.sleep(0.2)
+
+    async def route(self, update: dict) -> None:
+        shard = shard_for(update, self.shards)
+        payload = json.dumps(update, separators=(",", ":")).encode()
+        frame = _HEADER.pack(len(payload)) + payload
+
+        async with self._locks[shard]:
+            for attempt in range(2):
+                writer = self._writers.get(shard)
+                try:
+                    if writer is None or writer.is_closing():
+                        writer = self._writers[shard] = await self._connect(shard)
+                    writer.write(frame)
+                    await writer.drain()
+                    self.routed += 1
+                    return
+                except (ConnectionError, OSError) as e:
+                    self._writers.pop(shard, None)
+                    if attempt:
+                        print(f"Failed to route update {update.get('update_id')} to shard {shard}: {e}")
+
+    async def poll(self, bot: Bot, allowed_updates=None) -> None:
+        """Long-poll Telegram and route every update."""
+        offset = None
+        while True:
+            try:
+                updates = await bot.get_updates(offset=offset, timeout=POLLING_TIMEOUT,
+                                                allowed_updates=allowed_updates)
+            except Exception as e:
+                print(f"Polling error: {e}")
+                await asyncio.sleep(1)
+                continue
+            for update in updates:
+                offset = update.update_id + 1
+                await self.route(update.model_dump(mode="json", exclude_unset=True, by_alias=True))
+
+    async def handle_webhook(self, request: web.Request) -> web.Response:
+        if self.secret_token and not secrets.compare_digest(
+                request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), self.secret_token):
+            return web.Response(status=401, text="Unauthorized")
+        await self.route(await request.json())
+        return web.Response()
+
+    async def close(self) -> None:
+        for writer in self._writers.values():
+            writer.close()
+        self._writers.clear()
+
+
+async def serve_shard(shard: int, dp: Dispatcher, bot: Bot, state: SharedState) -> None:
+    """Feed updates routed to this shard into the dispatcher until cancelled."""
+    path = socket_path(shard)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if os.path.exists(path):
+        os.unlink(path)
+
+    # Strong references, the loop only keeps weak ones to running tasks
+    handling: set = set()
+
+    async def receive(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                (size,) = _HEADER.unpack(await reader.readexactly(_HEADER.size))
+                update = json.loads(await reader.readexactly(size))
+                # Skip updates another process already handled (webhook retries, restarts)
+                if not await asyncio.to_thread(state.claim, f"update:{update['update_id']}", UPDATE_DEDUP_TTL):
+                    continue
+                task = asyncio.create_task(dp.feed_raw_update(bot, update))
+                handling.add(task)
+                task.add_done_callback(handling.discard)
+        except (asyncio.IncompleteReadError, asyncio.CancelledError):
+            # Router went away, or this shard is shutting down
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_unix_server(receive, path)
+    print(f"Shard {shard} listening on {path}")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        if handling:
+            await asyncio.gather(*handling, return_exceptions=True)
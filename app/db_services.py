@@ -1,10 +1,11 @@
 # app/db_services.py
-import asyncio
 import os
 from contextlib import asynccontextmanager
 
+import httpx
 from dotenv import load_dotenv
-from supabase import create_client
+
+from app.metrics import db_latency, db_errors
 
 load_dotenv()
 
@@ -12,36 +13,71 @@ load_dotenv()
 SUPABASE_URL: str = os.getenv("SUPABASE_URL", "")
 SUPABASE_KEY: str = os.getenv("SUPABASE_KEY", "")
 
+DB_TIMEOUT: float = float(os.getenv("DB_TIMEOUT", "10"))
+DB_MAX_CONNECTIONS: int = int(os.getenv("DB_MAX_CONNECTIONS", "20"))
+DB_KEEPALIVE_CONNECTIONS: int = int(os.getenv("DB_KEEPALIVE_CONNECTIONS", "10"))
+
 # Connection pool
 _supabase_client = None
 
 
-def get_supabase_client():
+def get_supabase_client() -> httpx.AsyncClient:
+    """Shared async PostgREST client: keep-alive connection pool over HTTP/2."""
     global _supabase_client
-    if _supabase_client is None:
-        _supabase_client = create_client(SUPABASE_URL, SUPABASE_KEY)
+    if _supabase_client is None or _supabase_client.is_closed:
+        _supabase_client = httpx.AsyncClient(
+            base_url=f"{SUPABASE_URL.rstrip('/')}/rest/v1",
+            headers={
+                "apikey": SUPABASE_KEY,
+                "Authorization": f"Bearer {SUPABASE_KEY}",
+                "Content-Type": "application/json",
+            },
+            http2=True,
+            timeout=DB_TIMEOUT,
+            limits=httpx.Limits(
+                max_connections=DB_MAX_CONNECTIONS,
+                max_keepalive_connections=DB_KEEPALIVE_CONNECTIONS,
+            ),
+        )
     return _supabase_client
 
 
+async def close_supabase_client() -> None:
+    global _supabase_client
+    if _supabase_client is not None:
+        await _supabase_client.aclose()
+        _supabase_client = None
+
+
 @asynccontextmanager
 async def supabase_connection():
     client = get_supabase_client()
     try:
         yield client
     finally:
-        # No explicit cleanup needed for supabase client
+        # Connections go back to the pool on their own
         pass
 
 
+async def _rpc(client: httpx.AsyncClient, name: str, params: dict = None, timeout: float = None):
+    """Call a Postgres function through PostgREST and return its decoded result."""
+    with db_latency.time(name, errors=db_errors):
+        response = await client.post(
+            f"/rpc/{name}",
+            json=params or {},
+            timeout=timeout if timeout is not None else DB_TIMEOUT,
+        )
+        response.raise_for_status()
+    # Functions returning void answer with an empty body
+    return response.json() if response.content else None
+
+
 # Refactor functions to use the connection pool
 async def get_random_video():
     try:
         async with supabase_connection() as client:
-            response = await asyncio.to_thread(
-                lambda: client.rpc("get_random_video").execute()
-            )
             # Return only needed data, not the entire response
-            return response.data
+            return await _rpc(client, "get_random_video")
     except Exception as e:
         print(f"Failed to get random video: {e}")
         return None
@@ -50,11 +86,7 @@ async def get_random_video():
 async def get_user_not_fetch():
     try:
         async with supabase_connection() as client:
-            response = await asyncio.to_thread(
-                lambda: client.rpc("get_user_not_fetch").execute()
-            )
-
-            return response.data
+            return await _rpc(client, "get_user_not_fetch")
     except Exception as e:
         print(f"Failed to get user not fetch: {e}")
         return ""
@@ -63,11 +95,7 @@ async def get_user_not_fetch():
 async def get_user_fetched():
     try:
         async with supabase_connection() as client:
-            response = await asyncio.to_thread(
-                lambda: client.rpc("get_user_not_fetch").execute()
-            )
-
-            return response.data
+            return await _rpc(client, "get_user_not_fetch")
     except Exception as e:
         print(f"Failed to get user not fetch: {e}")
         return ""
@@ -77,11 +105,8 @@ async def get_user_fetched():
 async def delete_video(link: str):
     try:
         async with supabase_connection() as client:
-            response = await asyncio.to_thread(
-                lambda: client.rpc("delete_video", {"p_link": link}).execute()
-            )
-
-            return response
+            await _rpc(client, "delete_video", {"p_link": link})
+            return True
     except Exception as e:
         print(f"Failed to delete video: {e}")
         return False
@@ -91,11 +116,8 @@ async def delete_video(link: str):
 async def inactive_video(link: str):
     try:
         async with supabase_connection() as client:
-            response = await asyncio.to_thread(
-                lambda: client.rpc("inactive_video", {"p_link": link}).execute()
-            )
-
-            return response
+            await _rpc(client, "inactive_video", {"p_link": link})
+            return True
     except Exception as e:
         print(f"Failed to inactive video: {e}")
         return False
@@ -105,11 +127,8 @@ async def inactive_video(link: str):
 async def add_chat_id_and_user_id(chat_id: str, user_id: str):
     try:
         async with supabase_connection() as client:
-            response = await asyncio.to_thread(
-                lambda: client.rpc("add_chat_id_and_user_id", {"p_chat_id": chat_id, "p_user_id": user_id}).execute()
-            )
-
-        return response
+            await _rpc(client, "add_chat_id_and_user_id", {"p_chat_id": chat_id, "p_user_id": user_id})
+        return True
     except Exception as e:
         print(f"Failed to add chat id and user id: {e}")
         return False
@@ -119,11 +138,7 @@ async def add_chat_id_and_user_id(chat_id: str, user_id: str):
 async def get_current_tele_user_info(user_id: str):
     try:
         async with supabase_connection() as client:
-            response = await asyncio.to_thread(
-                lambda: client.rpc("get_current_tele_user_info", {"p_user_id": user_id}).execute()
-            )
-
-        return response.data
+            return await _rpc(client, "get_current_tele_user_info", {"p_user_id": user_id})
     except Exception as e:
         print(f"Failed to get current tele user info: {e}")
         return False
@@ -133,11 +148,7 @@ async def get_current_tele_user_info(user_id: str):
 async def get_list_chat_id():
     try:
         async with supabase_connection() as client:
-            response = await asyncio.to_thread(
-                lambda: client.rpc("get_list_chat_id").execute()
-            )
-
-        return response.data
+            return await _rpc(client, "get_list_chat_id")
     except Exception as e:
         print(f"Failed to get list chat id: {e}")
         return False
@@ -146,10 +157,7 @@ async def get_list_chat_id():
 async def get_random_user_video(tiktok_user: str):
     try:
         async with supabase_connection() as client:
-            response = await asyncio.to_thread(
-                lambda: client.rpc("get_random_user_video", {"p_tiktok_user": tiktok_user}).execute()
-            )
-            return response.data
+            return await _rpc(client, "get_random_user_video", {"p_tiktok_user": tiktok_user})
     except Exception as e:
         print(f"Failed to get random video: {e}")
         return None
@@ -158,10 +166,7 @@ async def get_random_user_video(tiktok_user: str):
 async def add_tiktok_user(tiktok_user: str):
     try:
         async with supabase_connection() as client:
-            response = await asyncio.to_thread(
-                lambda: client.rpc("add_tiktok_user", {"p_tiktok_user": tiktok_user}).execute()
-            )
-            return response.data
+            return await _rpc(client, "add_tiktok_user", {"p_tiktok_user": tiktok_user})
     except Exception as e:
         print(f"Failed to get random video: {e}")
         return None
@@ -170,10 +175,7 @@ async def add_tiktok_user(tiktok_user: str):
 async def get_tiktok_user_video_counts():
     try:
         async with supabase_connection() as client:
-            response = await asyncio.to_thread(
-                lambda: client.rpc("get_tiktok_user_video_counts").execute()
-            )
-            return response.data
+            return await _rpc(client, "get_tiktok_user_video_counts")
     except Exception as e:
         print(f"Failed to get: {e}")
         return None
@@ -182,10 +184,83 @@ async def get_tiktok_user_video_counts():
 async def get_tiktok_user_frequency_summary():
     try:
         async with supabase_connection() as client:
-            response = await asyncio.to_thread(
-                lambda: client.rpc("get_tiktok_user_frequency_summary").execute()
-            )
-            return response.data
+            return await _rpc(client, "get_tiktok_user_frequency_summary")
     except Exception as e:
         print(f"Failed to get: {e}")
         return None
+
+
+# bulk insert crawled videos into video table, skipping ones we already have
+async def upsert_videos(videos: list):
+    try:
+        async with supabase_connection() as client:
+            with db_latency.time("upsert_videos", errors=db_errors):
+                response = await client.post(
+                    "/video",
+                    params={"on_conflict": "video_id"},
+                    json=videos,
+                    headers={"Prefer": "resolution=ignore-duplicates,return=minimal"},
+                    # Batches are large, give them more time than a single RPC
+                    timeout=DB_TIMEOUT * 3,
+                )
+                response.raise_for_status()
+            return True
+    except Exception as e:
+        print(f"Failed to upsert videos: {e}")
+        return False
+
+
+# remove a chat the bot can no longer send to
+async def delete_chat_id(chat_id: str):
+    try:
+        async with supabase_connection() as client:
+            await _rpc(client, "delete_chat_id", {"p_chat_id": chat_id})
+        return True
+    except Exception as e:
+        print(f"Failed to delete chat id: {e}")
+        return False
+
+
+# move a group's rows to the supergroup it was upgraded to
+async def migrate_chat_id(old_chat_id: str, new_chat_id: str):
+    try:
+        async with supabase_connection() as client:
+            await _rpc(client, "migrate_chat_id", {"p_old_chat_id": old_chat_id, "p_new_chat_id": int(new_chat_id)})
+        return True
+    except Exception as e:
+        print(f"Failed to migrate chat id: {e}")
+        return False
+
+
+# page of video rows changed after the (updated_at, video_id) watermark, oldest first
+async def get_videos_updated_since(updated_at: str | None, video_id: str | None, limit: int):
+    params = {
+        "select": "video_id,link,tiktok_user,active,updated_at",
+        "order": "updated_at.asc,video_id.asc",
+        "limit": limit,
+    }
+    if updated_at:
+        # Keyset pagination: rows upserted in one batch share the same updated_at
+        params["or"] = (
+            f'(updated_at.gt."{updated_at}",and(updated_at.eq."{updated_at}",video_id.gt."{video_id}"))'
+        )
+    try:
+        async with supabase_connection() as client:
+            with db_latency.time("get_videos_updated_since", errors=db_errors):
+                response = await client.get("/video", params=params)
+                response.raise_for_status()
+            return response.json()
+    except Exception as e:
+        print(f"Failed to get updated videos: {e}")
+        return None
+
+
+# add views of videos picked locally to their frequency, ids repeat once per view
+async def increment_video_frequency(video_ids: list):
+    try:
+        async with supabase_connection() as client:
+            await _rpc(client, "increment_video_frequency", {"p_video_ids": video_ids})
+        return True
+    except Exception as e:
+        print(f"Failed to increment video frequency: {e}")
+        return False
@@ -1,7 +1,98 @@
-import asyncio
+import os
+import time
+from collections import OrderedDict
 from functools import wraps
 
-from app.db_services import add_chat_id_and_user_id, get_current_tele_user_info
+from dotenv import load_dotenv
+
+from app.chat_registry import chat_registry
+from app.db_services import get_current_tele_user_info
+
+load_dotenv()
+
+AUTH_CACHE_TTL: int = int(os.getenv("AUTH_CACHE_TTL", "300"))
+AUTH_NEGATIVE_TTL: int = int(os.getenv("AUTH_NEGATIVE_TTL", "60"))
+AUTH_CACHE_SIZE: int = int(os.getenv("AUTH_CACHE_SIZE", "10000"))
+# Comma separated Telegram user ids that always have the KING role
+AUTH_KING_IDS: str = os.getenv("AUTH_KING_IDS", "")
+# Only trust AUTH_KING_IDS and never ask the database
+AUTH_LOCAL_ONLY: bool = os.getenv("AUTH_LOCAL_ONLY", "").lower() in ("1", "true", "yes")
+
+
+class RoleLookupError(Exception):
+    """The role could not be fetched and nothing usable was cached."""
+
+
+class RoleCache:
+    """In-process cache of user roles in front of get_current_tele_user_info.
+
+    Known users are cached for `ttl` seconds and unknown ones for `negative_ttl`. When the
+    database can't be reached an expired entry is still used, so admin commands survive
+    short outages. Preloaded KING ids never expire.
+    """
+
+    def __init__(self, ttl: int, negative_ttl: int, max_entries: int, king_ids=(), local_only: bool = False):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.local_only = local_only
+        self.hits = 0
+        self.misses = 0
+        self._kings = {int(user_id) for user_id in king_ids}
+        # {user_id: (expires_at, role or None)}, oldest first
+        self._entries: OrderedDict = OrderedDict()
+
+    def _store(self, user_id: int, role) -> None:
+        ttl = self.ttl if role else self.negative_ttl
+        self._entries[user_id] = (time.monotonic() + ttl, role)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def get_role(self, user_id: int):
+        """Return the user's role, or None for unknown users. Raises RoleLookupError."""
+        if user_id in self._kings:
+            self.hits += 1
+            return "KING"
+        if self.local_only:
+            return None
+
+        entry = self._entries.get(user_id)
+        if entry is not None and entry[0] > time.monotonic():
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+        user = await get_current_tele_user_info(user_id)
+        if user is False:
+            # Lookup failed, fall back to whatever we knew before
+            if entry is not None:
+                print(f"Using expired role for user {user_id}")
+                return entry[1]
+            raise RoleLookupError(f"Could not fetch role for user {user_id}")
+
+        role = None
+        if isinstance(user, list) and len(user) > 0:
+            role = user[0].get("roles")
+        self._store(user_id, role)
+        return role
+
+    def invalidate(self, user_id: int = None) -> None:
+        """Forget one user's cached role, or every cached role."""
+        if user_id is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(user_id, None)
+
+
+# Create singleton instance
+role_cache = RoleCache(
+    AUTH_CACHE_TTL,
+    AUTH_NEGATIVE_TTL,
+    AUTH_CACHE_SIZE,
+    king_ids=[user_id.strip() for user_id in AUTH_KING_IDS.split(",") if user_id.strip()],
+    local_only=AUTH_LOCAL_ONLY,
+)
 
 
 def auth_check(handler):
@@ -11,8 +102,8 @@ def auth_check(handler):
         user_id = message.from_user.id
         print(f"Chat ID: {chat_id}, User ID: {user_id}")
 
-        # add chat_id and user_id if new user
-        asyncio.create_task(add_chat_id_and_user_id(chat_id, user_id))
+        # add chat_id and user_id if new user, written to the database in the background
+        chat_registry.register(chat_id, user_id)
 
         return await handler(message, *args, **kwargs)
 
@@ -24,13 +115,12 @@ def roles_check(handler):
     async def wrapper(message, *args, **kwargs):
         try:
             user_id = message.from_user.id
-            user = await get_current_tele_user_info(user_id)
+            role = await role_cache.get_role(user_id)
 
             # Check if user exists and has roles
-            if not user or not isinstance(user, list) or len(user) == 0:
+            if not role:
                 return await message.reply("User not found or has no role information.")
 
-            role = user[0].get("roles")
             print(f"User: {role}")  # Fixed string formatting
 
             if role != "KING":
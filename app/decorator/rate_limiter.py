@@ -1,20 +1,221 @@
 # app/rate_limiter.py
+import asyncio
+import heapq
+import os
+import sqlite3
+import threading
 import time
-from collections import defaultdict
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
-from typing import Dict, Callable, Any, TypeVar, Optional
+from typing import Dict, Callable, Any, TypeVar, Optional, List, Tuple
+
+from dotenv import load_dotenv
+
+load_dotenv()
 
 T = TypeVar('T', bound=Callable[..., Any])
 
+# "memory" (this process only) or "sqlite" (shared by every bot process on the host),
+# defaults to sqlite when updates are handled by several processes
+_MULTI_PROCESS = int(os.getenv("CLUSTER_WORKERS", "1")) > 1 or int(os.getenv("WEB_WORKERS", "1")) > 1
+RATE_LIMIT_BACKEND: str = os.getenv("RATE_LIMIT_BACKEND", "sqlite" if _MULTI_PROCESS else "memory")
+RATE_LIMIT_DB: str = os.getenv("RATE_LIMIT_DB", os.path.join("cache", "rate_limits.sqlite3"))
+# Extra buckets on top of the per-user cooldown, 0 disables them
+RATE_LIMIT_CHAT_PER_MINUTE: float = float(os.getenv("RATE_LIMIT_CHAT_PER_MINUTE", "0"))
+RATE_LIMIT_GLOBAL_PER_SECOND: float = float(os.getenv("RATE_LIMIT_GLOBAL_PER_SECOND", "0"))
 
-class RateLimiter:
-    """Class to handle rate limiting for bot commands."""
+# Absorbs float error so a call exactly one cooldown later still passes
+EPSILON = 1e-9
+
+# (key, capacity, refill rate in tokens per second)
+BucketSpec = Tuple[str, float, float]
+
+
+class _Bucket:
+    __slots__ = ("tokens", "updated", "expires")
+
+    def __init__(self, tokens: float, updated: float, expires: float):
+        self.tokens = tokens
+        self.updated = updated
+        # Time at which the bucket is full again and can be forgotten
+        self.expires = expires
+
+
+class RateLimitBackend(ABC):
+    """Storage for token buckets."""
+
+    # Backends doing I/O are run off the event loop by RateLimiter
+    blocking = False
+
+    @abstractmethod
+    def acquire(self, specs: List[BucketSpec], now: float) -> float:
+        """Take one token from every bucket, all or nothing.
+
+        Returns 0 when the tokens were taken, otherwise the seconds until all buckets
+        have a token again.
+        """
+
+    @abstractmethod
+    def __len__(self) -> int:
+        """Number of buckets currently stored."""
+
+
+def _refill(tokens: float, updated: float, capacity: float, rate: float, now: float) -> float:
+    return min(capacity, tokens + (now - updated) * rate)
+
+
+class MemoryBackend(RateLimitBackend):
+    """Buckets in a dict, expired ones are dropped through a heap of expiry times.
+
+    Memory is proportional to the number of buckets that are not full, i.e. active users.
+    """
 
     def __init__(self):
-        # Store for rate limiting data: {user_id: {command_name: last_used_timestamp}}
-        self.store: Dict[int, Dict[str, float]] = defaultdict(
-            lambda: defaultdict(lambda: 0)
+        self.buckets: Dict[str, _Bucket] = {}
+        self._expiry: list = []
+
+    def _prune(self, now: float) -> None:
+        expiry = self._expiry
+        while expiry and expiry[0][0] <= now:
+            expires, key = heapq.heappop(expiry)
+            bucket = self.buckets.get(key)
+            # Stale heap entries point at buckets that were used again since
+            if bucket is not None and bucket.expires == expires:
+                del self.buckets[key]
+
+    def acquire(self, specs: List[BucketSpec], now: float) -> float:
+        self._prune(now)
+
+        wait = 0.0
+        levels = []
+        for key, capacity, rate in specs:
+            bucket = self.buckets.get(key)
+            tokens = capacity if bucket is None else _refill(bucket.tokens, bucket.updated, capacity, rate, now)
+            if tokens < 1 - EPSILON:
+                wait = max(wait, (1 - tokens) / rate)
+            levels.append(tokens)
+        if wait:
+            return wait
+
+        for (key, capacity, rate), tokens in zip(specs, levels):
+            tokens -= 1
+            expires = now + (capacity - tokens) / rate
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                self.buckets[key] = _Bucket(tokens, now, expires)
+            else:
+                bucket.tokens, bucket.updated, bucket.expires = tokens, now, expires
+            heapq.heappush(self._expiry, (expires, key))
+        return 0.0
+
+    def __len__(self) -> int:
+        return len(self.buckets)
+
+
+class SqliteBackend(RateLimitBackend):
+    """Buckets in a local SQLite file in WAL mode, so several bot processes share limits."""
+
+    PRUNE_EVERY = 1000
+    blocking = True
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._calls = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            dirname = os.path.dirname(self.path)
+            if dirname:
+                os.makedirs(dirname, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS buckets ("
+                "key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL, expires REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS buckets_expires ON buckets (expires)")
+            self._local.conn = conn
+        return conn
+
+    def acquire(self, specs: List[BucketSpec], now: float) -> float:
+        conn = self._connect()
+        # Take the write lock up front so check-and-take is atomic across processes
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._calls += 1
+            if self._calls % self.PRUNE_EVERY == 0:
+                conn.execute("DELETE FROM buckets WHERE expires <= ?", (now,))
+
+            wait = 0.0
+            levels = []
+            for key, capacity, rate in specs:
+                row = conn.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+                tokens = capacity if row is None else _refill(row[0], row[1], capacity, rate, now)
+                if tokens < 1 - EPSILON:
+                    wait = max(wait, (1 - tokens) / rate)
+                levels.append(tokens)
+
+            if not wait:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO buckets (key, tokens, updated, expires) VALUES (?, ?, ?, ?)",
+                    [
+                        (key, tokens - 1, now, now + (capacity - tokens + 1) / rate)
+                        for (key, capacity, rate), tokens in zip(specs, levels)
+                    ],
+                )
+            conn.execute("COMMIT")
+            return wait
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def __len__(self) -> int:
+        return self._connect().execute("SELECT COUNT(*) FROM buckets").fetchone()[0]
+
+
+def create_backend(name: str = RATE_LIMIT_BACKEND) -> RateLimitBackend:
+    if name == "sqlite":
+        return SqliteBackend(RATE_LIMIT_DB)
+    return MemoryBackend()
+
+
+class RateLimiter:
+    """Class to handle rate limiting for bot commands.
+
+    Every command has a per-user token bucket (a cooldown is a bucket holding one token
+    that refills once per cooldown period). Optionally a per-chat and a global bucket are
+    checked as well; a call passes only if all of them have a token.
+    """
+
+    def __init__(self, backend: Optional[RateLimitBackend] = None):
+        self.backend = backend if backend is not None else create_backend()
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    @staticmethod
+    def _round_up(wait: float) -> Optional[int]:
+        if not wait:
+            return None
+        return int(wait) + 1  # +1 to round up
+
+    def check_buckets(self, specs: List[BucketSpec]) -> Optional[int]:
+        """Take a token from every bucket, or return the seconds to wait (rounded up)."""
+        return self._round_up(self.backend.acquire(specs, time.time()))
+
+    async def check_buckets_async(self, specs: List[BucketSpec]) -> Optional[int]:
+        """check_buckets() for handlers: blocking backends run on a thread of their own."""
+        if not self.backend.blocking:
+            return self.check_buckets(specs)
+        if self._executor is None:
+            # One thread is enough, SQLite serialises the write transactions anyway
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="rate-limit")
+        wait = await asyncio.get_running_loop().run_in_executor(
+            self._executor, self.backend.acquire, specs, time.time()
         )
+        return self._round_up(wait)
 
     def check_cooldown(self, user_id: int, command_name: str, cooldown_period: int) -> Optional[int]:
         """
@@ -28,28 +229,20 @@ class RateLimiter:
         Returns:
             None if user can execute command, otherwise seconds remaining until allowed
         """
-        current_time = time.time()
-        last_time = self.store[user_id][command_name]
-
-        # Check if cooldown period has passed
-        time_since_last_call = current_time - last_time
-        if last_time == 0 or time_since_last_call >= cooldown_period:
-            # Update last execution time
-            self.store[user_id][command_name] = current_time
-            return None
-
-        # User needs to wait
-        time_remaining = int(cooldown_period - time_since_last_call) + 1  # +1 to round up
-        return time_remaining
+        return self.check_buckets([(f"u:{user_id}:{command_name}", 1, 1 / cooldown_period)])
 
     def limit(self, cooldown: int = 5,
-              error_message: str = "Command cooldown active.") -> Callable[[T], T]:
+              error_message: str = "Command cooldown active.",
+              chat_per_minute: float = RATE_LIMIT_CHAT_PER_MINUTE,
+              global_per_second: float = RATE_LIMIT_GLOBAL_PER_SECOND) -> Callable[[T], T]:
         """
         Rate limiter decorator that enforces a cooldown between command executions.
 
         Args:
             cooldown: Time in seconds that must pass between command executions
             error_message: Message to send when cooldown is active
+            chat_per_minute: Commands per minute allowed in one chat across all users (0 = off)
+            global_per_second: Commands per second allowed across all chats (0 = off)
 
         Example usage:
             @rate_limiter.limit(cooldown=5, error_message="Please wait before using this command again.")
@@ -63,7 +256,13 @@ class RateLimiter:
                 user_id = message.from_user.id
                 command_name = func.__name__
 
-                time_remaining = self.check_cooldown(user_id, command_name, cooldown)
+                specs = [(f"u:{user_id}:{command_name}", 1, 1 / cooldown)]
+                if chat_per_minute:
+                    specs.append((f"c:{message.chat.id}", chat_per_minute, chat_per_minute / 60))
+                if global_per_second:
+                    specs.append(("g", global_per_second, global_per_second))
+
+                time_remaining = await self.check_buckets_async(specs)
                 if time_remaining is not None:
                     user_message = f"{error_message}"
                     return await message.answer(user_message)
@@ -0,0 +1,154 @@
+# app/download_scheduler.py
+import asyncio
+import os
+from collections import OrderedDict, deque
+from typing import Awaitable, Callable, Optional
+
+from dotenv import load_dotenv
+
+from app.metrics import Counter, Gauge
+
+load_dotenv()
+
+DOWNLOAD_CONCURRENCY: int = int(os.getenv("DOWNLOAD_CONCURRENCY", "2"))
+DOWNLOAD_QUEUE_SIZE: int = int(os.getenv("DOWNLOAD_QUEUE_SIZE", "20"))
+
+# Lower value runs first
+PRIORITY_DOWNLOAD = 0  # /download, the user sent us the link
+PRIORITY_RANDOM = 1  # /r and /ru
+PRIORITY_PREFETCH = 2  # Background refills, only when nobody is waiting
+
+
+download_shed = Counter("download_jobs_shed_total", "Downloads rejected because the queue was full.")
+
+
+class QueueFullError(Exception):
+    """The download queue is full and the job was shed."""
+
+
+class DownloadScheduler:
+    """Admission control in front of the downloader.
+
+    At most `concurrency` jobs run at once. Waiting jobs are kept per priority and per chat,
+    and chats of the same priority take turns so one busy group cannot starve the others.
+    Once `max_queue` jobs are waiting new ones are rejected with QueueFullError.
+    """
+
+    def __init__(self, concurrency: int, max_queue: int):
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.running = 0
+        self.queued = 0
+        self.shed = 0
+        # Cleared by the memory monitor to refuse new downloads while memory is short
+        self.accepting = True
+        # {priority: OrderedDict({chat_id: deque([future, ...])})}
+        self._queues: dict = {}
+
+    def _position(self, priority: int, chat_id, index: int) -> int:
+        """Estimate how many jobs will start before the index-th job of chat_id."""
+        ahead = 0
+        for queue_priority, chats in self._queues.items():
+            if queue_priority < priority:
+                ahead += sum(len(jobs) for jobs in chats.values())
+            elif queue_priority == priority:
+                ahead += index
+                before = True
+                for other_chat, jobs in chats.items():
+                    if other_chat == chat_id:
+                        before = False
+                        continue
+                    # Round-robin: chats ahead of us in the rotation get one extra turn
+                    ahead += min(len(jobs), index + 1 if before else index)
+        return ahead + 1
+
+    def _pop_next(self):
+        for priority in sorted(self._queues):
+            chats = self._queues[priority]
+            while chats:
+                chat_id, jobs = next(iter(chats.items()))
+                future = jobs.popleft()
+                if jobs:
+                    chats.move_to_end(chat_id)
+                else:
+                    del chats[chat_id]
+                self.queued -= 1
+                if not future.done():
+                    return future
+        return None
+
+    def _grant(self) -> None:
+        while self.running < self.concurrency:
+            future = self._pop_next()
+            if future is None:
+                return
+            self.running += 1
+            future.set_result(None)
+
+    def _remove(self, priority: int, chat_id, future: asyncio.Future) -> None:
+        jobs = self._queues.get(priority, {}).get(chat_id)
+        if jobs and future in jobs:
+            jobs.remove(future)
+            self.queued -= 1
+            if not jobs:
+                del self._queues[priority][chat_id]
+
+    async def _acquire(self, chat_id, priority: int,
+                       on_queued: Optional[Callable[[int], Awaitable]]) -> None:
+        if not self.accepting:
+            self.shed += 1
+            download_shed.inc()
+            raise QueueFullError("Downloads are paused while memory is low")
+
+        if self.running < self.concurrency and self.queued == 0:
+            self.running += 1
+            return
+
+        if self.queued >= self.max_queue:
+            self.shed += 1
+            download_shed.inc()
+            raise QueueFullError(f"Download queue is full ({self.queued} waiting)")
+
+        future = asyncio.get_running_loop().create_future()
+        jobs = self._queues.setdefault(priority, OrderedDict()).setdefault(chat_id, deque())
+        jobs.append(future)
+        self.queued += 1
+        position = self._position(priority, chat_id, len(jobs) - 1)
+
+        try:
+            if on_queued:
+                try:
+                    await on_queued(position)
+                except Exception as e:
+                    print(f"Failed to send queue position: {e}")
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # We were granted a slot right before being cancelled, hand it on
+                self._release()
+            else:
+                self._remove(priority, chat_id, future)
+            raise
+
+    def _release(self) -> None:
+        self.running -= 1
+        self._grant()
+
+    async def submit(self, chat_id, priority: int, factory: Callable[[], Awaitable],
+                     on_queued: Optional[Callable[[int], Awaitable]] = None):
+        """Run factory() once a slot is free and return its result.
+
+        on_queued(position) is awaited when the job has to wait for a slot.
+        """
+        await self._acquire(chat_id, priority, on_queued)
+        try:
+            return await factory()
+        finally:
+            self._release()
+
+
+# Create singleton instance
+download_scheduler = DownloadScheduler(DOWNLOAD_CONCURRENCY, DOWNLOAD_QUEUE_SIZE)
+
+Gauge("download_jobs_running", "Downloads running now.", function=lambda: download_scheduler.running)
+Gauge("download_jobs_queued", "Downloads waiting for a slot.", function=lambda: download_scheduler.queued)
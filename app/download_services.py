@@ -1,10 +1,30 @@
 import asyncio
+import csv
+import glob
+import io
 import os
+import random
+import shutil
+import tempfile
+import time
+from collections import OrderedDict
+from contextlib import AsyncExitStack
 
 import aiofiles
-import yt_dlp
+from dotenv import load_dotenv
 
-from app.db_services import get_user_not_fetch, get_user_fetched
+from app.db_services import get_user_not_fetch, get_user_fetched, upsert_videos
+from app.download_scheduler import download_scheduler, PRIORITY_RANDOM
+from app.known_videos import known_videos
+from app.metadata_cache import metadata_cache
+from app.metrics import Counter, Gauge
+from app.random_index import random_index
+from app.shared_state import PROCESS_OWNER, shared_state
+from app.stats_service import stats_service
+from app.utils import extract_tiktok_video_id, is_partial_download
+from app.ytdlp_pool import YtDlpPool, YTDLP_POOL_SIZE, YTDLP_MAX_JOBS, YTDLP_MAX_RSS, YTDLP_JOB_TIMEOUT
+
+load_dotenv()
 
 YT_DLP_DEFAULT_OPTS = {
     "extract_flat": True,  # Don't download the videos, just get the info
@@ -14,13 +34,42 @@ YT_DLP_DEFAULT_OPTS = {
 }
 
 DOWNLOAD_DIR = "downloads"
+STAGING_DIR = os.path.join(DOWNLOAD_DIR, ".staging")
+
+MAX_VIDEO_SIZE: int = 50 * 1024 * 1024  # 50MB
+
+# Hand Telegram the CDN URL of small videos instead of downloading and uploading them
+URL_PASSTHROUGH: bool = os.getenv("URL_PASSTHROUGH", "1") == "1"
+URL_PASSTHROUGH_MAX_SIZE: int = 20 * 1024 * 1024  # Telegram fetches files up to 20MB by URL
+URL_PASSTHROUGH_MAX_FAILURES: int = int(os.getenv("URL_PASSTHROUGH_MAX_FAILURES", "5"))
+URL_PASSTHROUGH_COOLDOWN: int = int(os.getenv("URL_PASSTHROUGH_COOLDOWN", "3600"))
+
+VIDEO_CACHE_MAX_BYTES: int = int(os.getenv("VIDEO_CACHE_MAX_MB", "500")) * 1024 * 1024
+JANITOR_INTERVAL: int = int(os.getenv("VIDEO_CACHE_JANITOR_INTERVAL", "600"))
+PARTIAL_MAX_AGE: int = 60 * 60  # Leftovers older than this are from dead downloads
+# Only used when several processes share DOWNLOAD_DIR, see VideoCache.shared
+SHARED_EVICT_INTERVAL: int = int(os.getenv("VIDEO_CACHE_SHARED_EVICT_INTERVAL", "30"))
+SHARED_EVICT_GRACE: int = 10 * 60  # Files another process used this recently may still be uploading
+DOWNLOAD_LEASE_TTL: int = int(os.getenv("DOWNLOAD_LEASE_TTL", "900"))
+DOWNLOAD_LEASE_POLL: float = 1.0
+
+OUTPUT_DIR = "output"
+CSV_HEADERS = ["video_id", "link", "tiktok_user"]
+CSV_FLUSH_ROWS: int = 1000  # Write buffered rows to disk after this many
 
+INGEST_BATCH_SIZE: int = int(os.getenv("INGEST_BATCH_SIZE", "500"))
+INGEST_MAX_IN_FLIGHT: int = int(os.getenv("INGEST_MAX_IN_FLIGHT", "2"))
 
-def get_yt_dlp_options():
+CRAWL_CONCURRENCY: int = int(os.getenv("CRAWL_CONCURRENCY", "3"))
+CRAWL_USER_TIMEOUT: int = int(os.getenv("CRAWL_USER_TIMEOUT", "600"))
+CRAWL_JITTER: float = float(os.getenv("CRAWL_JITTER", "2"))  # Max random pause before each creator
+
+
+def get_yt_dlp_options(output_dir: str = DOWNLOAD_DIR):
     """Returns yt-dlp options for TikTok video downloads with additional configurations to avoid blocking."""
     return {
         "format": "bestvideo+bestaudio/best",  # Download the best quality video with audio
-        "outtmpl": os.path.join(DOWNLOAD_DIR, "%(id)s.%(ext)s"),  # Template for output file names
+        "outtmpl": os.path.join(output_dir, "%(id)s.%(ext)s"),  # Template for output file names
         "merge_output_format": "mp4",  # Ensure the final merged file is MP4
         # Additional options to mimic a browser and prevent blocking by TikTok:
         # 'http_headers': {
@@ -38,126 +87,780 @@ def get_yt_dlp_options():
     }
 
 
-async def get_video_async(video_url: str) -> str:
-    os.makedirs(DOWNLOAD_DIR, exist_ok=True)  # Ensure download_dir exists
-    ydl_opts = get_yt_dlp_options()
+class VideoCache:
+    """Byte-budgeted LRU cache of finished downloads in DOWNLOAD_DIR.
+
+    Downloads are written to a private staging directory and only moved into the cache
+    with an atomic rename once yt-dlp succeeded, so readers never see half-written files.
+    Entries that are currently being sent are pinned and skipped by eviction.
+
+    With shared=True several processes use the same directory. Each one adopts files the
+    others downloaded and touches the files it serves; only evict_shared(), run by the
+    leader's janitor, deletes anything, least recently touched first.
+    """
+
+    def __init__(self, directory: str, staging_dir: str, max_bytes: int):
+        self.directory = directory
+        self.staging_dir = staging_dir
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        # {video_id: [path, size]}, oldest first
+        self._entries: OrderedDict = OrderedDict()
+        self._pins: dict = {}
+        self._active_staging: set = set()
+        self._loaded = False
+        self.shared = False
+
+    def load(self) -> None:
+        """Adopt finished videos left in the directory by a previous run, least recently used first."""
+        if self._loaded:
+            return
+        self._loaded = True
+        os.makedirs(self.staging_dir, exist_ok=True)
+        self._index(self._scan())
+        self._evict()
+
+    def _scan(self) -> list:
+        # [(atime, path, size)] of finished videos, least recently used first
+        found = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if not entry.is_file() or is_partial_download(entry.name):
+                    continue
+                stat = entry.stat()
+                found.append((stat.st_atime, entry.path, stat.st_size))
+        return sorted(found)
+
+    def _index(self, found: list) -> None:
+        self._entries.clear()
+        self.total_bytes = 0
+        for _, path, size in found:
+            video_id = os.path.splitext(os.path.basename(path))[0]
+            self._entries[video_id] = [path, size]
+            self.total_bytes += size
+
+    def adopt(self, video_id: str):
+        """Pin and return a finished file for video_id another process put in the directory, or None."""
+        for path in glob.glob(os.path.join(glob.escape(self.directory), glob.escape(video_id) + ".*")):
+            if is_partial_download(path):
+                continue
+            try:
+                size = os.path.getsize(path)
+            except FileNotFoundError:
+                continue
+            if video_id in self._entries:
+                self.total_bytes -= self._entries[video_id][1]
+            self._entries[video_id] = [path, size]
+            self._entries.move_to_end(video_id)
+            self.total_bytes += size
+            self._pins[video_id] = self._pins.get(video_id, 0) + 1
+            return path
+        return None
+
+    def acquire(self, video_id: str):
+        """Return the cached path for video_id and pin it, or None on a miss."""
+        self.load()
+        entry = self._entries.get(video_id)
+        if entry is None or not os.path.exists(entry[0]):
+            if entry is not None:
+                self._drop(video_id)
+            path = self.adopt(video_id) if self.shared else None
+            if path is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return path
+
+        self._entries.move_to_end(video_id)
+        self._pins[video_id] = self._pins.get(video_id, 0) + 1
+        self.hits += 1
+        if self.shared:
+            # Tell the process that evicts this file was just used
+            try:
+                os.utime(entry[0])
+            except OSError:
+                pass
+        return entry[0]
+
+    def pin(self, path: str) -> None:
+        """Take an extra reference on a cached path so eviction leaves it alone."""
+        video_id = os.path.splitext(os.path.basename(path))[0]
+        self._pins[video_id] = self._pins.get(video_id, 0) + 1
+
+    def release(self, path: str) -> None:
+        """Unpin a path returned by acquire() or finalize()."""
+        video_id = os.path.splitext(os.path.basename(path))[0]
+        count = self._pins.get(video_id, 0) - 1
+        if count > 0:
+            self._pins[video_id] = count
+        else:
+            self._pins.pop(video_id, None)
+            self._evict()
+
+    def new_staging(self) -> str:
+        self.load()
+        path = tempfile.mkdtemp(dir=self.staging_dir)
+        self._active_staging.add(path)
+        return path
+
+    def discard_staging(self, path: str) -> None:
+        self._active_staging.discard(path)
+        shutil.rmtree(path, ignore_errors=True)
+
+    def finalize(self, video_id: str, staged_path: str) -> str:
+        """Atomically move a finished download into the cache and return its pinned path."""
+        ext = os.path.splitext(staged_path)[1] or ".mp4"
+        final_path = os.path.join(self.directory, f"{video_id}{ext}")
+        os.replace(staged_path, final_path)
+
+        if video_id in self._entries:
+            self.total_bytes -= self._entries[video_id][1]
+        size = os.path.getsize(final_path)
+        self._entries[video_id] = [final_path, size]
+        self._entries.move_to_end(video_id)
+        self.total_bytes += size
+        self._pins[video_id] = self._pins.get(video_id, 0) + 1
+
+        self._evict()
+        return final_path
+
+    def _drop(self, video_id: str) -> None:
+        path, size = self._entries.pop(video_id)
+        self.total_bytes -= size
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def _evict(self, keep: set | None = None) -> None:
+        if keep is None:
+            if self.shared:
+                # Other processes may be sending these files, leave it to evict_shared()
+                return
+            keep = set()
+        if self.total_bytes <= self.max_bytes:
+            return
+        for video_id in list(self._entries):
+            if self.total_bytes <= self.max_bytes:
+                break
+            if video_id in self._pins or video_id in keep:
+                continue
+            self._drop(video_id)
+
+    async def evict_shared(self, grace: float = SHARED_EVICT_GRACE) -> None:
+        """Re-read the shared directory and evict down to max_bytes, sparing files any process used lately."""
+        self.load()
+        found = await asyncio.to_thread(self._scan)
+        self._index(found)
+        cutoff = time.time() - grace
+        recent = {os.path.splitext(os.path.basename(path))[0] for atime, path, _ in found if atime > cutoff}
+        self._evict(recent)
+
+    def _sweep(self, keep: set, max_age: float) -> int:
+        # Runs in a worker thread, only touches files outside the index
+        removed = 0
+        cutoff = time.time() - max_age
+
+        with os.scandir(self.staging_dir) as it:
+            for entry in it:
+                if entry.path in keep or entry.stat().st_mtime > cutoff:
+                    continue
+                shutil.rmtree(entry.path, ignore_errors=True)
+                removed += 1
+
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if not entry.is_file() or not is_partial_download(entry.name):
+                    continue
+                if entry.stat().st_mtime > cutoff:
+                    continue
+                os.remove(entry.path)
+                removed += 1
+        return removed
+
+    async def cleanup(self, max_age: float = PARTIAL_MAX_AGE) -> int:
+        """Remove abandoned staging directories and partial files left by failed downloads."""
+        self.load()
+        return await asyncio.to_thread(self._sweep, set(self._active_staging), max_age)
+
+
+os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+video_cache = VideoCache(DOWNLOAD_DIR, STAGING_DIR, VIDEO_CACHE_MAX_BYTES)
+
+Gauge("video_cache_bytes", "Size of finished downloads kept on disk.", function=lambda: video_cache.total_bytes)
+Gauge("video_cache_lookups", "Video cache lookups since start.", ["result"],
+      function=lambda: {"hit": video_cache.hits, "miss": video_cache.misses})
+downloaded_bytes = Counter("ytdlp_downloaded_bytes_total", "Bytes of video downloaded by yt-dlp.")
+
+
+async def run_cache_janitor(interval: int = JANITOR_INTERVAL) -> None:
+    """Periodically sweep partial downloads out of DOWNLOAD_DIR.
+
+    With a shared cache this is also the only place finished videos are evicted, every
+    SHARED_EVICT_INTERVAL seconds, so it must run in one process (the leader).
+    """
+    last_sweep = None
+    while True:
+        try:
+            if video_cache.shared:
+                await video_cache.evict_shared()
+            if last_sweep is None or time.monotonic() - last_sweep >= interval:
+                last_sweep = time.monotonic()
+                removed = await video_cache.cleanup()
+                if removed:
+                    print(f"Video cache janitor removed {removed} leftover files")
+        except Exception as e:
+            print(f"Video cache janitor error: {e}")
+        await asyncio.sleep(min(interval, SHARED_EVICT_INTERVAL) if video_cache.shared else interval)
+
+
+class _Flight:
+    """One in-progress download shared by every caller asking for the same video."""
+    __slots__ = ("task", "waiters", "released")
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+        self.released = False
+
+    def release_download(self) -> None:
+        # Drop the reference finalize() took for the download itself, exactly once
+        if self.released:
+            return
+        self.released = True
+        if not self.task.cancelled() and self.task.exception() is None and self.task.result():
+            video_cache.release(self.task.result())
+
+
+# {video id (or url for short links): _Flight}
+_inflight: dict = {}
+
+
+def _on_flight_done(key: str, flight: _Flight) -> None:
+    if _inflight.get(key) is flight:
+        del _inflight[key]
+    if flight.waiters == 0:
+        # Every caller gave up before the download finished
+        flight.release_download()
+
+
+async def get_video_async(video_url: str, chat_id=None, priority: int = PRIORITY_RANDOM,
+                          on_queued=None, on_progress=None, send_url=None) -> str:
+    """Return a local path for the video, downloading it on a cache miss.
+
+    Concurrent calls for the same video share a single download. The returned path is
+    pinned in video_cache once per caller; each caller must call video_cache.release(path)
+    once it is done sending, and the file only becomes evictable after the last one did.
+
+    New downloads go through download_scheduler with the given chat_id and priority;
+    on_queued(position) is awaited if the download has to wait. Raises QueueFullError
+    when the queue is full. on_progress(downloaded, total) follows the download, only for
+    the caller that started it.
+
+    With send_url(video_id, direct_url) a new download first offers a small video to
+    Telegram by its CDN URL, in the same slot and from the same extraction. When that
+    callback returns True nothing is downloaded and "" is returned.
+    """
+    video_id = extract_tiktok_video_id(video_url)
+    if video_id:
+        cached_path = video_cache.acquire(video_id)
+        if cached_path:
+            print(f"Video served from cache: {cached_path}")
+            return cached_path
+
+    key = video_id or video_url
+    flight = _inflight.get(key)
+    if flight is None:
+        flight = _Flight(asyncio.create_task(
+            _download_once(video_url, video_id, chat_id, priority, on_queued, on_progress, send_url)
+        ))
+        flight.task.add_done_callback(lambda _: _on_flight_done(key, flight))
+        _inflight[key] = flight
+    else:
+        print(f"Joining in-flight download of {key}")
+
+    flight.waiters += 1
+    video_path = ""
+    try:
+        video_path = await asyncio.shield(flight.task)
+        if video_path:
+            video_cache.pin(video_path)
+        return video_path
+    finally:
+        flight.waiters -= 1
+        if flight.waiters == 0 and flight.task.done():
+            flight.release_download()
+
+
+async def _download_once(video_url: str, video_id: str | None, chat_id, priority: int,
+                         on_queued, on_progress, send_url=None) -> str:
+    """Download through download_scheduler, once across every process sharing the cache.
+
+    With a shared cache the download holds the lease "download:<video id>"; a process that
+    finds it taken waits for the lease and then adopts the file the holder left behind.
+    """
+    def submit():
+        return download_scheduler.submit(
+            chat_id, priority, lambda: _fetch_video(video_url, video_id, on_progress, send_url), on_queued
+        )
 
-    loop = asyncio.get_event_loop()
+    if not (video_cache.shared and video_id):
+        return await submit()
 
+    lease = f"download:{video_id}"
     try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            # Get minimal info first
-            info_dict = await loop.run_in_executor(None, lambda: ydl.extract_info(video_url, download=False))
+        while not await asyncio.to_thread(shared_state.acquire_lease, lease, PROCESS_OWNER, DOWNLOAD_LEASE_TTL):
+            await asyncio.sleep(DOWNLOAD_LEASE_POLL)
+    except Exception as e:
+        # Better a duplicate download than none
+        print(f"Download lease error: {e}")
+        return await submit()
 
-            # Check file size before downloading (optional size limit)
-            if info_dict.get("filesize") and info_dict.get("filesize") > 50 * 1024 * 1024:  # 50MB
-                print(f"Skipping large file: {info_dict.get('filesize') / 1024 / 1024:.2f}MB")
+    try:
+        path = video_cache.adopt(video_id)
+        if path:
+            print(f"Video downloaded by another process: {path}")
+            return path
+        return await submit()
+    finally:
+        await asyncio.to_thread(shared_state.release_lease, lease, PROCESS_OWNER)
+
+
+def _too_large(video_id: str | None) -> bool:
+    metadata = metadata_cache.get(video_id) if video_id else None
+    filesize = metadata and metadata.get("filesize")
+    if filesize and filesize > MAX_VIDEO_SIZE:
+        print(f"Skipping large file: {filesize / 1024 / 1024:.2f}MB")
+        return True
+    return False
+
+
+async def _fetch_video(video_url: str, video_id: str | None, on_progress=None, send_url=None) -> str:
+    """One download slot: offer a small video to Telegram by URL first, download anything else."""
+    info = None
+    if send_url is not None and url_passthrough.available():
+        resolved = await url_passthrough.resolve(video_url, video_id)
+        if resolved:
+            video_id, direct_url, info = resolved
+            if direct_url and await send_url(video_id, direct_url):
                 return ""
+    return await _download_video(video_url, video_id, on_progress, info)
+
+
+async def _download_video(video_url: str, video_id: str | None, on_progress=None, info: dict = None) -> str:
+    # Known to be too big from an earlier extraction or crawl, don't even ask TikTok
+    if _too_large(video_id):
+        return ""
+
+    staging = video_cache.new_staging()
+    payload = {
+        "url": video_url,
+        "outtmpl": os.path.join(staging, "%(id)s.%(ext)s"),
+        "max_filesize": MAX_VIDEO_SIZE,
+    }
+    if info:
+        payload["info"] = info
 
-            # Download with optimized options
-            info_dict = await loop.run_in_executor(None, lambda: ydl.extract_info(video_url, download=True))
-            file_path = ydl.prepare_filename(info_dict)
-            print(f"Video downloaded successfully: {file_path}")
-            return file_path
+    try:
+        result = await ytdlp_pool.run("download", payload, on_progress=on_progress)
+        video_id = str(result.get("id") or video_id)
+        metadata_cache.put(video_id, result["metadata"])
+
+        if not result["filepath"]:
+            if not _too_large(video_id):
+                print(f"Download produced no file for {video_url}")
+            return ""
+
+        downloaded_bytes.inc(amount=os.path.getsize(result["filepath"]))
+        file_path = video_cache.finalize(video_id, result["filepath"])
+        print(f"Video downloaded successfully: {file_path}")
+        return file_path
     except Exception as e:
         print(f"Download error: {e}")
         return ""
+    finally:
+        video_cache.discard_staging(staging)
 
 
-async def fetch_videos(user_url: str, username: str, playlist_limit: int = None):
-    """Fetch video information from a user URL with an optional playlist limit."""
-    if not ("@" in user_url or "/user/" in user_url):
-        raise ValueError("The provided URL does not appear to be a valid TikTok user profile URL")
-
+def get_crawl_options():
+    """Returns yt-dlp options for listing a profile's videos without downloading them."""
     ydl_opts = YT_DLP_DEFAULT_OPTS.copy()
-    if playlist_limit:
-        ydl_opts["playlistend"] = playlist_limit
 
     # Add these options to reduce memory usage
     ydl_opts["quiet"] = True
     ydl_opts["extract_flat"] = True  # Don't extract full info
     ydl_opts["skip_download"] = True
+    return ydl_opts
+
+
+ytdlp_pool = YtDlpPool(
+    {"download": get_yt_dlp_options()},
+    size=YTDLP_POOL_SIZE,
+    max_jobs=YTDLP_MAX_JOBS,
+    max_rss=YTDLP_MAX_RSS,
+    job_timeout=YTDLP_JOB_TIMEOUT,
+)
+
+# Separate workers for crawls, so a long profile listing never holds up user downloads.
+# Started on demand and stopped again when a crawl finishes.
+crawl_pool = YtDlpPool(
+    {"crawl": get_crawl_options()},
+    size=CRAWL_CONCURRENCY,
+    max_jobs=YTDLP_MAX_JOBS,
+    max_rss=YTDLP_MAX_RSS,
+    job_timeout=CRAWL_USER_TIMEOUT,
+)
+
+Gauge("ytdlp_workers_busy", "yt-dlp workers running a job.", ["pool"],
+      function=lambda: {"download": ytdlp_pool.busy(), "crawl": crawl_pool.busy()})
+
+
+class UrlPassthrough:
+    """Resolves direct CDN URLs of small videos so Telegram can fetch them itself.
+
+    Saves downloading and uploading the file, but Telegram can't fetch every CDN URL. After
+    `max_failures` rejected URLs in a row pass-through is suspended for `cooldown` seconds.
+    """
+
+    def __init__(self, enabled: bool, max_size: int, max_failures: int, cooldown: int):
+        self.enabled = enabled
+        self.max_size = max_size
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self.sent = 0
+        self.rejected = 0
+        self._failures = 0
+        self._suspended_until = 0.0
+
+    def available(self) -> bool:
+        return self.enabled and time.monotonic() >= self._suspended_until
+
+    def record(self, ok: bool) -> None:
+        """Report whether Telegram accepted a resolved URL."""
+        if ok:
+            self.sent += 1
+            self._failures = 0
+            return
+        self.rejected += 1
+        self._failures += 1
+        if self._failures >= self.max_failures:
+            print(f"Telegram rejected {self._failures} video URLs in a row, uploading files for {self.cooldown}s")
+            self._failures = 0
+            self._suspended_until = time.monotonic() + self.cooldown
+
+    async def resolve(self, video_url: str, video_id: str | None = None):
+        """Return (video id, direct URL or None, extracted info), or None when not worth trying.
+
+        Runs inside the caller's download slot. The info lets _download_video skip a second
+        extraction when there is no small format or Telegram rejects the URL.
+        """
+        metadata = metadata_cache.get(video_id) if video_id else None
+        if metadata and (metadata.get("filesize") or 0) > self.max_size:
+            return None
+
+        payload = {"url": video_url, "max_filesize": self.max_size}
+        try:
+            result = await ytdlp_pool.run("extract", payload)
+        except Exception as e:
+            print(f"Extraction error: {e}")
+            return None
+
+        video_id = str(result.get("id") or video_id)
+        metadata_cache.put(video_id, result["metadata"])
+        return video_id, result["url"], result.get("info")
+
+
+url_passthrough = UrlPassthrough(URL_PASSTHROUGH, URL_PASSTHROUGH_MAX_SIZE, URL_PASSTHROUGH_MAX_FAILURES,
+                                 URL_PASSTHROUGH_COOLDOWN)
+
+Gauge("url_passthrough_videos", "Videos sent to Telegram by CDN URL instead of uploading.", ["result"],
+      function=lambda: {"sent": url_passthrough.sent, "rejected": url_passthrough.rejected})
 
-    try:
-        # Run the extraction in a separate thread to avoid blocking the event loop
-        loop = asyncio.get_event_loop()
-        info = await loop.run_in_executor(
-            None,
-            lambda: yt_dlp.YoutubeDL(ydl_opts).extract_info(user_url, download=False),
-        )
 
-        videos_info = []
-        if "entries" in info:
-            # Process entries one by one instead of creating a large list comprehension
-            for entry in info["entries"]:
-                if entry:
-                    videos_info.append(
-                        {
-                            "link": entry.get("url", ""),
-                            "video_id": entry.get("id", ""),
-                            "tiktok_user": username,
-                        }
-                    )
-
-                    # Process in batches to avoid memory buildup
-                    if len(videos_info) >= 100:
-                        # Return this batch and process it before continuing
-                        yield videos_info
-                        videos_info = []
-
-            # Return any remaining videos
-            if videos_info:
-                yield videos_info
-    except Exception as e:
-        print(f"Error extracting videos for user '{username}': {str(e)}")
-        yield []
+async def fetch_videos(user_url: str, username: str, playlist_limit: int = None):
+    """Fetch video information from a user URL with an optional playlist limit.
 
+    Only videos missing from the known_videos index are yielded; paging stops once the
+    crawl reaches videos we already have. Extraction errors are raised to the caller.
+    """
+    if not ("@" in user_url or "/user/" in user_url):
+        raise ValueError("The provided URL does not appear to be a valid TikTok user profile URL")
 
-async def create_csv(videos: list, filename: str = "tiktok_videos.csv") -> str:
-    """Create a CSV file from the list of videos."""
-    os.makedirs("output", exist_ok=True)
-    file_path = os.path.join("output", filename)
-    headers = ["video_id", "link", "tiktok_user"]
-
-    async with aiofiles.open(file_path, "w", newline="", encoding="utf-8") as csvfile:
-        content = [",".join(headers)] + [
-            ",".join(
-                [
-                    str(video.get("video_id", "")),
-                    str(video.get("link", "")),
-                    str(video.get("tiktok_user", "")),
-                ]
-            )
+    # Run the extraction in a pool worker to keep it off the event loop
+    payload = {
+        "url": user_url,
+        "playlistend": playlist_limit,
+        "known_ids": known_videos.get(username).tolist(),
+    }
+    entries = await crawl_pool.run("crawl", payload, profile="crawl")
+
+    videos_info = []
+    # Process entries one by one instead of creating a large list comprehension
+    for entry in entries:
+        metadata_cache.put(entry["id"], {**entry, "uploader": entry["uploader"] or username})
+        videos_info.append(
+            {
+                "link": entry["url"],
+                "video_id": entry["id"],
+                "tiktok_user": username,
+            }
+        )
+
+        # Process in batches to avoid memory buildup
+        if len(videos_info) >= 100:
+            # Return this batch and process it before continuing
+            yield videos_info
+            videos_info = []
+
+    # Return any remaining videos
+    if videos_info:
+        yield videos_info
+
+
+class CsvSink:
+    """Streams crawled videos into a CSV file as they arrive.
+
+    Rows go to a temporary file that is flushed every CSV_FLUSH_ROWS rows and renamed
+    over the final path only when the crawl completed, so readers never see a partial file.
+    """
+
+    def __init__(self, filename: str):
+        os.makedirs(OUTPUT_DIR, exist_ok=True)
+        self.path = os.path.join(OUTPUT_DIR, filename)
+        self.rows = 0
+        self._tmp_path = f"{self.path}.tmp"
+        self._file = None
+        self._pending: list = []
+        self._pending_rows = 0
+        self._lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        self._file = await aiofiles.open(self._tmp_path, "w", newline="", encoding="utf-8")
+        self._buffer_rows([CSV_HEADERS])
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            await self.close()
+        else:
+            await self.abort()
+
+    def _buffer_rows(self, rows) -> None:
+        buffer = io.StringIO()
+        csv.writer(buffer, lineterminator="\n").writerows(rows)
+        self._pending.append(buffer.getvalue())
+
+    async def write(self, videos: list) -> None:
+        self._buffer_rows(
+            [video.get("video_id", ""), video.get("link", ""), video.get("tiktok_user", "")]
             for video in videos
-        ]
-        await csvfile.write("\n".join(content))
-    return file_path
+        )
+        self.rows += len(videos)
+        self._pending_rows += len(videos)
+        if self._pending_rows >= CSV_FLUSH_ROWS:
+            await self.flush()
+
+    async def flush(self) -> None:
+        async with self._lock:
+            chunk, self._pending = "".join(self._pending), []
+            self._pending_rows = 0
+            if chunk:
+                await self._file.write(chunk)
+                await self._file.flush()
+
+    async def close(self) -> str:
+        await self.flush()
+        await self._file.close()
+        os.replace(self._tmp_path, self.path)
+        return self.path
+
+    async def abort(self) -> None:
+        await self._file.close()
+        if os.path.exists(self._tmp_path):
+            os.remove(self._tmp_path)
+
+
+class IngestSink:
+    """Upserts crawled videos straight into the video table in large batches.
+
+    At most INGEST_MAX_IN_FLIGHT batches are being sent at once; write() waits for a free
+    slot, which slows the crawl down instead of buffering without limit. Videos of stored
+    batches are added to known_videos right away, videos of failed batches are crawled
+    again next time.
+    """
+
+    def __init__(self, batch_size: int = INGEST_BATCH_SIZE, max_in_flight: int = INGEST_MAX_IN_FLIGHT):
+        self.batch_size = batch_size
+        self.rows = 0
+        self.batches = 0
+        self.failed = 0
+        self._pending: list = []
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self._tasks: set = set()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def write(self, videos: list) -> None:
+        self._pending.extend(
+            {"video_id": video["video_id"], "link": video["link"], "tiktok_user": video["tiktok_user"]}
+            for video in videos
+        )
+        while len(self._pending) >= self.batch_size:
+            batch, self._pending = self._pending[:self.batch_size], self._pending[self.batch_size:]
+            await self._send(batch)
+
+    async def _send(self, batch: list) -> None:
+        await self._slots.acquire()
+        task = asyncio.create_task(self._upsert(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _upsert(self, batch: list) -> None:
+        try:
+            if await upsert_videos(batch) is False:
+                self.failed += len(batch)
+            else:
+                self.rows += len(batch)
+                self.batches += 1
+                self._remember(batch)
+        finally:
+            self._slots.release()
+
+    @staticmethod
+    def _remember(batch: list) -> None:
+        by_user: dict = {}
+        for video in batch:
+            by_user.setdefault(video["tiktok_user"], []).append(video["video_id"])
+        for tiktok_user, video_ids in by_user.items():
+            known_videos.add(tiktok_user, video_ids)
+
+    async def close(self) -> None:
+        if self._pending:
+            batch, self._pending = self._pending, []
+            await self._send(batch)
+        if self._tasks:
+            await asyncio.gather(*self._tasks)
+        print(f"Ingested {self.rows} videos in {self.batches} batches, {self.failed} failed")
 
 
-async def process_users(users, playlist_limit=None, csv_filename="tiktok_videos.csv"):
-    """Process users to fetch videos and save them into a CSV file."""
-    all_videos = []
-    for user in users:
-        # Collect videos from the async generator
-        user_videos = []
-        async for batch in fetch_videos(user["link"], user["tiktok_user"], playlist_limit):
-            user_videos.extend(batch)
+async def create_csv(videos: list, filename: str = "tiktok_videos.csv") -> str:
+    """Create a CSV file from the list of videos."""
+    async with CsvSink(filename) as sink:
+        await sink.write(videos)
+    return sink.path
+
+
+class CrawlStats:
+    """Counters for one process_users run."""
+
+    def __init__(self, total_users: int):
+        self.total_users = total_users
+        self.users = 0
+        self.videos = 0
+        self.failures = 0
+        self.started = time.monotonic()
+
+    def report(self) -> str:
+        elapsed = max(time.monotonic() - self.started, 1e-6)
+        return (
+            f"Crawled {self.users}/{self.total_users} users, {self.videos} videos, "
+            f"{self.failures} failures in {elapsed:.1f}s "
+            f"({self.users / elapsed:.2f} users/s, {self.videos / elapsed:.1f} videos/s)"
+        )
 
-        print(f"Successfully crawled user: {user['tiktok_user']} - found {len(user_videos)} videos")
-        all_videos.extend(user_videos)
 
-    csv_path = await create_csv(all_videos, filename=csv_filename)
-    print(f"CSV created at: {csv_path}")
+# Cleared while memory is low: crawls finish the user they are on and wait before the next
+crawl_gate = asyncio.Event()
+crawl_gate.set()
+
+
+def pause_crawls() -> None:
+    crawl_gate.clear()
+
+
+def resume_crawls() -> None:
+    crawl_gate.set()
+
+
+async def _crawl_user(user: dict, playlist_limit, semaphore: asyncio.Semaphore, stats: CrawlStats,
+                      sinks: list) -> None:
+    async with semaphore:
+        await crawl_gate.wait()
+        # Spread requests out a little so TikTok doesn't see a burst
+        await asyncio.sleep(random.uniform(0, CRAWL_JITTER))
+
+        # Hand every batch to the sinks as soon as the generator yields it
+        found = 0
+        try:
+            async with asyncio.timeout(CRAWL_USER_TIMEOUT):
+                async for batch in fetch_videos(user["link"], user["tiktok_user"], playlist_limit):
+                    for sink in sinks:
+                        await sink.write(batch)
+                    found += len(batch)
+        except TimeoutError:
+            stats.failures += 1
+            print(f"Timed out crawling user: {user['tiktok_user']} after {CRAWL_USER_TIMEOUT}s "
+                  f"- kept {found} new videos")
+        except Exception as e:
+            stats.failures += 1
+            print(f"Failed to crawl user: {user['tiktok_user']} - {e} - kept {found} new videos")
+        else:
+            print(f"Successfully crawled user: {user['tiktok_user']} - found {found} new videos "
+                  f"[{stats.users + 1}/{stats.total_users}]")
+
+        # Batches handed to the sinks before a failure still count
+        stats.users += 1
+        stats.videos += found
+
+
+async def process_users(users, playlist_limit=None, csv_filename=None, ingest=True):
+    """Crawl users concurrently (up to CRAWL_CONCURRENCY at once).
+
+    New videos are upserted into the database as they are found (ingest=True) and/or
+    written to output/<csv_filename>. Only videos stored in the database are recorded in
+    known_videos, a CSV-only crawl finds the same videos again next time.
+    """
+    users = users or []
+    stats = CrawlStats(len(users))
+    semaphore = asyncio.Semaphore(CRAWL_CONCURRENCY)
+    try:
+        async with AsyncExitStack() as stack:
+            sinks = []
+            if ingest:
+                ingest_sink = await stack.enter_async_context(IngestSink())
+                sinks.append(ingest_sink)
+            if csv_filename:
+                csv_sink = await stack.enter_async_context(CsvSink(csv_filename))
+                sinks.append(csv_sink)
+
+            await asyncio.gather(*(
+                _crawl_user(user, playlist_limit, semaphore, stats, sinks) for user in users
+            ))
+    finally:
+        await crawl_pool.aclose()
+    print(stats.report())
+
+    if csv_filename:
+        print(f"CSV created at: {csv_sink.path}")
+    known_videos.unload()
+    stats_service.mark_dirty()
+    random_index.request_sync()
 
 
 # Example specific methods to process users
 async def process():
     users = await get_user_not_fetch()
-    await process_users(users, csv_filename="all_tiktok_videos.csv")
+    await process_users(users)
 
 
 async def process_10():
-    await process_users(await get_user_fetched(), playlist_limit=10, csv_filename="10_tiktok_videos.csv")
+    await process_users(await get_user_fetched(), playlist_limit=10)
 
 
 # asyncio.run(process())
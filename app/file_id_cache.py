@@ -0,0 +1,124 @@
+# app/file_id_cache.py
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+FILE_ID_CACHE_PATH: str = os.getenv("FILE_ID_CACHE_PATH", os.path.join("cache", "file_ids.sqlite3"))
+FILE_ID_CACHE_MAX_ENTRIES: int = int(os.getenv("FILE_ID_CACHE_MAX_ENTRIES", "50000"))
+FILE_ID_CACHE_MAX_AGE: int = int(os.getenv("FILE_ID_CACHE_MAX_AGE_DAYS", "180")) * 24 * 60 * 60
+
+# Run eviction after this many inserts instead of on every write
+EVICT_EVERY: int = 500
+
+
+class FileIdCache:
+    """Persistent map of TikTok video id -> Telegram file_id, so a video is uploaded only once."""
+
+    def __init__(self, path: str, max_entries: int, max_age: int):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self._conn = None
+        self._lock = threading.Lock()
+        self._puts = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            dirname = os.path.dirname(self.path)
+            if dirname:
+                os.makedirs(dirname, exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS file_ids ("
+                "video_id TEXT PRIMARY KEY, "
+                "file_id TEXT NOT NULL, "
+                "created_at REAL NOT NULL, "
+                "last_used REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS file_ids_last_used ON file_ids (last_used)")
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def _get(self, video_id: str):
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute(
+                "SELECT file_id, created_at FROM file_ids WHERE video_id = ?", (video_id,)
+            ).fetchone()
+            if row is None:
+                return None
+
+            file_id, created_at = row
+            if now - created_at > self.max_age:
+                conn.execute("DELETE FROM file_ids WHERE video_id = ?", (video_id,))
+                conn.commit()
+                return None
+
+            conn.execute("UPDATE file_ids SET last_used = ? WHERE video_id = ?", (now, video_id))
+            conn.commit()
+            return file_id
+
+    def _put(self, video_id: str, file_id: str) -> None:
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO file_ids (video_id, file_id, created_at, last_used) VALUES (?, ?, ?, ?)",
+                (video_id, file_id, now, now),
+            )
+            conn.commit()
+
+            self._puts += 1
+            if self._puts % EVICT_EVERY == 0:
+                self._evict(conn, now)
+
+    def _evict(self, conn: sqlite3.Connection, now: float) -> None:
+        # Drop expired entries first, then the least recently used ones above the size cap
+        conn.execute("DELETE FROM file_ids WHERE created_at < ?", (now - self.max_age,))
+        (count,) = conn.execute("SELECT COUNT(*) FROM file_ids").fetchone()
+        if count > self.max_entries:
+            conn.execute(
+                "DELETE FROM file_ids WHERE video_id IN "
+                "(SELECT video_id FROM file_ids ORDER BY last_used LIMIT ?)",
+                (count - self.max_entries,),
+            )
+        conn.commit()
+
+    def _delete(self, video_id: str) -> None:
+        with self._lock:
+            conn = self._connect()
+            conn.execute("DELETE FROM file_ids WHERE video_id = ?", (video_id,))
+            conn.commit()
+
+    async def get(self, video_id: str):
+        try:
+            return await asyncio.to_thread(self._get, video_id)
+        except Exception as e:
+            print(f"Failed to read file_id cache: {e}")
+            return None
+
+    async def put(self, video_id: str, file_id: str) -> None:
+        try:
+            await asyncio.to_thread(self._put, video_id, file_id)
+        except Exception as e:
+            print(f"Failed to write file_id cache: {e}")
+
+    async def delete(self, video_id: str) -> None:
+        try:
+            await asyncio.to_thread(self._delete, video_id)
+        except Exception as e:
+            print(f"Failed to delete from file_id cache: {e}")
+
+
+# Create singleton instance
+file_id_cache = FileIdCache(FILE_ID_CACHE_PATH, FILE_ID_CACHE_MAX_ENTRIES, FILE_ID_CACHE_MAX_AGE)
@@ -0,0 +1,73 @@
+# app/known_videos.py
+import os
+import re
+from array import array
+from bisect import bisect_left
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+KNOWN_VIDEOS_DIR: str = os.getenv("KNOWN_VIDEOS_DIR", os.path.join("cache", "known_videos"))
+
+_UNSAFE_CHARS_RE = re.compile(r"[^A-Za-z0-9_.-]")
+
+
+class KnownVideoIndex:
+    """Video ids we already crawled, per TikTok user.
+
+    Each user's ids are kept as a sorted array of unsigned 64-bit ints (8 bytes per video)
+    and persisted to one small binary file per user.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._ids: dict = {}
+
+    def _path(self, tiktok_user: str) -> str:
+        return os.path.join(self.directory, f"{_UNSAFE_CHARS_RE.sub('_', tiktok_user)}.bin")
+
+    def get(self, tiktok_user: str) -> array:
+        ids = self._ids.get(tiktok_user)
+        if ids is None:
+            ids = array("Q")
+            path = self._path(tiktok_user)
+            if os.path.exists(path):
+                with open(path, "rb") as f:
+                    ids.frombytes(f.read())
+            self._ids[tiktok_user] = ids
+        return ids
+
+    def contains(self, tiktok_user: str, video_id: int) -> bool:
+        ids = self.get(tiktok_user)
+        i = bisect_left(ids, video_id)
+        return i < len(ids) and ids[i] == video_id
+
+    def add(self, tiktok_user: str, video_ids) -> int:
+        """Merge new ids into a user's index and persist it. Returns how many were new."""
+        ids = self.get(tiktok_user)
+        new = {int(video_id) for video_id in video_ids if str(video_id).isdigit()}
+        new.difference_update(ids)
+        if not new:
+            return 0
+
+        merged = array("Q", sorted(new.union(ids)))
+        self._ids[tiktok_user] = merged
+        self._save(tiktok_user, merged)
+        return len(new)
+
+    def _save(self, tiktok_user: str, ids: array) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(tiktok_user)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            ids.tofile(f)
+        os.replace(tmp_path, path)
+
+    def unload(self) -> None:
+        """Drop in-memory arrays, they are reloaded from disk on the next crawl."""
+        self._ids.clear()
+
+
+# Create singleton instance
+known_videos = KnownVideoIndex(KNOWN_VIDEOS_DIR)
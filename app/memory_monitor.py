@@ -1,43 +1,230 @@
 import asyncio
+import ctypes
+import ctypes.util
+import gc
 import os
+import time
+import tracemalloc
 
 import psutil
+from aiogram import BaseMiddleware
+from dotenv import load_dotenv
 
+from app.download_scheduler import download_scheduler
+from app.download_services import pause_crawls, resume_crawls, ytdlp_pool, crawl_pool
+from app.known_videos import known_videos
+from app.metadata_cache import metadata_cache
+from app.metrics import Counter, Gauge, handler_command
+from app.prefetcher import video_prefetcher
 
-async def monitor_memory(interval, alert_threshold_mb=700):
-    """
-    Async function to monitor memory usage of the current process.
-    :param interval: Time (in seconds) between memory usage checks.
-    :param alert_threshold_mb: Alert if memory usage exceeds this threshold (in MB).
-    """
-    process = psutil.Process(os.getpid())
-    print(f"Monitoring memory usage of process PID: {process.pid}")
+load_dotenv()
+
+# Unique memory (USS) of this process plus its yt-dlp workers, which share the container's memory.
+# Shared libraries every interpreter maps (libpython, libssl, ...) are not counted once per process
+MEMORY_ALERT_MB: int = int(os.getenv("MEMORY_ALERT_MB", "400"))
+# Shedding stops again once usage is back below this
+MEMORY_LOW_WATER_MB: int = int(os.getenv("MEMORY_LOW_WATER_MB", str(MEMORY_ALERT_MB * 4 // 5)))
+MEMORY_CHECK_INTERVAL: int = int(os.getenv("MEMORY_CHECK_INTERVAL", "5"))
+# Allocation tracking costs some memory and CPU itself, 1 turns it on while investigating
+MEMORY_TRACEMALLOC: bool = os.getenv("MEMORY_TRACEMALLOC", "0") == "1"
+MEMORY_SNAPSHOT_INTERVAL: int = int(os.getenv("MEMORY_SNAPSHOT_INTERVAL", "600"))
+MEMORY_REPORT_TOP: int = 10
 
-    peak_usage = 0
+handler_allocated = Counter("memory_handler_allocated_bytes_total",
+                            "Python memory still allocated when a handler returned.", ["command"])
 
+
+def _malloc_trim() -> None:
+    """Ask glibc to hand freed heap pages back to the OS, otherwise RSS rarely shrinks."""
     try:
-        while True:
-            mem_info = process.memory_info()
-            ram_usage_mb = mem_info.rss / 1024 / 1024
+        libc = ctypes.CDLL(ctypes.util.find_library("c"))
+        libc.malloc_trim(0)
+    except (OSError, AttributeError, TypeError):
+        pass
+
+
+class MemoryMonitor:
+    """Watches memory and sheds load before the container runs out.
+
+    Above alert_threshold_mb it pauses prefetching and crawls, refuses new downloads and
+    trims caches; everything resumes once usage drops below low_water_mb. With tracemalloc
+    on it also logs the fastest-growing allocation sites and what in-flight handlers
+    allocated.
+    """
+
+    def __init__(self, alert_threshold_mb: int, low_water_mb: int, trace: bool, snapshot_interval: int):
+        self.alert_threshold_mb = alert_threshold_mb
+        self.low_water_mb = low_water_mb
+        self.trace = trace
+        self.snapshot_interval = snapshot_interval
+        self.process = psutil.Process(os.getpid())
+        self.shedding = False
+        self.usage_mb = 0.0
+        self.peak_mb = 0.0
+        self._snapshot = None
+        self._snapshot_at = 0.0
+        # {task: (command, traced bytes at start, started at)}
+        self._handlers: dict = {}
+
+    @staticmethod
+    def _unique_bytes(process: psutil.Process) -> int:
+        # USS needs /proc/<pid>/smaps; fall back to RSS where that can't be read
+        try:
+            return process.memory_full_info().uss
+        except psutil.AccessDenied:
+            return process.memory_info().rss
+
+    def usage(self) -> float:
+        """Unique memory (USS) of this process and its children in MB.
+
+        The workers are separate interpreters; summing RSS would count the shared
+        libraries each of them maps once per process.
+        """
+        total = self._unique_bytes(self.process)
+        for child in self.process.children(recursive=True):
+            try:
+                total += self._unique_bytes(child)
+            except psutil.Error:
+                pass
+        return total / 1024 / 1024
+
+    def _take_snapshot(self):
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<unknown>"),
+        ))
+
+    async def report_growth(self) -> None:
+        """Log the allocation sites that grew most since the previous report."""
+        if not tracemalloc.is_tracing():
+            return
+        snapshot = await asyncio.to_thread(self._take_snapshot)
+        previous, self._snapshot = self._snapshot, snapshot
+        self._snapshot_at = time.monotonic()
+        if previous is None:
+            return
+
+        stats = await asyncio.to_thread(snapshot.compare_to, previous, "lineno")
+        traced, peak = tracemalloc.get_traced_memory()
+        print(f"Top allocation growth (traced {traced / 1024 / 1024:.1f} MB, peak {peak / 1024 / 1024:.1f} MB):")
+        for stat in stats[:MEMORY_REPORT_TOP]:
+            if stat.size_diff <= 0:
+                break
+            print(f"  {stat}")
 
-            if ram_usage_mb > peak_usage:
-                peak_usage = ram_usage_mb
+    def report_handlers(self) -> None:
+        if not self._handlers:
+            return
+        traced = tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else 0
+        now = time.monotonic()
+        print("Handlers in flight:")
+        for command, start, started_at in self._handlers.values():
+            grown = f", +{(traced - start) / 1024 / 1024:.1f} MB since start" if traced else ""
+            print(f"  {command}: {now - started_at:.1f}s{grown}")
 
-            if ram_usage_mb > alert_threshold_mb:
-                print(f"⚠️ HIGH MEMORY ALERT: {ram_usage_mb:.2f} MB (threshold: {alert_threshold_mb} MB)")
+    def start_handler(self, command: str) -> None:
+        traced = tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else 0
+        self._handlers[asyncio.current_task()] = (command, traced, time.monotonic())
 
-            # Print memory usage every interval (5 seconds)
-            print(f"RAM Usage: {ram_usage_mb:.2f} MB (Peak: {peak_usage:.2f} MB)")
+    def end_handler(self) -> None:
+        command, start, _ = self._handlers.pop(asyncio.current_task())
+        if tracemalloc.is_tracing():
+            # Other handlers running meanwhile blur this, totals per command still show who holds memory
+            grown = tracemalloc.get_traced_memory()[0] - start
+            if grown > 0:
+                handler_allocated.inc(command, amount=grown)
 
-            await asyncio.sleep(interval)
-    except asyncio.CancelledError:
-        print("Memory monitoring task has been stopped.")
+    def _shed(self) -> None:
+        print(f"⚠️ HIGH MEMORY ALERT: {self.usage_mb:.2f} MB (threshold: {self.alert_threshold_mb} MB), shedding load")
+        self.shedding = True
+        video_prefetcher.pause()
+        pause_crawls()
+        download_scheduler.accepting = False
+
+        metadata_cache.clear()
+        known_videos.unload()
+        recycled = ytdlp_pool.recycle_idle()
+        if crawl_pool.busy() == 0:
+            # Workers are joined in threads, the loop keeps serving updates meanwhile
+            crawl_pool.close()
+        gc.collect()
+        _malloc_trim()
+        print(f"Trimmed caches, recycled {recycled} idle yt-dlp workers")
+        self.report_handlers()
+
+    def _resume(self) -> None:
+        print(f"Memory back to {self.usage_mb:.2f} MB (low water: {self.low_water_mb} MB), resuming")
+        self.shedding = False
+        video_prefetcher.resume()
+        resume_crawls()
+        download_scheduler.accepting = True
+
+    async def check(self) -> None:
+        # Reading smaps takes a few ms per process, keep it off the loop
+        self.usage_mb = await asyncio.to_thread(self.usage)
+        self.peak_mb = max(self.peak_mb, self.usage_mb)
+
+        if not self.shedding and self.usage_mb > self.alert_threshold_mb:
+            self._shed()
+            await self.report_growth()
+        elif self.shedding and self.usage_mb < self.low_water_mb:
+            self._resume()
+        elif self.trace and time.monotonic() - self._snapshot_at > self.snapshot_interval:
+            await self.report_growth()
+
+    async def run(self, interval: int = MEMORY_CHECK_INTERVAL) -> None:
+        if self.trace and not tracemalloc.is_tracing():
+            tracemalloc.start(1)
+        print(f"Monitoring memory usage of process PID: {self.process.pid} "
+              f"(alert: {self.alert_threshold_mb} MB, low water: {self.low_water_mb} MB)")
+        try:
+            while True:
+                try:
+                    await self.check()
+                except Exception as e:
+                    print(f"Memory monitor error: {e}")
+                await asyncio.sleep(interval)
+        except asyncio.CancelledError:
+            print(f"Memory monitoring task has been stopped (peak: {self.peak_mb:.2f} MB).")
+
+
+class HandlerMemoryMiddleware(BaseMiddleware):
+    """Dispatcher middleware recording which handlers are running for memory attribution."""
+
+    async def __call__(self, handler, event, data):
+        memory_monitor.start_handler(handler_command(event))
+        try:
+            return await handler(event, data)
+        finally:
+            memory_monitor.end_handler()
+
+
+# Create singleton instance
+memory_monitor = MemoryMonitor(MEMORY_ALERT_MB, MEMORY_LOW_WATER_MB, MEMORY_TRACEMALLOC, MEMORY_SNAPSHOT_INTERVAL)
+
+Gauge("memory_usage_bytes", "Unique memory of this process and its yt-dlp workers at the last check.",
+      function=lambda: int(memory_monitor.usage_mb * 1024 * 1024))
+Gauge("memory_shedding", "1 while load is shed because memory is low.", function=lambda: int(memory_monitor.shedding))
+
+
+async def monitor_memory(interval, alert_threshold_mb=MEMORY_ALERT_MB):
+    """
+    Async function to monitor memory usage of the current process.
+    :param interval: Time (in seconds) between memory usage checks.
+    :param alert_threshold_mb: Shed load if memory usage exceeds this threshold (in MB).
+    """
+    memory_monitor.alert_threshold_mb = alert_threshold_mb
+    await memory_monitor.run(interval)
 
 
-def start_memory_monitor(interval):
+def start_memory_monitor(interval=MEMORY_CHECK_INTERVAL):
     """
     Starts the memory monitor task as an asyncio task.
     This allows it to integrate with asyncio properly.
     :param interval: Time (in seconds) between memory usage checks.
     """
-    asyncio.create_task(monitor_memory(interval))
+    # Modules and extractors loaded at startup live forever; keeping them out of the
+    # collector makes the full gc.collect() in _shed take milliseconds, not half a second
+    gc.freeze()
+    return asyncio.create_task(monitor_memory(interval))
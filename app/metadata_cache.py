@@ -0,0 +1,70 @@
+# app/metadata_cache.py
+import os
+import time
+from collections import OrderedDict
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+METADATA_CACHE_TTL: int = int(os.getenv("METADATA_CACHE_TTL", "3600"))
+METADATA_CACHE_SIZE: int = int(os.getenv("METADATA_CACHE_SIZE", "5000"))
+
+# Fields we keep per video, everything else yt-dlp returns is dropped
+METADATA_FIELDS = ("filesize", "duration", "uploader", "formats")
+FORMAT_FIELDS = ("format_id", "ext", "filesize", "width", "height", "vcodec", "acodec")
+
+
+def slim_formats(formats) -> list:
+    """Keep only what format selection and size checks need from yt-dlp's format list."""
+    return [{key: fmt.get(key) for key in FORMAT_FIELDS} for fmt in formats or []]
+
+
+class MetadataCache:
+    """Bounded TTL cache of per-video metadata shared by the downloader and the crawler."""
+
+    def __init__(self, ttl: int, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        # {video_id: (stored_at, {field: value})}, oldest first
+        self._entries: OrderedDict = OrderedDict()
+
+    def get(self, video_id: str):
+        entry = self._entries.get(video_id)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        stored_at, metadata = entry
+        if time.monotonic() - stored_at > self.ttl:
+            del self._entries[video_id]
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(video_id)
+        self.hits += 1
+        return metadata
+
+    def put(self, video_id: str, metadata: dict) -> None:
+        """Merge metadata for a video, ignoring fields that are missing or empty."""
+        if not video_id:
+            return
+
+        fresh = {key: metadata[key] for key in METADATA_FIELDS if metadata.get(key)}
+        entry = self._entries.get(video_id)
+        if entry is not None and time.monotonic() - entry[0] <= self.ttl:
+            fresh = {**entry[1], **fresh}
+
+        self._entries[video_id] = (time.monotonic(), fresh)
+        self._entries.move_to_end(video_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+
+# Create singleton instance
+metadata_cache = MetadataCache(METADATA_CACHE_TTL, METADATA_CACHE_SIZE)
@@ -0,0 +1,187 @@
+# app/metrics.py
+import asyncio
+import os
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+import psutil
+from aiogram import BaseMiddleware
+
+# Seconds; covers cache hits (ms) up to slow downloads and uploads (a minute)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+LOOP_LAG_INTERVAL = 1
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        registry.append(self)
+
+    def _header(self) -> list:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    """Monotonic count per label set. Updates are plain dict writes on the event loop thread."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values: dict = {}
+
+    def inc(self, *labels, amount: float = 1) -> None:
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> list:
+        lines = self._header()
+        for labels, value in self._values.items():
+            lines.append(f"{self.name}{_labels(self.labelnames, labels)} {value}")
+        return lines
+
+
+class Gauge(_Metric):
+    """Current value per label set, either set directly or read from `function` at scrape time."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), function=None):
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+        self._values: dict = {}
+
+    def set(self, value: float, *labels) -> None:
+        self._values[labels] = value
+
+    def render(self) -> list:
+        lines = self._header()
+        values = self._values
+        if self.function is not None:
+            try:
+                value = self.function()
+            except Exception as e:
+                print(f"Failed to read gauge {self.name}: {e}")
+                return lines
+            # A function returns one value, or {label value(s): value} for labelled gauges
+            if isinstance(value, dict):
+                values = {labels if isinstance(labels, tuple) else (labels,): v for labels, v in value.items()}
+            else:
+                values = {(): value}
+        for labels, value in values.items():
+            lines.append(f"{self.name}{_labels(self.labelnames, labels)} {value}")
+        return lines
+
+
+class Histogram(_Metric):
+    """Bucketed observations per label set.
+
+    Each label set keeps a flat list of per-bucket counts (the last slot is +Inf), its sum
+    and count, so observe() is a bisect and three increments.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+        # {labels: [bucket counts..., sum, count]}
+        self._values: dict = {}
+
+    def observe(self, value: float, *labels) -> None:
+        series = self._values.get(labels)
+        if series is None:
+            series = self._values[labels] = [0] * (len(self.buckets) + 3)
+        series[bisect_left(self.buckets, value)] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    @contextmanager
+    def time(self, *labels, errors: Counter = None):
+        """Observe the duration of the with-block; count it in `errors` too if it raises."""
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            if errors is not None:
+                errors.inc(*labels)
+            raise
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def render(self) -> list:
+        lines = self._header()
+        for labels, series in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                bucket_labels = _labels(self.labelnames, labels, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            bucket_labels = _labels(self.labelnames, labels, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{bucket_labels} {series[-1]}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {series[-2]}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {series[-1]}")
+        return lines
+
+
+registry: list = []
+
+
+def render() -> str:
+    """All metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+_process = psutil.Process(os.getpid())
+
+process_rss = Gauge("process_resident_memory_bytes", "Resident memory size in bytes.",
+                    function=lambda: _process.memory_info().rss)
+loop_lag = Histogram("event_loop_lag_seconds", "How late a periodic timer fired on the event loop.",
+                     buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5))
+handler_latency = Histogram("bot_handler_seconds", "Time spent in message handlers.", ["command"])
+handler_errors = Counter("bot_handler_errors_total", "Message handlers that raised.", ["command"])
+db_latency = Histogram("db_request_seconds", "Supabase (PostgREST) request latency.", ["name"])
+db_errors = Counter("db_request_errors_total", "Failed Supabase (PostgREST) requests.", ["name"])
+
+
+def handler_command(event) -> str:
+    """Label for a handled message: its command ("/r@SomeBot args" -> "/r") or "message"."""
+    text = getattr(event, "text", None) or ""
+    return text.split(maxsplit=1)[0].split("@", 1)[0] if text.startswith("/") else "message"
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Dispatcher middleware timing every handled message by its command."""
+
+    async def __call__(self, handler, event, data):
+        with handler_latency.time(handler_command(event), errors=handler_errors):
+            return await handler(event, data)
+
+
+async def run_loop_lag_monitor(interval: float = LOOP_LAG_INTERVAL) -> None:
+    """Sleep `interval` over and over; oversleeping means something blocked the event loop."""
+    try:
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(interval)
+            loop_lag.observe(max(0.0, time.perf_counter() - started - interval))
+    except asyncio.CancelledError:
+        pass
@@ -0,0 +1,200 @@
+# app/prefetcher.py
+import asyncio
+import os
+from collections import Counter, deque
+
+from dotenv import load_dotenv
+
+from app.download_scheduler import PRIORITY_PREFETCH
+from app.download_services import get_video_async, video_cache
+from app.file_id_cache import file_id_cache
+from app.metrics import Gauge
+from app.random_index import pick_random_video
+from app.utils import extract_tiktok_video_id
+
+load_dotenv()
+
+PREFETCH_POOL_SIZE: int = int(os.getenv("PREFETCH_POOL_SIZE", "5"))
+PREFETCH_USER_POOL_SIZE: int = int(os.getenv("PREFETCH_USER_POOL_SIZE", "2"))
+PREFETCH_MAX_USERS: int = int(os.getenv("PREFETCH_MAX_USERS", "3"))
+PREFETCH_MAX_BYTES: int = int(os.getenv("PREFETCH_MAX_MB", "150")) * 1024 * 1024
+
+IDLE_WAIT: int = 30  # Re-check pools at least this often when nothing wakes us up
+RETRY_DELAY: int = 5  # Back off after a failed fetch
+DEMAND_DECAY_EVERY: int = 100  # Halve /ru demand counters after this many requests
+
+
+class PrefetchedVideo:
+    __slots__ = ("video_url", "from_index", "video_path", "size")
+
+    def __init__(self, video_url: str, from_index: bool, video_path: str | None = None, size: int = 0):
+        self.video_url = video_url
+        # Picked from random_index, so its view is counted by us when sent
+        self.from_index = from_index
+        # None when Telegram already has the video and it can be sent by file_id
+        self.video_path = video_path
+        self.size = size
+
+
+class VideoPrefetcher:
+    """Keeps small pools of ready-to-send videos for /r and the most requested /ru creators."""
+
+    def __init__(self, pool_size: int, user_pool_size: int, max_users: int, max_bytes: int):
+        self.pool_size = pool_size
+        self.user_pool_size = user_pool_size
+        self.max_users = max_users
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._random: deque = deque()
+        self._users: dict = {}
+        self._demand: Counter = Counter()
+        self._requests = 0
+        self._wakeup = asyncio.Event()
+        self.paused = False
+
+    def take(self, user: str | None = None) -> PrefetchedVideo | None:
+        """Pop a ready video for /r (user=None) or /ru, or None when the pool is empty."""
+        if user:
+            self._record_demand(user)
+            pool = self._users.get(user)
+        else:
+            pool = self._random
+
+        # Whatever happens, the pool needs a refill
+        self._wakeup.set()
+
+        if not pool:
+            self.misses += 1
+            return None
+
+        item = pool.popleft()
+        self.total_bytes -= item.size
+        self.hits += 1
+        return item
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "random_pool": len(self._random),
+            "user_pools": {user: len(pool) for user, pool in self._users.items()},
+            "bytes": self.total_bytes,
+        }
+
+    def pause(self) -> None:
+        """Stop refilling pools; the videos already pooled can still be taken."""
+        self.paused = True
+
+    def resume(self) -> None:
+        self.paused = False
+        self._wakeup.set()
+
+    def _record_demand(self, user: str) -> None:
+        self._demand[user] += 1
+        self._requests += 1
+        if self._requests % DEMAND_DECAY_EVERY == 0:
+            # Let creators that stopped being requested fall out of the top list
+            for key in list(self._demand):
+                self._demand[key] //= 2
+                if not self._demand[key]:
+                    del self._demand[key]
+
+    def _popular_users(self) -> list:
+        # A creator has to be asked for more than once to earn a pool
+        return [user for user, count in self._demand.most_common(self.max_users) if count > 1]
+
+    def _drop_unpopular(self, popular: list) -> None:
+        for user in list(self._users):
+            if user in popular:
+                continue
+            for item in self._users.pop(user):
+                self._discard(item)
+
+    def _clear(self) -> None:
+        for item in self._random:
+            self._discard(item)
+        self._random.clear()
+        self._drop_unpopular([])
+
+    def _discard(self, item: PrefetchedVideo) -> None:
+        self.total_bytes -= item.size
+        if item.video_path:
+            video_cache.release(item.video_path)
+
+    def _next_target(self):
+        """Return the pool that needs a video next: (deque, user or None), or None if all are full."""
+        if self.paused or self.total_bytes >= self.max_bytes:
+            return None
+        if len(self._random) < self.pool_size:
+            return self._random, None
+
+        popular = self._popular_users()
+        self._drop_unpopular(popular)
+        for user in popular:
+            pool = self._users.setdefault(user, deque())
+            if len(pool) < self.user_pool_size:
+                return pool, user
+        return None
+
+    async def _fetch(self, user: str | None) -> PrefetchedVideo | None:
+        video_url, from_index = await pick_random_video(user)
+        if not video_url:
+            return None
+
+        video_id = extract_tiktok_video_id(video_url)
+        if video_id and await file_id_cache.get(video_id):
+            # Already on Telegram's side, nothing to download
+            return PrefetchedVideo(video_url, from_index)
+
+        video_path = await get_video_async(video_url, priority=PRIORITY_PREFETCH)
+        if not video_path:
+            return None
+        return PrefetchedVideo(video_url, from_index, video_path, os.path.getsize(video_path))
+
+    async def run(self) -> None:
+        print(f"Prefetcher started: pool={self.pool_size}, user pools={self.max_users}x{self.user_pool_size}")
+        try:
+            while True:
+                target = self._next_target()
+                if target is None:
+                    self._wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), timeout=IDLE_WAIT)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+
+                pool, user = target
+                try:
+                    item = await self._fetch(user)
+                except Exception as e:
+                    print(f"Prefetch error: {e}")
+                    item = None
+
+                if item is None:
+                    await asyncio.sleep(RETRY_DELAY)
+                    continue
+
+                # The creator may have dropped out of the top list while we were downloading
+                stale = user is not None and self._users.get(user) is not pool
+                if stale or any(pooled.video_url == item.video_url for pooled in pool):
+                    if item.video_path:
+                        video_cache.release(item.video_path)
+                    continue
+
+                pool.append(item)
+                self.total_bytes += item.size
+        except asyncio.CancelledError:
+            # Leadership moved to another process, which refills its own pools
+            self._clear()
+            print("Prefetcher task has been stopped.")
+
+
+# Create singleton instance
+video_prefetcher = VideoPrefetcher(PREFETCH_POOL_SIZE, PREFETCH_USER_POOL_SIZE, PREFETCH_MAX_USERS,
+                                   PREFETCH_MAX_BYTES)
+
+Gauge("prefetch_pool_videos", "Prefetched videos ready to send.",
+      function=lambda: len(video_prefetcher._random) + sum(map(len, video_prefetcher._users.values())))
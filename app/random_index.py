@@ -0,0 +1,295 @@
+# app/random_index.py
+import asyncio
+import os
+import random
+import time
+from array import array
+
+from dotenv import load_dotenv
+
+from app.db_services import get_random_video, get_random_user_video, get_videos_updated_since, \
+    increment_video_frequency
+from app.metrics import Gauge
+from app.stats_service import stats_service
+from app.utils import extract_tiktok_video_id
+
+load_dotenv()
+
+RANDOM_INDEX_ENABLED: bool = os.getenv("RANDOM_INDEX_ENABLED", "1") == "1"
+RANDOM_INDEX_SYNC_INTERVAL: int = int(os.getenv("RANDOM_INDEX_SYNC_INTERVAL", "300"))
+# Deleted rows leave no trace to sync from, so the index is rebuilt from scratch this often
+RANDOM_INDEX_FULL_SYNC_INTERVAL: int = int(os.getenv("RANDOM_INDEX_FULL_SYNC_INTERVAL", str(24 * 60 * 60)))
+RANDOM_INDEX_PAGE_SIZE: int = int(os.getenv("RANDOM_INDEX_PAGE_SIZE", "1000"))
+# "uniform" over all videos, or "frequency": creators weighted by how often their videos were watched
+RANDOM_INDEX_WEIGHTING: str = os.getenv("RANDOM_INDEX_WEIGHTING", "uniform")
+# Views not yet added to the frequency column are dropped beyond this
+MAX_PENDING_VIEWS = 10000
+
+
+def video_link(tiktok_user: str, video_id: int) -> str:
+    return f"https://www.tiktok.com/@{tiktok_user}/video/{video_id}"
+
+
+class _IndexData:
+    """Active videos grouped per creator.
+
+    Ids are unsigned 64-bit ints: 8 bytes per video in its creator's array plus 12 in the
+    global arrays (id and creator number). Links are rebuilt from the creator and id, only
+    links that differ from that form (e.g. photo posts) are stored.
+    """
+
+    def __init__(self):
+        self.users: list = []
+        self.user_numbers: dict = {}
+        self.by_user: dict = {}
+        self.ids = array("Q")
+        self.owners = array("I")
+        self.links: dict = {}
+        # Bumped whenever a creator gains their first or loses their last video
+        self.users_version = 0
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def add(self, tiktok_user: str, video_id: int, link: str, check: bool = True) -> bool:
+        ids = self.by_user.get(tiktok_user)
+        if ids is None:
+            ids = self.by_user[tiktok_user] = array("Q")
+            self.users_version += 1
+            if tiktok_user not in self.user_numbers:
+                self.user_numbers[tiktok_user] = len(self.users)
+                self.users.append(tiktok_user)
+        elif check and video_id in ids:
+            return False
+
+        ids.append(video_id)
+        self.ids.append(video_id)
+        self.owners.append(self.user_numbers[tiktok_user])
+        if link and link != video_link(tiktok_user, video_id):
+            self.links[video_id] = link
+        return True
+
+    def remove(self, video_id: int) -> bool:
+        # Linear scans of the arrays run in C; removals are rare compared to picks
+        try:
+            i = self.ids.index(video_id)
+        except ValueError:
+            return False
+        tiktok_user = self.users[self.owners[i]]
+
+        _swap_remove(self.ids, i)
+        _swap_remove(self.owners, i)
+        ids = self.by_user[tiktok_user]
+        _swap_remove(ids, ids.index(video_id))
+        if not ids:
+            del self.by_user[tiktok_user]
+            self.users_version += 1
+        self.links.pop(video_id, None)
+        return True
+
+    def link(self, tiktok_user: str, video_id: int) -> str:
+        return self.links.get(video_id) or video_link(tiktok_user, video_id)
+
+
+def _swap_remove(values: array, i: int) -> None:
+    """Remove values[i] in O(1) by moving the last value into its place."""
+    last = values.pop()
+    if i < len(values):
+        values[i] = last
+
+
+class _AliasTable:
+    """Walker's alias method: O(n) to build, O(1) per weighted sample."""
+
+    def __init__(self, weights: list):
+        n = len(weights)
+        total = sum(weights)
+        self.prob = array("d", [0.0] * n)
+        self.alias = array("I", [0] * n)
+        scaled = [weight * n / total for weight in weights]
+        small = [i for i, p in enumerate(scaled) if p < 1]
+        large = [i for i, p in enumerate(scaled) if p >= 1]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            self.prob[s] = scaled[s]
+            self.alias[s] = l
+            scaled[l] -= 1 - scaled[s]
+            (small if scaled[l] < 1 else large).append(l)
+        for i in small + large:
+            self.prob[i] = 1.0
+
+    def sample(self) -> int:
+        i = random.randrange(len(self.prob))
+        return i if random.random() < self.prob[i] else self.alias[i]
+
+
+class RandomIndex:
+    """In-process index of active videos for /r and /ru.
+
+    Loaded once from the video table and kept current by syncing rows changed since an
+    (updated_at, video_id) watermark. Videos deleted or deactivated through the bot are
+    removed locally right away. Until the first load succeeds callers fall back to the
+    random-video RPCs.
+    """
+
+    def __init__(self, page_size: int, sync_interval: int, full_sync_interval: int, weighting: str):
+        self.page_size = page_size
+        self.sync_interval = sync_interval
+        self.full_sync_interval = full_sync_interval
+        self.weighting = weighting
+        self.ready = False
+        self._data = _IndexData()
+        self._watermark = (None, None)
+        self._last_full_sync = 0.0
+        # Ids of index-picked videos that were sent, the RPCs used to count these views server-side
+        self._views: list = []
+        self._alias = None
+        self._alias_key = None
+        self._lock = asyncio.Lock()
+        self._sync_requested = asyncio.Event()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def _apply(self, data: _IndexData, row: dict, seen: set | None) -> None:
+        video_id = str(row.get("video_id") or "")
+        if not video_id.isdigit():
+            return
+        video_id = int(video_id)
+        if row.get("active") in (0, False):
+            # A fresh index never held it, don't pay for the array scan
+            if seen is None:
+                data.remove(video_id)
+        elif seen is None:
+            data.add(row["tiktok_user"], video_id, row.get("link"))
+        elif video_id not in seen:
+            # A full load only sees a row twice if it changed mid-load, skip the array scan
+            seen.add(video_id)
+            data.add(row["tiktok_user"], video_id, row.get("link"), check=False)
+
+    async def _load(self, data: _IndexData, watermark: tuple, seen: set | None = None):
+        """Apply every row changed after `watermark`. Returns the new watermark, None on failure."""
+        while True:
+            rows = await get_videos_updated_since(*watermark, self.page_size)
+            if rows is None:
+                return None
+            for row in rows:
+                self._apply(data, row, seen)
+            if rows:
+                watermark = (rows[-1]["updated_at"], rows[-1]["video_id"])
+            if len(rows) < self.page_size:
+                return watermark
+
+    async def sync(self, full: bool = False) -> None:
+        async with self._lock:
+            if full or not self.ready:
+                # Build the new index on the side so picks keep working meanwhile
+                data = _IndexData()
+                watermark = await self._load(data, (None, None), seen=set())
+                if watermark is None:
+                    return
+                self._data = data
+                self._last_full_sync = time.monotonic()
+                if not self.ready:
+                    self.ready = True
+                    print(f"Random index loaded: {len(data)} videos from {len(data.by_user)} users")
+            else:
+                watermark = await self._load(self._data, self._watermark)
+                if watermark is None:
+                    return
+            self._watermark = watermark
+
+    async def flush_views(self) -> None:
+        if not self._views:
+            return
+        views, self._views = self._views, []
+        if not await increment_video_frequency(views):
+            self._views = (views + self._views)[-MAX_PENDING_VIEWS:]
+
+    def request_sync(self) -> None:
+        """Sync soon instead of waiting for the interval, e.g. after a crawl."""
+        self._sync_requested.set()
+
+    def _weighted_user(self, data: _IndexData) -> str:
+        key = (id(data), data.users_version, stats_service.generation)
+        if self._alias_key != key:
+            frequency = stats_service.frequency_by_user() or {}
+            users = list(data.by_user)
+            # +1 so creators nobody watched yet still come up
+            self._alias = (users, _AliasTable([frequency.get(user, 0) + 1 for user in users]))
+            self._alias_key = key
+        users, table = self._alias
+        return users[table.sample()]
+
+    def pick(self, tiktok_user: str | None = None) -> str | None:
+        """Link of a random active video (of `tiktok_user`), None if the index can't answer."""
+        data = self._data
+        if not self.ready or not data.ids:
+            return None
+
+        if tiktok_user is None and self.weighting == "frequency":
+            tiktok_user = self._weighted_user(data)
+
+        if tiktok_user is None:
+            i = random.randrange(len(data.ids))
+            video_id = data.ids[i]
+            tiktok_user = data.users[data.owners[i]]
+        else:
+            ids = data.by_user.get(tiktok_user)
+            if not ids:
+                return None
+            video_id = ids[random.randrange(len(ids))]
+        return data.link(tiktok_user, video_id)
+
+    def record_view(self, link: str) -> None:
+        """Count a view of a video picked from the index once it was actually sent.
+
+        Prefetched picks may never be sent, and links from the RPC fallback were already
+        counted server-side, so callers only pass index picks.
+        """
+        video_id = extract_tiktok_video_id(link)
+        if not video_id or len(self._views) >= MAX_PENDING_VIEWS:
+            return
+        self._views.append(video_id)
+
+    def remove_link(self, link: str) -> bool:
+        """Drop a deleted or deactivated video right away."""
+        video_id = extract_tiktok_video_id(link)
+        if not video_id:
+            return False
+        return self._data.remove(int(video_id))
+
+    async def run(self) -> None:
+        if not RANDOM_INDEX_ENABLED:
+            return
+        try:
+            while True:
+                try:
+                    full = time.monotonic() - self._last_full_sync > self.full_sync_interval
+                    await self.sync(full=full)
+                    await self.flush_views()
+                except Exception as e:
+                    print(f"Random index sync error: {e}")
+                try:
+                    await asyncio.wait_for(self._sync_requested.wait(), timeout=self.sync_interval)
+                except asyncio.TimeoutError:
+                    pass
+                self._sync_requested.clear()
+        except asyncio.CancelledError:
+            print("Random index task has been stopped.")
+
+
+# Create singleton instance
+random_index = RandomIndex(RANDOM_INDEX_PAGE_SIZE, RANDOM_INDEX_SYNC_INTERVAL, RANDOM_INDEX_FULL_SYNC_INTERVAL,
+                           RANDOM_INDEX_WEIGHTING)
+
+Gauge("random_index_videos", "Active videos in the local random index.", function=lambda: len(random_index))
+
+
+async def pick_random_video(tiktok_user: str | None = None) -> tuple:
+    """(random video link or None, whether it came from the local index rather than the RPCs)."""
+    link = random_index.pick(tiktok_user)
+    if link:
+        return link, True
+    link = await get_random_user_video(tiktok_user) if tiktok_user else await get_random_video()
+    return link, False
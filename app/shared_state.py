@@ -0,0 +1,222 @@
+# app/shared_state.py
+import asyncio
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+SHARED_STATE_DB: str = os.getenv("SHARED_STATE_DB", os.path.join("cache", "shared_state.sqlite3"))
+LEADER_LEASE_TTL: float = float(os.getenv("LEADER_LEASE_TTL", "30"))
+
+SHARED_EVENTS_POLL_INTERVAL: float = float(os.getenv("SHARED_EVENTS_POLL_INTERVAL", "1"))
+SHARED_EVENTS_TTL: float = 60 * 60  # Events older than this are pruned
+
+# Lease owner name of this process
+PROCESS_OWNER: str = f"{socket.gethostname()}:{os.getpid()}"
+
+
+class SharedState:
+    """Small cross-process store in a local SQLite file (WAL mode) for every bot process on the host.
+
+    Holds one-shot claims (update and job de-duplication), named leases (leader election)
+    and a short log of events every process should apply (see SharedEvents).
+    """
+
+    PRUNE_EVERY = 1000
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._claims = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            dirname = os.path.dirname(self.path)
+            if dirname:
+                os.makedirs(dirname, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS claims (key TEXT PRIMARY KEY, expires REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS claims_expires ON claims (expires)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS events (id INTEGER PRIMARY KEY AUTOINCREMENT, topic TEXT NOT NULL, "
+                "payload TEXT NOT NULL, origin TEXT NOT NULL, created REAL NOT NULL)"
+            )
+            self._local.conn = conn
+        return conn
+
+    def claim(self, key: str, ttl: float) -> bool:
+        """Return True for the first process to claim `key` within `ttl` seconds, False for everyone else."""
+        conn = self._connect()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._claims += 1
+            if self._claims % self.PRUNE_EVERY == 0:
+                conn.execute("DELETE FROM claims WHERE expires <= ?", (now,))
+            conn.execute("DELETE FROM claims WHERE key = ? AND expires <= ?", (key, now))
+            claimed = conn.execute(
+                "INSERT OR IGNORE INTO claims (key, expires) VALUES (?, ?)", (key, now + ttl)
+            ).rowcount == 1
+            conn.execute("COMMIT")
+            return claimed
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def acquire_lease(self, name: str, owner: str, ttl: float) -> bool:
+        """Take or renew lease `name` for `owner`. Fails while another owner holds an unexpired lease."""
+        conn = self._connect()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT owner, expires FROM leases WHERE name = ?", (name,)).fetchone()
+            acquired = row is None or row[0] == owner or row[1] <= now
+            if acquired:
+                conn.execute(
+                    "INSERT OR REPLACE INTO leases (name, owner, expires) VALUES (?, ?, ?)", (name, owner, now + ttl)
+                )
+            conn.execute("COMMIT")
+            return acquired
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def release_lease(self, name: str, owner: str) -> None:
+        self._connect().execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, owner))
+
+    def append_event(self, topic: str, payload: str, origin: str) -> None:
+        conn = self._connect()
+        now = time.time()
+        conn.execute("DELETE FROM events WHERE created <= ?", (now - SHARED_EVENTS_TTL,))
+        conn.execute("INSERT INTO events (topic, payload, origin, created) VALUES (?, ?, ?, ?)",
+                     (topic, payload, origin, now))
+
+    def last_event_id(self) -> int:
+        return self._connect().execute("SELECT COALESCE(MAX(id), 0) FROM events").fetchone()[0]
+
+    def events_after(self, last_id: int) -> list:
+        """[(id, topic, payload, origin)] appended after event `last_id`, oldest first."""
+        return self._connect().execute(
+            "SELECT id, topic, payload, origin FROM events WHERE id > ? ORDER BY id", (last_id,)
+        ).fetchall()
+
+
+class SharedEvents:
+    """Applies events published by one process in every process on the host.
+
+    publish() runs the local handlers right away and appends the event to the shared
+    log; run() polls the log and runs the handlers for events other processes published.
+    """
+
+    def __init__(self, state: SharedState, poll_interval: float = SHARED_EVENTS_POLL_INTERVAL):
+        self.state = state
+        self.poll_interval = poll_interval
+        self._handlers: dict = {}
+        self._last_id = None
+
+    def subscribe(self, topic: str, handler) -> None:
+        """handler(payload) is called for every `topic` event, in this process and the others."""
+        self._handlers.setdefault(topic, []).append(handler)
+
+    def _dispatch(self, topic: str, payload: str) -> None:
+        for handler in self._handlers.get(topic, ()):
+            try:
+                handler(payload)
+            except Exception as e:
+                print(f"Shared event handler for {topic} failed: {e}")
+
+    async def publish(self, topic: str, payload: str = "") -> None:
+        self._dispatch(topic, payload)
+        try:
+            await asyncio.to_thread(self.state.append_event, topic, payload, PROCESS_OWNER)
+        except Exception as e:
+            print(f"Failed to publish shared event {topic}: {e}")
+
+    async def run(self) -> None:
+        try:
+            while True:
+                try:
+                    if self._last_id is None:
+                        # Only what happens from now on, earlier events are in the data we load
+                        self._last_id = await asyncio.to_thread(self.state.last_event_id)
+                    for event_id, topic, payload, origin in await asyncio.to_thread(
+                            self.state.events_after, self._last_id):
+                        self._last_id = event_id
+                        if origin != PROCESS_OWNER:
+                            self._dispatch(topic, payload)
+                except Exception as e:
+                    print(f"Shared events error: {e}")
+                await asyncio.sleep(self.poll_interval)
+        except asyncio.CancelledError:
+            print("Shared events task has been stopped.")
+
+
+class LeaderElection:
+    """Runs a set of jobs in exactly one process at a time.
+
+    Every process competes for the same lease; the holder renews it every ttl/3 seconds and
+    runs the jobs. If it stops renewing (crash, hang) another process takes over once the
+    lease expires.
+    """
+
+    def __init__(self, state: SharedState, name: str = "leader", ttl: float = LEADER_LEASE_TTL):
+        self.state = state
+        self.name = name
+        self.ttl = ttl
+        self.owner = PROCESS_OWNER
+        self.is_leader = False
+        self._tasks: list = []
+
+    def _start(self, jobs) -> None:
+        print(f"{self.owner} is now the leader")
+        self.is_leader = True
+        self._tasks = [asyncio.create_task(job()) for job in jobs]
+
+    def _stop(self) -> None:
+        if self.is_leader:
+            print(f"{self.owner} lost leadership")
+        self.is_leader = False
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    def resign(self) -> None:
+        """Stop the jobs and hand the lease over right away, e.g. on shutdown."""
+        was_leader = self.is_leader
+        self._stop()
+        if was_leader:
+            self.state.release_lease(self.name, self.owner)
+
+    async def run(self, jobs) -> None:
+        """Keep competing for leadership; `jobs` are coroutine functions started on election."""
+        try:
+            while True:
+                try:
+                    elected = await asyncio.to_thread(self.state.acquire_lease, self.name, self.owner, self.ttl)
+                except Exception as e:
+                    print(f"Leader election error: {e}")
+                    elected = False
+                if elected and not self.is_leader:
+                    self._start(jobs)
+                elif not elected and self.is_leader:
+                    self._stop()
+                await asyncio.sleep(self.ttl / 3)
+        except asyncio.CancelledError:
+            self.resign()
+
+
+# Create singleton instance
+shared_state = SharedState(SHARED_STATE_DB)
+leader_election = LeaderElection(shared_state)
+shared_events = SharedEvents(shared_state)
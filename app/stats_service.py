@@ -0,0 +1,152 @@
+# app/stats_service.py
+import asyncio
+import os
+
+from dotenv import load_dotenv
+
+from app.db_services import get_tiktok_user_video_counts, get_tiktok_user_frequency_summary
+
+load_dotenv()
+
+STATS_REFRESH_INTERVAL: int = int(os.getenv("STATS_REFRESH_INTERVAL", "900"))
+# Telegram rejects messages longer than this, counted in UTF-16 code units
+MESSAGE_LIMIT = 4096
+
+
+def _utf16_len(text: str) -> int:
+    # Emoji outside the BMP count twice
+    return len(text.encode("utf-16-le")) // 2
+
+
+def chunk_lines(lines, limit: int = MESSAGE_LIMIT) -> list:
+    """Join lines with newlines into as few messages under `limit` characters as possible."""
+    chunks = []
+    current = []
+    size = 0
+    for line in lines:
+        length = _utf16_len(line)
+        if length > limit:
+            line = line[:limit // 2]
+            length = _utf16_len(line)
+        # +1 for the newline joining it to the previous line
+        if current and size + 1 + length > limit:
+            chunks.append("\n".join(current))
+            current, size = [], 0
+        size += length + (1 if current else 0)
+        current.append(line)
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+
+class StatsService:
+    """In-memory /total and /frequency aggregates with their rendered replies.
+
+    Aggregates are loaded from the RPCs once, refreshed in the background every
+    `refresh_interval` seconds or soon after mark_dirty(), and adjusted locally in
+    between for deletes and views. Replies are rendered once per change.
+    """
+
+    def __init__(self, refresh_interval: int):
+        self.refresh_interval = refresh_interval
+        # {tiktok_user: value} in the order the RPCs returned them
+        self._counts = None
+        self._frequency = None
+        # {"total" | "frequency": [message chunks]}
+        self._rendered: dict = {}
+        self._generation = 0
+        self._lock = asyncio.Lock()
+        self._dirty = asyncio.Event()
+
+    async def refresh(self) -> None:
+        """Reload both aggregates. Callers arriving during a refresh wait for it instead of starting another."""
+        generation = self._generation
+        async with self._lock:
+            if self._generation != generation:
+                return
+
+            counts, frequency = await asyncio.gather(
+                get_tiktok_user_video_counts(), get_tiktok_user_frequency_summary()
+            )
+            # Keep serving the previous numbers if an RPC failed
+            if counts is not None:
+                self._counts = {item["tiktok_user"]: item["number_of_videos"] for item in counts}
+            if frequency is not None:
+                self._frequency = {item["tiktok_user"]: item["total_of_frequency"] for item in frequency}
+            self._rendered.clear()
+            self._generation += 1
+
+    @property
+    def generation(self) -> int:
+        """Changes whenever the aggregates are reloaded."""
+        return self._generation
+
+    def frequency_by_user(self):
+        """{tiktok_user: total views} as of the last refresh, None before the first one."""
+        return self._frequency
+
+    def mark_dirty(self) -> None:
+        """Ask the background task to refresh soon, e.g. after a crawl added videos."""
+        self._dirty.set()
+
+    def record_removed(self, tiktok_user: str) -> None:
+        """A video of `tiktok_user` was deleted or deactivated."""
+        if self._counts and self._counts.get(tiktok_user):
+            self._counts[tiktok_user] -= 1
+            self._rendered.pop("total", None)
+
+    def record_view(self, tiktok_user: str) -> None:
+        """A random video of `tiktok_user` was sent."""
+        if self._frequency is not None and tiktok_user in self._frequency:
+            self._frequency[tiktok_user] += 1
+            self._rendered.pop("frequency", None)
+
+    async def total_chunks(self) -> list:
+        if self._counts is None:
+            await self.refresh()
+        chunks = self._rendered.get("total")
+        if chunks is None:
+            chunks = self._rendered["total"] = self._render_total()
+        return chunks
+
+    async def frequency_chunks(self) -> list:
+        if self._frequency is None:
+            await self.refresh()
+        chunks = self._rendered.get("frequency")
+        if chunks is None:
+            chunks = self._rendered["frequency"] = self._render_frequency()
+        return chunks
+
+    def _render_total(self) -> list:
+        if not self._counts:
+            return []
+        lines = ["Danh sách các bé:\n"]
+        lines.extend(f"💃 {user}: {count} videos" for user, count in self._counts.items())
+        lines.append(f"\n📊 Tổng số videos: {sum(self._counts.values())}")
+        return chunk_lines(lines)
+
+    def _render_frequency(self) -> list:
+        if not self._frequency:
+            return []
+        lines = ["Danh sách các bé được ae yêu quý:\n"]
+        lines.extend(f"💃 {user}: {frequency} lượt sục" for user, frequency in self._frequency.items())
+        return chunk_lines(lines)
+
+    async def run(self) -> None:
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(self._dirty.wait(), timeout=self.refresh_interval)
+                except asyncio.TimeoutError:
+                    pass
+                self._dirty.clear()
+                try:
+                    await self.refresh()
+                except Exception as e:
+                    print(f"Stats refresh error: {e}")
+        except asyncio.CancelledError:
+            print("Stats task has been stopped.")
+
+
+# Create singleton instance
+stats_service = StatsService(STATS_REFRESH_INTERVAL)
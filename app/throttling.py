@@ -0,0 +1,198 @@
+# app/throttling.py
+import asyncio
+import os
+import time
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import SendChatAction
+from dotenv import load_dotenv
+
+from app.metrics import Gauge, Histogram
+
+load_dotenv()
+
+# Telegram's documented limits: ~30 messages/s overall, 1/s per chat, 20/min per group
+TELEGRAM_GLOBAL_RATE: float = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))
+TELEGRAM_CHAT_RATE: float = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))
+TELEGRAM_GROUP_PER_MINUTE: float = float(os.getenv("TELEGRAM_GROUP_PER_MINUTE", "20"))
+TELEGRAM_MAX_RETRIES: int = int(os.getenv("TELEGRAM_MAX_RETRIES", "3"))
+# A chat action is shown for 5 seconds, repeating it sooner does nothing
+CHAT_ACTION_TTL: float = float(os.getenv("CHAT_ACTION_TTL", "4.5"))
+
+# API methods that post to a chat and count against the flood limits
+THROTTLED_PREFIXES = ("send", "copy", "forward", "edit")
+
+telegram_request_seconds = Histogram("telegram_request_seconds", "Telegram API call duration, uploads included.",
+                                     ["method"])
+telegram_wait_seconds = Histogram("telegram_throttle_wait_seconds", "Time requests waited for a rate limit token.")
+
+
+class AsyncTokenBucket:
+    """Paces callers to `rate` acquisitions per second, allowing bursts of `capacity`.
+
+    Each acquire() reserves the next free slot up front (GCRA), so waiters are served in
+    arrival order without polling.
+    """
+    __slots__ = ("rate", "capacity", "waiting", "_interval", "_tolerance", "_tat")
+
+    def __init__(self, rate: float, capacity: float = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self.waiting = 0
+        self._interval = 1 / rate
+        self._tolerance = (capacity - 1) * self._interval
+        # Theoretical arrival time of the next request
+        self._tat = 0.0
+
+    def reserve(self) -> float:
+        """Take the next slot and return how long to wait before using it."""
+        now = time.monotonic()
+        tat = max(self._tat, now)
+        self._tat = tat + self._interval
+        return max(0.0, tat - self._tolerance - now)
+
+    async def acquire(self) -> None:
+        delay = self.reserve()
+        if delay > 0:
+            self.waiting += 1
+            try:
+                await asyncio.sleep(delay)
+            finally:
+                self.waiting -= 1
+
+    def pause(self, seconds: float) -> None:
+        """Push every future slot back, e.g. after Telegram answered with RetryAfter."""
+        self._tat = max(self._tat, time.monotonic() + seconds + self._tolerance)
+
+
+class ThrottleMiddleware(BaseRequestMiddleware):
+    """Bot session middleware that keeps every outgoing request inside Telegram's limits.
+
+    Requests that post to a chat wait for a token from the global bucket and from the
+    chat's bucket (groups are limited per minute), repeated chat actions are answered
+    locally and RetryAfter errors are retried after the delay Telegram asks for.
+    """
+
+    PRUNE_EVERY = 1000
+
+    def __init__(self, global_rate: float = TELEGRAM_GLOBAL_RATE, chat_rate: float = TELEGRAM_CHAT_RATE,
+                 group_per_minute: float = TELEGRAM_GROUP_PER_MINUTE, max_retries: int = TELEGRAM_MAX_RETRIES,
+                 action_ttl: float = CHAT_ACTION_TTL):
+        self.global_rate = global_rate
+        self.global_bucket = AsyncTokenBucket(global_rate, capacity=global_rate)
+        self.chat_rate = chat_rate
+        self.group_rate = group_per_minute / 60
+        self.max_retries = max_retries
+        self.action_ttl = action_ttl
+        self._chats: dict = {}
+        # {chat_id: {action: sent_at}}
+        self._actions: dict = {}
+        self._requests = 0
+        self.in_flight = 0
+        self.sent = 0
+        self.retried = 0
+        self.coalesced = 0
+
+    def share_global_rate(self, processes: int) -> None:
+        """Take only this process' share of the global limit when `processes` send with the same token."""
+        rate = self.global_rate / max(processes, 1)
+        self.global_bucket = AsyncTokenBucket(rate, capacity=rate)
+
+    @staticmethod
+    def _chat_key(chat_id):
+        # Ids read from the database arrive as strings, "123" and 123 are the same chat
+        if isinstance(chat_id, str) and chat_id.lstrip("-").isdigit():
+            return int(chat_id)
+        return chat_id
+
+    def _chat_bucket(self, chat_id) -> AsyncTokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            # Group and channel ids are negative, usernames (@channel) are channels too
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            if is_group:
+                bucket = AsyncTokenBucket(self.group_rate, capacity=3)
+            else:
+                bucket = AsyncTokenBucket(self.chat_rate, capacity=3)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    def _prune(self) -> None:
+        now = time.monotonic()
+        # A bucket whose next slot is in the past is full again and can be forgotten
+        self._chats = {chat_id: bucket for chat_id, bucket in self._chats.items()
+                       if bucket._tat > now or bucket.waiting}
+        self._actions = {chat_id: actions for chat_id, actions in self._actions.items()
+                         if any(now - sent_at < self.action_ttl for sent_at in actions.values())}
+
+    def _coalesce(self, chat_id, action: str) -> bool:
+        actions = self._actions.setdefault(chat_id, {})
+        now = time.monotonic()
+        sent_at = actions.get(action)
+        if sent_at is not None and now - sent_at < self.action_ttl:
+            return True
+        actions[action] = now
+        return False
+
+    def stats(self) -> dict:
+        return {
+            "queued": self.global_bucket.waiting + sum(bucket.waiting for bucket in self._chats.values()),
+            "in_flight": self.in_flight,
+            "sent": self.sent,
+            "retried": self.retried,
+            "coalesced": self.coalesced,
+            "chats": len(self._chats),
+        }
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None or not method.__api_method__.startswith(THROTTLED_PREFIXES):
+            return await make_request(bot, method)
+        chat_id = self._chat_key(chat_id)
+
+        if isinstance(method, SendChatAction):
+            if self._coalesce(chat_id, method.action):
+                self.coalesced += 1
+                return True
+        else:
+            # A new message ends any chat action shown in that chat
+            self._actions.pop(chat_id, None)
+
+        self._requests += 1
+        if self._requests % self.PRUNE_EVERY == 0:
+            self._prune()
+
+        for attempt in range(self.max_retries + 1):
+            waited = time.perf_counter()
+            # Chat actions don't count against a chat's message limit
+            if not isinstance(method, SendChatAction):
+                await self._chat_bucket(chat_id).acquire()
+            await self.global_bucket.acquire()
+            telegram_wait_seconds.observe(time.perf_counter() - waited)
+
+            self.in_flight += 1
+            try:
+                with telegram_request_seconds.time(method.__api_method__):
+                    result = await make_request(bot, method)
+                self.sent += 1
+                return result
+            except TelegramRetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                self.retried += 1
+                print(f"Telegram flood limit on {method.__api_method__} to {chat_id}, retrying in {e.retry_after}s")
+                self._chat_bucket(chat_id).pause(e.retry_after)
+                # A short delay is per chat, a long one usually means the whole bot is limited
+                if e.retry_after > 1:
+                    self.global_bucket.pause(e.retry_after)
+                await asyncio.sleep(e.retry_after)
+            finally:
+                self.in_flight -= 1
+
+
+# Create singleton instance
+throttle_middleware = ThrottleMiddleware()
+
+Gauge("telegram_requests", "Outgoing Telegram requests by state.", ["state"],
+      function=lambda: {"queued": throttle_middleware.stats()["queued"], "in_flight": throttle_middleware.in_flight})
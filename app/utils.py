@@ -1,3 +1,12 @@
+import os
+import re
+
+_VIDEO_ID_RE = re.compile(r"/(?:video|photo)/(\d+)")
+
+# yt-dlp intermediate files that must never be served
+PARTIAL_SUFFIXES = (".part", ".ytdl", ".temp", ".tmp")
+
+
 def extract_tiktok_username(url: str) -> str | None:
     # Split the URL by '/' and look for the part starting with '@'
     parts = url.split('/')
@@ -8,6 +17,23 @@ def extract_tiktok_username(url: str) -> str | None:
     return None
 
 
+def extract_tiktok_video_id(url: str) -> str | None:
+    # Canonical links look like https://www.tiktok.com/@user/video/<id>
+    match = _VIDEO_ID_RE.search(url or "")
+    if match:
+        return match.group(1)
+    return None
+
+
+def is_partial_download(name: str) -> bool:
+    # yt-dlp leaves "<id>.mp4.part", "<id>.f123.mp4" fragments and "<id>.temp.mp4" merges behind
+    stem, ext = os.path.splitext(name)
+    if ext in PARTIAL_SUFFIXES or ".part-Frag" in name:
+        return True
+    _, inner = os.path.splitext(stem)
+    return inner == ".temp" or (inner.startswith(".f") and inner[2:].isdigit())
+
+
 def extract_link_from_caption(caption: str) -> str | None:
     # Check if 'link:' exists in the caption
     if 'link:' in caption:
@@ -21,4 +47,4 @@ def extract_link_from_caption(caption: str) -> str | None:
             link = link_part.strip()
 
         return link
-    return None
\ No newline at end of file
+    return None
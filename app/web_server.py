@@ -0,0 +1,92 @@
+# app/web_server.py
+import os
+import subprocess
+import sys
+
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+from dotenv import load_dotenv
+
+from app import metrics
+
+load_dotenv()
+
+WEB_HOST: str = os.getenv("WEB_HOST", "0.0.0.0")
+PORT: int = int(os.getenv("PORT", "8080"))
+# Public base URL Telegram should post updates to, e.g. https://bot.example.com. Empty = polling
+WEBHOOK_URL: str = os.getenv("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_PATH: str = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET: str = os.getenv("WEBHOOK_SECRET", "")
+# Processes sharing the port in webhook mode, and which one this is (0 spawns the others)
+WEB_WORKERS: int = int(os.getenv("WEB_WORKERS", "1"))
+WEB_WORKER_ID: int = int(os.getenv("WEB_WORKER_ID", "0"))
+
+
+def webhook_enabled() -> bool:
+    return bool(WEBHOOK_URL)
+
+
+async def health(request: web.Request) -> web.Response:
+    return web.Response(text="Bot is running!")
+
+
+async def metrics_endpoint(request: web.Request) -> web.Response:
+    return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
+
+def create_web_app() -> web.Application:
+    """aiohttp app serving the health route and /metrics, plus the webhook when enabled."""
+    app = web.Application()
+    app.router.add_get("/", health)
+    app.router.add_get("/metrics", metrics_endpoint)
+    return app
+
+
+def setup_webhook(app: web.Application, dp: Dispatcher, bot: Bot) -> None:
+    """Feed updates posted to WEBHOOK_PATH into the dispatcher on this event loop."""
+    SimpleRequestHandler(dp, bot, secret_token=WEBHOOK_SECRET or None).register(app, path=WEBHOOK_PATH)
+    # Runs dp startup/shutdown hooks together with the web app
+    setup_application(app, dp, bot=bot)
+
+
+async def set_webhook(bot: Bot, dp: Dispatcher) -> None:
+    await bot.set_webhook(
+        f"{WEBHOOK_URL}{WEBHOOK_PATH}",
+        secret_token=WEBHOOK_SECRET or None,
+        allowed_updates=dp.resolve_used_update_types(),
+        drop_pending_updates=True,
+    )
+    print(f"Webhook set to {WEBHOOK_URL}{WEBHOOK_PATH}")
+
+
+async def start_web_app(app: web.Application, port: int = PORT) -> web.AppRunner:
+    runner = web.AppRunner(app)
+    await runner.setup()
+    # SO_REUSEPORT lets every worker bind the same port, the kernel spreads connections
+    site = web.TCPSite(runner, WEB_HOST, port, reuse_port=WEB_WORKERS > 1)
+    await site.start()
+    print(f"Web server {WEB_WORKER_ID} listening on {WEB_HOST}:{port}")
+    return runner
+
+
+def spawn_workers(script: str, count: int = WEB_WORKERS, env_name: str = "WEB_WORKER_ID", first: int = 1) -> list:
+    """Start processes `first`..`count`-1 running `script`, each with its id in `env_name`.
+
+    By default these are web workers 1..WEB_WORKERS-1; the caller is worker 0.
+    """
+    workers = []
+    for worker_id in range(first, count):
+        env = {**os.environ, env_name: str(worker_id)}
+        workers.append(subprocess.Popen([sys.executable, script], env=env))
+    return workers
+
+
+def stop_workers(workers: list) -> None:
+    for process in workers:
+        process.terminate()
+    for process in workers:
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
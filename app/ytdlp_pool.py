@@ -0,0 +1,410 @@
+# app/ytdlp_pool.py
+import asyncio
+import itertools
+import os
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.connection import Connection
+
+import psutil
+import yt_dlp
+from dotenv import load_dotenv
+
+from app.metadata_cache import slim_formats
+from app.metrics import Counter, Histogram
+from app.utils import is_partial_download
+
+load_dotenv()
+
+YTDLP_POOL_SIZE: int = int(os.getenv("YTDLP_POOL_SIZE", "2"))
+YTDLP_MAX_JOBS: int = int(os.getenv("YTDLP_MAX_JOBS", "50"))  # Recycle a worker after this many jobs
+YTDLP_MAX_RSS: int = int(os.getenv("YTDLP_MAX_RSS_MB", "300")) * 1024 * 1024  # ... or above this RSS
+YTDLP_JOB_TIMEOUT: int = int(os.getenv("YTDLP_JOB_TIMEOUT", "300"))
+
+# Workers run "python -m app.ytdlp_pool", which needs the project root importable
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# TikTok lets creators pin up to 3 videos above their newest ones
+KNOWN_STOP_AFTER: int = 4
+
+# Extractors every job needs, resolved once when a worker starts
+WARM_EXTRACTORS = ("TikTok", "TikTokUser", "Generic")
+
+# Download progress is reported to the bot at most this often
+PROGRESS_INTERVAL: float = 1.0
+
+
+ytdlp_job_seconds = Histogram("ytdlp_job_seconds", "yt-dlp job duration, including the wait for a worker.",
+                              ["kind"], buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300))
+ytdlp_job_errors = Counter("ytdlp_job_errors_total", "yt-dlp jobs that failed or timed out.", ["kind"])
+ytdlp_recycled = Counter("ytdlp_workers_recycled_total", "yt-dlp workers replaced.")
+
+
+class YtDlpError(Exception):
+    """A job failed inside a yt-dlp worker."""
+
+
+def _find_download(ydl, info_dict: dict):
+    """Locate the final file yt-dlp produced for info_dict."""
+    for download in info_dict.get("requested_downloads") or []:
+        path = download.get("filepath")
+        if path and os.path.exists(path):
+            return path
+
+    path = ydl.prepare_filename(info_dict)
+    if os.path.exists(path):
+        return path
+
+    # Merging may change the extension, take whatever complete file is left
+    output_dir = os.path.dirname(path)
+    for name in os.listdir(output_dir):
+        if not is_partial_download(name):
+            return os.path.join(output_dir, name)
+    return None
+
+
+def _estimate_filesize(info_dict: dict):
+    if info_dict.get("filesize") or info_dict.get("filesize_approx"):
+        return info_dict.get("filesize") or info_dict.get("filesize_approx")
+    # Merged video+audio downloads only carry sizes on the selected formats
+    sizes = [fmt.get("filesize") or fmt.get("filesize_approx") for fmt in info_dict.get("requested_formats") or []]
+    return sum(sizes) if sizes and all(sizes) else None
+
+
+def _job_download(ydl, payload: dict) -> dict:
+    # Each job writes into its own staging directory
+    ydl.params["outtmpl"] = {"default": payload["outtmpl"]}
+    # yt-dlp skips formats known to be too big and aborts downloads that turn out to be
+    ydl.params["max_filesize"] = payload["max_filesize"]
+
+    if payload.get("info"):
+        # Extracted by an earlier "extract" job, only format selection and the download are left
+        info_dict = ydl.process_ie_result(payload["info"], download=True)
+    else:
+        # Single pass: extraction, format selection and download in one call
+        info_dict = ydl.extract_info(payload["url"], download=True)
+    return {
+        "id": info_dict.get("id"),
+        "filepath": _find_download(ydl, info_dict),
+        "metadata": {
+            "filesize": _estimate_filesize(info_dict),
+            "duration": info_dict.get("duration"),
+            "uploader": info_dict.get("uploader"),
+            "formats": slim_formats(info_dict.get("formats")),
+        },
+    }
+
+
+def _direct_format(formats, max_filesize: int):
+    """Biggest single-file mp4 with audio whose known size is under max_filesize."""
+    candidates = []
+    for fmt in formats or []:
+        size = fmt.get("filesize") or fmt.get("filesize_approx")
+        if (fmt.get("ext") == "mp4" and fmt.get("protocol") in ("https", "http") and fmt.get("url")
+                and fmt.get("vcodec") != "none" and fmt.get("acodec") != "none"
+                and size and size <= max_filesize):
+            candidates.append((fmt.get("height") or 0, size, fmt))
+    return max(candidates, key=lambda candidate: candidate[:2])[2] if candidates else None
+
+
+def _job_extract(ydl, payload: dict) -> dict:
+    """Resolve a CDN URL Telegram can fetch on its own, without downloading anything.
+
+    The extracted info comes back too, a "download" job can reuse it instead of asking TikTok again.
+    """
+    info_dict = ydl.extract_info(payload["url"], download=False)
+    fmt = _direct_format(info_dict.get("formats"), payload["max_filesize"])
+    return {
+        "id": info_dict.get("id"),
+        "url": fmt and fmt["url"],
+        "info": ydl.sanitize_info(info_dict),
+        "metadata": {
+            "filesize": _estimate_filesize(info_dict),
+            "duration": info_dict.get("duration"),
+            "uploader": info_dict.get("uploader"),
+            "formats": slim_formats(info_dict.get("formats")),
+        },
+    }
+
+
+def _job_crawl(ydl, payload: dict) -> list:
+    """List a profile newest first, stopping at the playlist limit or once we reach known videos."""
+    known_ids = set(payload.get("known_ids") or ())
+    limit = payload.get("playlistend")
+
+    # process=False keeps "entries" a lazy generator, so pages we don't read are never fetched
+    info = ydl.extract_info(payload["url"], download=False, process=False)
+
+    entries = []
+    known_in_a_row = 0
+    for entry in (info or {}).get("entries") or []:
+        if not entry:
+            continue
+        video_id = str(entry.get("id", ""))
+        if video_id.isdigit() and int(video_id) in known_ids:
+            # Pinned videos sit on top of the profile out of order, so one known id
+            # isn't enough, but a run of them means the rest is old content
+            known_in_a_row += 1
+            if known_in_a_row >= KNOWN_STOP_AFTER:
+                break
+            continue
+        known_in_a_row = 0
+
+        # Only ship the fields the crawler needs back to the bot process
+        entries.append({
+            "id": video_id,
+            "url": entry.get("url", ""),
+            "duration": entry.get("duration"),
+            "uploader": entry.get("uploader"),
+            "filesize": entry.get("filesize") or entry.get("filesize_approx"),
+        })
+        if limit and len(entries) >= limit:
+            break
+    return entries
+
+
+JOBS = {
+    "download": _job_download,
+    "extract": _job_extract,
+    "crawl": _job_crawl,
+}
+
+
+def _worker_main(conn: Connection) -> None:
+    """Worker process loop: one warm YoutubeDL per profile, one job at a time.
+
+    Jobs asking for it get ("progress", job_id, downloaded bytes, total bytes) messages
+    before their reply.
+    """
+    profiles = conn.recv()
+    # [job id or None, last report]
+    reporting = [None, 0.0]
+
+    def progress_hook(status: dict) -> None:
+        now = time.monotonic()
+        if reporting[0] is None or status.get("status") != "downloading" or now - reporting[1] < PROGRESS_INTERVAL:
+            return
+        reporting[1] = now
+        total = status.get("total_bytes") or status.get("total_bytes_estimate")
+        conn.send(("progress", reporting[0], status.get("downloaded_bytes") or 0, total))
+
+    ydls = {name: yt_dlp.YoutubeDL(opts) for name, opts in profiles.items()}
+    for ydl in ydls.values():
+        for ie_key in WARM_EXTRACTORS:
+            ydl.get_info_extractor(ie_key)
+        ydl.add_progress_hook(progress_hook)
+    process = psutil.Process()
+
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            break
+        if message is None:
+            break
+
+        job_id, kind, profile, payload = message
+        reporting[:] = [job_id if payload.get("progress") else None, 0.0]
+        try:
+            result = JOBS[kind](ydls[profile], payload)
+            ok = True
+        except Exception as e:
+            result = str(e)
+            ok = False
+        reporting[0] = None
+        conn.send((job_id, ok, result, process.memory_info().rss))
+
+    conn.close()
+
+
+class _Worker:
+    __slots__ = ("process", "conn", "jobs")
+
+    def __init__(self, profiles: dict):
+        # A fresh interpreter running this module, so workers never import the bot itself
+        to_child_r, to_child_w = os.pipe()
+        from_child_r, from_child_w = os.pipe()
+        python_path = os.pathsep.join(filter(None, [PROJECT_ROOT, os.environ.get("PYTHONPATH")]))
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "app.ytdlp_pool", str(to_child_r), str(from_child_w)],
+            pass_fds=(to_child_r, from_child_w),
+            env={**os.environ, "PYTHONPATH": python_path},
+        )
+        os.close(to_child_r)
+        os.close(from_child_w)
+        self.conn = _DuplexConnection(Connection(from_child_r, writable=False), Connection(to_child_w, readable=False))
+        self.conn.send(profiles)
+        self.jobs = 0
+
+    @property
+    def pid(self) -> int:
+        return self.process.pid
+
+    def stop(self) -> None:
+        try:
+            self.conn.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        self.conn.close()
+        try:
+            self.process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.process.terminate()
+
+    def kill(self) -> None:
+        self.conn.close()
+        self.process.terminate()
+
+
+class _DuplexConnection:
+    """Pair of one-way pipe connections used like a single duplex one."""
+    __slots__ = ("reader", "writer")
+
+    def __init__(self, reader: Connection, writer: Connection):
+        self.reader = reader
+        self.writer = writer
+
+    def send(self, obj) -> None:
+        self.writer.send(obj)
+
+    def recv(self):
+        return self.reader.recv()
+
+    def close(self) -> None:
+        self.reader.close()
+        self.writer.close()
+
+
+class YtDlpPool:
+    """Pool of long-lived worker processes, each holding warmed YoutubeDL instances.
+
+    Keeps extraction and downloading off the bot process' GIL. Workers are replaced after
+    max_jobs jobs or once their RSS goes above max_rss, and whenever a job times out.
+    """
+
+    def __init__(self, profiles: dict, size: int, max_jobs: int, max_rss: int, job_timeout: int):
+        self.profiles = profiles
+        self.size = size
+        self.max_jobs = max_jobs
+        self.max_rss = max_rss
+        self.job_timeout = job_timeout
+        self.recycled = 0
+        self._workers: list = []
+        self._idle: asyncio.Queue | None = None
+        self._executor: ThreadPoolExecutor | None = None
+        self._job_ids = itertools.count(1)
+
+    def _spawn(self) -> _Worker:
+        worker = _Worker(self.profiles)
+        self._workers.append(worker)
+        return worker
+
+    def _retire(self, worker: _Worker, kill: bool = False) -> None:
+        self._workers.remove(worker)
+        if kill:
+            worker.kill()
+        else:
+            # Joining can take a few seconds, keep it off the loop and the pipe readers
+            threading.Thread(target=worker.stop, daemon=True).start()
+        self.recycled += 1
+        ytdlp_recycled.inc()
+
+    def _start(self) -> None:
+        if self._idle is not None:
+            return
+        self._idle = asyncio.Queue()
+        # One thread per worker waits on its pipe, so waiting never grows past the pool size
+        self._executor = ThreadPoolExecutor(max_workers=self.size, thread_name_prefix="ytdlp-pool")
+        for _ in range(self.size):
+            self._idle.put_nowait(self._spawn())
+        print(f"yt-dlp pool started with {self.size} workers")
+
+    async def run(self, kind: str, payload: dict, profile: str = "download", on_progress=None):
+        """Run a job on the next free worker and return its result.
+
+        on_progress(downloaded, total) is called on the event loop while a download runs;
+        total is None when yt-dlp doesn't know the size.
+        """
+        with ytdlp_job_seconds.time(kind, errors=ytdlp_job_errors):
+            return await self._run(kind, payload, profile, on_progress)
+
+    def busy(self) -> int:
+        return len(self._workers) - self._idle.qsize() if self._idle is not None else 0
+
+    async def _receive(self, worker: _Worker, on_progress):
+        loop = asyncio.get_running_loop()
+        while True:
+            message = await loop.run_in_executor(self._executor, worker.conn.recv)
+            if message[0] != "progress":
+                return message
+            if on_progress is not None:
+                try:
+                    on_progress(message[2], message[3])
+                except Exception as e:
+                    print(f"Progress callback failed: {e}")
+
+    async def _run(self, kind: str, payload: dict, profile: str, on_progress=None):
+        self._start()
+        worker = await self._idle.get()
+        job_id = next(self._job_ids)
+        if on_progress is not None:
+            payload = {**payload, "progress": True}
+
+        try:
+            worker.conn.send((job_id, kind, profile, payload))
+            reply = await asyncio.wait_for(self._receive(worker, on_progress), timeout=self.job_timeout)
+        except BaseException:
+            # Timed out, cancelled or crashed: the worker state is unknown, replace it
+            self._retire(worker, kill=True)
+            self._idle.put_nowait(self._spawn())
+            raise
+
+        _, ok, result, rss = reply
+        worker.jobs += 1
+        if worker.jobs >= self.max_jobs or rss > self.max_rss:
+            print(f"Recycling yt-dlp worker {worker.pid}: jobs={worker.jobs}, rss={rss / 1024 / 1024:.0f}MB")
+            self._retire(worker)
+            worker = self._spawn()
+        self._idle.put_nowait(worker)
+
+        if not ok:
+            raise YtDlpError(result)
+        return result
+
+    def recycle_idle(self) -> int:
+        """Replace every idle worker with a fresh one, giving back memory yt-dlp accumulated."""
+        if self._idle is None:
+            return 0
+        idle = []
+        while not self._idle.empty():
+            idle.append(self._idle.get_nowait())
+        for worker in idle:
+            self._retire(worker)
+            self._idle.put_nowait(self._spawn())
+        return len(idle)
+
+    def _detach(self) -> list:
+        workers, self._workers = self._workers, []
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+        self._idle = None
+        self._executor = None
+        return workers
+
+    def close(self) -> None:
+        """Stop all workers without waiting for them. The pool starts again on the next run()."""
+        for worker in self._detach():
+            # Like _retire(), joining can take seconds, keep it off the loop
+            threading.Thread(target=worker.stop, daemon=True).start()
+
+    async def aclose(self) -> None:
+        """Stop all workers and wait until they exited, in threads next to the loop."""
+        await asyncio.gather(*(asyncio.to_thread(worker.stop) for worker in self._detach()))
+
+
+if __name__ == "__main__":
+    _worker_main(_DuplexConnection(Connection(int(sys.argv[1]), writable=False),
+                                   Connection(int(sys.argv[2]), readable=False)))
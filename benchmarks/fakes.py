@@ -0,0 +1,335 @@
+"""Local stand-ins for Telegram, Supabase (PostgREST) and yt-dlp used by the load tests.
+
+The HTTP fakes run in their own process (see serve()) so they don't skew the latency and
+memory numbers of the bot process being measured. FakeYtDlpPool replaces the yt-dlp
+worker pools inside the bot process.
+"""
+import asyncio
+import itertools
+import json
+import os
+import random
+import re
+import time
+
+from aiohttp import web
+
+# Snowflake-sized ids like real TikTok videos
+VIDEO_ID_BASE = 7_300_000_000_000_000_000
+
+
+def video_link(tiktok_user: str, video_id: int) -> str:
+    return f"https://www.tiktok.com/@{tiktok_user}/video/{video_id}"
+
+
+class FakeData:
+    """Synthetic creators, videos and chats shared by the fakes."""
+
+    def __init__(self, users: int, videos_per_user: int, chats: int, admin_id: int):
+        self.admin_id = admin_id
+        self.users = [f"creator{i}" for i in range(users)]
+        self.videos = []
+        for n in range(users * videos_per_user):
+            tiktok_user = self.users[n % users]
+            video_id = VIDEO_ID_BASE + n
+            self.videos.append({
+                "video_id": str(video_id),
+                "link": video_link(tiktok_user, video_id),
+                "tiktok_user": tiktok_user,
+                "active": 1,
+                # One batch per creator, like rows upserted by a crawl
+                "updated_at": f"2025-01-01T00:00:{n % users:02d}+00:00",
+            })
+        self.videos.sort(key=lambda row: (row["updated_at"], row["video_id"]))
+        self.chat_ids = [-1_000_000_000_000 - i for i in range(chats)]
+
+
+class FakeTelegram:
+    """Bot API server answering every method the bot uses with plausible results.
+
+    Uploads are read and thrown away chunk by chunk. A `retry_after_rate` share of the
+    posting calls is answered with a 429 flood error.
+    """
+
+    def __init__(self, latency: float = 0.0, retry_after_rate: float = 0.0):
+        self.latency = latency
+        self.retry_after_rate = retry_after_rate
+        self.calls: dict = {}
+        self.flood_errors = 0
+        self.uploaded_bytes = 0
+        # Wall clock time of every sendMessage, for broadcast delivery latencies
+        self.message_times: list = []
+        self._message_ids = itertools.count(1)
+        self._file_ids = itertools.count(1)
+
+    async def _read_params(self, request: web.Request) -> dict:
+        if not request.content_type.startswith("multipart/"):
+            return dict(await request.post())
+        params = {}
+        reader = await request.multipart()
+        async for part in reader:
+            if part.filename:
+                while chunk := await part.read_chunk(256 * 1024):
+                    self.uploaded_bytes += len(chunk)
+                params[part.name] = "<upload>"
+            else:
+                params[part.name] = await part.text()
+        return params
+
+    def _message(self, params: dict) -> dict:
+        chat_id = int(params.get("chat_id") or 0)
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"},
+        }
+        if "text" in params:
+            message["text"] = params["text"]
+        return message
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = await self._read_params(request)
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if method.startswith("send") and method != "sendChatAction" and random.random() < self.retry_after_rate:
+            self.flood_errors += 1
+            return web.json_response({
+                "ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                "parameters": {"retry_after": 1},
+            }, status=429)
+
+        if method == "getMe":
+            result = {"id": 42, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        elif method in ("sendMessage", "editMessageText"):
+            if method == "sendMessage":
+                self.message_times.append(time.time())
+            result = self._message(params)
+        elif method == "sendVideo":
+            result = self._message(params)
+            file_id = f"video{next(self._file_ids)}"
+            result["video"] = {"file_id": file_id, "file_unique_id": file_id,
+                               "width": 720, "height": 1280, "duration": 15}
+        elif method == "getUpdates":
+            result = []
+        else:
+            # sendChatAction, deleteWebhook, setWebhook, ...
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def stats(self, request: web.Request) -> web.Response:
+        return web.json_response({
+            "calls": self.calls,
+            "flood_errors": self.flood_errors,
+            "uploaded_bytes": self.uploaded_bytes,
+            "message_times": self.message_times,
+        })
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=0)
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        app.router.add_get("/_stats", self.stats)
+        return app
+
+
+class FakePostgrest:
+    """The Supabase REST endpoints db_services calls: the RPCs and the video table."""
+
+    _KEYSET_RE = re.compile(r'updated_at\.gt\."([^"]*)",and\(updated_at\.eq\."[^"]*",video_id\.gt\."([^"]*)"\)')
+
+    def __init__(self, data: FakeData, latency: float = 0.0):
+        self.data = data
+        self.latency = latency
+        self.calls: dict = {}
+        self.upserted_rows = 0
+        self._by_user: dict = {}
+        for row in data.videos:
+            self._by_user.setdefault(row["tiktok_user"], []).append(row["link"])
+
+    def _count(self, name: str) -> None:
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    def _rpc_result(self, name: str, params: dict):
+        data = self.data
+        if name == "get_random_video":
+            return random.choice(data.videos)["link"]
+        if name == "get_random_user_video":
+            links = self._by_user.get(params.get("p_tiktok_user"))
+            return random.choice(links) if links else None
+        if name == "get_current_tele_user_info":
+            return [{"roles": "KING"}] if int(params["p_user_id"]) == data.admin_id else []
+        if name == "get_list_chat_id":
+            return [{"chat_id": chat_id} for chat_id in data.chat_ids]
+        if name in ("get_user_not_fetch", "get_user_fetched"):
+            return [{"tiktok_user": user, "link": f"https://www.tiktok.com/@{user}"} for user in data.users]
+        if name == "get_tiktok_user_video_counts":
+            return [{"tiktok_user": user, "number_of_videos": len(links)} for user, links in self._by_user.items()]
+        if name == "get_tiktok_user_frequency_summary":
+            return [{"tiktok_user": user, "total_of_frequency": 0} for user in self._by_user]
+        if name == "add_tiktok_user":
+            return f"Added {params.get('p_tiktok_user')}"
+        # add_chat_id_and_user_id, delete_video, inactive_video, increment_video_frequency, ...
+        return None
+
+    async def rpc(self, request: web.Request) -> web.Response:
+        name = request.match_info["name"]
+        self._count(name)
+        params = await request.json() if request.can_read_body else {}
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        result = self._rpc_result(name, params)
+        if result is None:
+            return web.Response(status=204)
+        return web.json_response(result)
+
+    async def get_videos(self, request: web.Request) -> web.Response:
+        self._count("get_videos_updated_since")
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        rows = self.data.videos
+        match = self._KEYSET_RE.search(request.query.get("or", ""))
+        if match:
+            watermark = (match.group(1), match.group(2))
+            rows = [row for row in rows if (row["updated_at"], row["video_id"]) > watermark]
+        return web.json_response(rows[:int(request.query.get("limit", len(rows)))])
+
+    async def upsert_videos(self, request: web.Request) -> web.Response:
+        self._count("upsert_videos")
+        rows = await request.json()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.upserted_rows += len(rows)
+        return web.Response(status=201)
+
+    async def stats(self, request: web.Request) -> web.Response:
+        return web.json_response({"calls": self.calls, "upserted_rows": self.upserted_rows})
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/rest/v1/rpc/{name}", self.rpc)
+        app.router.add_get("/rest/v1/video", self.get_videos)
+        app.router.add_post("/rest/v1/video", self.upsert_videos)
+        app.router.add_get("/_stats", self.stats)
+        return app
+
+
+class FakeYtDlpPool:
+    """Drop-in for YtDlpPool: sleeps `delay` seconds per job instead of talking to TikTok.
+
+    Downloads write a `video_bytes` file into the job's staging directory (half the delay
+    when they reuse an extraction's info), extractions return a fake CDN URL, crawls list
+    `crawl_videos` new videos per creator. Jobs wait for one of `size` slots like they wait
+    for a worker. `job_seconds` records each job including that wait.
+    """
+
+    def __init__(self, size: int, delay: float, video_bytes: int, crawl_videos: int):
+        self.size = size
+        self.delay = delay
+        self.video_bytes = video_bytes
+        self.crawl_videos = crawl_videos
+        self.job_seconds: list = []
+        self._slots = asyncio.Semaphore(size)
+        self._busy = 0
+        self._video_ids = itertools.count(VIDEO_ID_BASE * 2)
+
+    def _write_video(self, path: str) -> None:
+        block = os.urandom(min(self.video_bytes, 1024 * 1024))
+        remaining = self.video_bytes
+        with open(path, "wb") as f:
+            while remaining > 0:
+                f.write(block[:remaining])
+                remaining -= len(block)
+
+    async def _download(self, payload: dict, on_progress) -> dict:
+        video_id = payload["url"].rstrip("/").rsplit("/", 1)[-1]
+        metadata = {"filesize": self.video_bytes, "duration": 15, "uploader": None, "formats": []}
+        if self.video_bytes > payload["max_filesize"]:
+            return {"id": video_id, "filepath": None, "metadata": metadata}
+        if on_progress is not None:
+            on_progress(self.video_bytes // 2, self.video_bytes)
+        path = payload["outtmpl"] % {"id": video_id, "ext": "mp4"}
+        await asyncio.to_thread(self._write_video, path)
+        return {"id": video_id, "filepath": path, "metadata": metadata}
+
+    def _extract(self, payload: dict) -> dict:
+        video_id = payload["url"].rstrip("/").rsplit("/", 1)[-1]
+        metadata = {"filesize": self.video_bytes, "duration": 15, "uploader": None, "formats": []}
+        url = f"https://cdn.example.com/{video_id}.mp4" if self.video_bytes <= payload["max_filesize"] else None
+        return {"id": video_id, "url": url, "metadata": metadata, "info": {"id": video_id}}
+
+    def _crawl(self, payload: dict) -> list:
+        username = payload["url"].rstrip("/").rsplit("@", 1)[-1]
+        count = min(self.crawl_videos, payload.get("playlistend") or self.crawl_videos)
+        entries = []
+        for _ in range(count):
+            video_id = str(next(self._video_ids))
+            entries.append({"id": video_id, "url": video_link(username, int(video_id)),
+                            "duration": 15, "uploader": username, "filesize": self.video_bytes})
+        return entries
+
+    async def run(self, kind: str, payload: dict, profile: str = "download", on_progress=None):
+        started = time.perf_counter()
+        async with self._slots:
+            self._busy += 1
+            try:
+                if kind == "extract":
+                    # Extraction is most of a download's time, minus the transfer
+                    await asyncio.sleep(self.delay / 2)
+                    return self._extract(payload)
+                # Downloading from an extraction's info leaves only the transfer
+                await asyncio.sleep(self.delay / 2 if payload.get("info") else self.delay)
+                if kind == "download":
+                    return await self._download(payload, on_progress)
+                return self._crawl(payload)
+            finally:
+                self._busy -= 1
+                self.job_seconds.append(time.perf_counter() - started)
+
+    def busy(self) -> int:
+        return self._busy
+
+    def recycle_idle(self) -> int:
+        return 0
+
+    def close(self) -> None:
+        pass
+
+    async def aclose(self) -> None:
+        pass
+
+
+async def _serve(config: dict) -> None:
+    data = FakeData(config["users"], config["videos_per_user"], config["chats"], config["admin_id"])
+    telegram = FakeTelegram(config["telegram_latency"], config["retry_after_rate"])
+    postgrest = FakePostgrest(data, config["db_latency"])
+
+    runners = []
+    for fake, port in ((telegram, config["telegram_port"]), (postgrest, config["db_port"])):
+        runner = web.AppRunner(fake.app(), access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", port).start()
+        runners.append(runner)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        for runner in runners:
+            await runner.cleanup()
+
+
+def serve(config: dict) -> None:
+    """Run both HTTP fakes until the process is terminated (multiprocessing target)."""
+    try:
+        asyncio.run(_serve(config))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    # Handy for poking at the fakes by hand: python -m benchmarks.fakes
+    serve(json.loads(os.getenv("FAKES_CONFIG", "{}")) or {
+        "users": 50, "videos_per_user": 200, "chats": 100, "admin_id": 1,
+        "telegram_latency": 0.0, "retry_after_rate": 0.0, "db_latency": 0.0,
+        "telegram_port": 8081, "db_port": 8082,
+    })
@@ -0,0 +1,331 @@
+"""Offline load test of the bot against fake Telegram, Supabase and yt-dlp.
+
+Synthetic updates are fed straight into the dispatcher; every Bot API and PostgREST call
+goes to local fakes (benchmarks/fakes.py) running in a separate process, and yt-dlp is
+replaced by FakeYtDlpPool. Each scenario reports p50/p99 latency, throughput and the
+peak RSS of the bot process.
+
+Run from the project root:
+    python -m benchmarks.load_test [r download send crawl] [--requests 200] [--json results.json]
+
+Telegram's flood limits are applied as in production; --unthrottled lifts them to measure
+the bot's own overhead.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import socket
+import sys
+import tempfile
+import time
+import urllib.request
+
+import psutil
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_ROOT)
+
+from benchmarks.fakes import serve, FakeYtDlpPool  # noqa: E402
+
+SCENARIOS = ("r", "download", "send", "crawl")
+ADMIN_ID = 1
+RSS_SAMPLE_INTERVAL = 0.02
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _get_json(url: str) -> dict:
+    with urllib.request.urlopen(url, timeout=5) as response:
+        return json.load(response)
+
+
+def _wait_for(url: str, timeout: float = 10) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            _get_json(url)
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def _percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class RssSampler:
+    """Polls this process' RSS in the background and keeps the peak."""
+
+    def __init__(self):
+        self.process = psutil.Process()
+        self.baseline = self.peak = self.process.memory_info().rss
+        self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            self.peak = max(self.peak, self.process.memory_info().rss)
+            await asyncio.sleep(RSS_SAMPLE_INTERVAL)
+
+    def __enter__(self):
+        self._task = asyncio.create_task(self._run())
+        return self
+
+    def __exit__(self, *exc):
+        self._task.cancel()
+        self.peak = max(self.peak, self.process.memory_info().rss)
+
+
+class Result:
+    def __init__(self, name: str, latencies: list, operations: int, elapsed: float, rss: RssSampler, **extra):
+        self.name = name
+        self.latencies = latencies
+        self.operations = operations
+        self.elapsed = elapsed
+        self.peak_rss = rss.peak
+        self.rss_growth = rss.peak - rss.baseline
+        self.extra = extra
+
+    def as_dict(self) -> dict:
+        return {
+            "scenario": self.name,
+            "operations": self.operations,
+            "elapsed_s": round(self.elapsed, 3),
+            "throughput_per_s": round(self.operations / self.elapsed, 2) if self.elapsed else 0.0,
+            "p50_ms": round(_percentile(self.latencies, 0.50) * 1000, 2),
+            "p99_ms": round(_percentile(self.latencies, 0.99) * 1000, 2),
+            "max_ms": round(max(self.latencies, default=0.0) * 1000, 2),
+            "peak_rss_mb": round(self.peak_rss / 1024 / 1024, 1),
+            "rss_growth_mb": round(self.rss_growth / 1024 / 1024, 1),
+            **self.extra,
+        }
+
+    def text(self) -> str:
+        d = self.as_dict()
+        extra = "".join(f", {key}={value}" for key, value in self.extra.items())
+        return (
+            f"{self.name:>8}: {d['operations']} ops in {d['elapsed_s']:.2f}s ({d['throughput_per_s']:.1f}/s), "
+            f"p50 {d['p50_ms']:.1f} ms, p99 {d['p99_ms']:.1f} ms, max {d['max_ms']:.1f} ms, "
+            f"peak RSS {d['peak_rss_mb']:.1f} MB (+{d['rss_growth_mb']:.1f}){extra}"
+        )
+
+
+class LoadTest:
+    def __init__(self, args, telegram_url: str, db_url: str):
+        self.args = args
+        self.telegram_url = telegram_url
+        self.db_url = db_url
+        self._update_ids = iter(range(1, sys.maxsize))
+        self._user_ids = iter(range(ADMIN_ID + 1, sys.maxsize))
+
+        # Imported only now: the app reads its configuration from the environment at import time
+        from app import download_services
+        from app.bot import bot, dp
+        from app.download_scheduler import download_scheduler
+
+        self.bot = bot
+        self.dp = dp
+        self.scheduler = download_scheduler
+        video_bytes = int(args.video_mb * 1024 * 1024)
+        self.ytdlp_pool = FakeYtDlpPool(args.download_workers, args.download_delay, video_bytes, 0)
+        self.crawl_pool = FakeYtDlpPool(args.crawl_concurrency, args.crawl_delay, video_bytes, args.crawl_videos)
+        download_services.ytdlp_pool = self.ytdlp_pool
+        download_services.crawl_pool = self.crawl_pool
+
+    def _update(self, text: str, user_id: int = None, chat_id: int = None) -> dict:
+        # Fresh users by default, so the per-user command cooldown doesn't turn requests away
+        user_id = user_id or next(self._user_ids)
+        command = text.split(maxsplit=1)[0]
+        return {
+            "update_id": next(self._update_ids),
+            "message": {
+                "message_id": 1,
+                "date": int(time.time()),
+                "chat": {"id": chat_id or user_id, "type": "private"},
+                "from": {"id": user_id, "is_bot": False, "first_name": "bench"},
+                "text": text,
+                "entities": [{"type": "bot_command", "offset": 0, "length": len(command)}],
+            },
+        }
+
+    async def _feed(self, updates: list) -> tuple:
+        """Feed updates at --rate per second (all at once when 0). Returns latencies and failures."""
+        latencies = []
+        failures = 0
+
+        async def handle(update: dict) -> None:
+            nonlocal failures
+            started = time.perf_counter()
+            try:
+                await self.dp.feed_raw_update(self.bot, update)
+            except Exception as e:
+                failures += 1
+                if failures <= 3:
+                    print(f"Update {update['update_id']} failed: {e}")
+            latencies.append(time.perf_counter() - started)
+
+        tasks = []
+        for update in updates:
+            tasks.append(asyncio.create_task(handle(update)))
+            if self.args.rate:
+                await asyncio.sleep(1 / self.args.rate)
+        await asyncio.gather(*tasks)
+        return latencies, failures
+
+    async def _update_scenario(self, name: str, texts: list) -> Result:
+        shed = self.scheduler.shed
+        with RssSampler() as rss:
+            started = time.perf_counter()
+            latencies, failures = await self._feed([self._update(text) for text in texts])
+            elapsed = time.perf_counter() - started
+        return Result(name, latencies, len(texts), elapsed, rss, failures=failures,
+                      shed=self.scheduler.shed - shed)
+
+    async def scenario_r(self) -> Result:
+        """/r storm: random videos, downloaded and uploaded on a file_id cache miss."""
+        return await self._update_scenario("r", ["/r"] * self.args.requests)
+
+    async def scenario_download(self) -> Result:
+        """/download burst of distinct videos, so every request needs a download."""
+        texts = [f"/download https://www.tiktok.com/@burst/video/{7_400_000_000_000_000_000 + i}"
+                 for i in range(self.args.requests)]
+        return await self._update_scenario("download", texts)
+
+    async def scenario_send(self) -> Result:
+        """/send to every chat; latency is the time until each chat's message reached Telegram."""
+        before = len(_get_json(f"{self.telegram_url}/_stats")["message_times"])
+        with RssSampler() as rss:
+            started_at = time.time()
+            started = time.perf_counter()
+            _, failures = await self._feed([self._update("/send benchmark broadcast", user_id=ADMIN_ID)])
+            elapsed = time.perf_counter() - started
+        stats = _get_json(f"{self.telegram_url}/_stats")
+        # The last message is the report reply to the admin
+        delivered = [t - started_at for t in stats["message_times"][before:-1]]
+        return Result("send", delivered, len(delivered), elapsed, rss, failures=failures,
+                      flood_errors=stats["flood_errors"])
+
+    async def scenario_crawl(self) -> Result:
+        """process_users over every creator; latency is one creator's crawl job."""
+        from app.db_services import get_user_not_fetch
+        from app.download_services import process_users
+
+        users = await get_user_not_fetch()
+        upserted = _get_json(f"{self.db_url}/_stats")["upserted_rows"]
+        jobs = len(self.crawl_pool.job_seconds)
+        with RssSampler() as rss:
+            started = time.perf_counter()
+            await process_users(users, playlist_limit=self.args.crawl_videos)
+            elapsed = time.perf_counter() - started
+        upserted = _get_json(f"{self.db_url}/_stats")["upserted_rows"] - upserted
+        return Result("crawl", self.crawl_pool.job_seconds[jobs:], len(users), elapsed, rss,
+                      videos=upserted, videos_per_s=round(upserted / elapsed, 1))
+
+    async def run(self, scenarios: list) -> list:
+        from app.db_services import close_supabase_client
+
+        results = []
+        try:
+            if self.args.random_index:
+                from app.random_index import random_index
+                await random_index.sync(full=True)
+            for name in scenarios:
+                results.append(await getattr(self, f"scenario_{name}")())
+        finally:
+            await self.bot.session.close()
+            await close_supabase_client()
+        return results
+
+
+def _configure_environment(args, workdir: str, telegram_url: str, db_url: str) -> None:
+    os.environ.update({
+        "BOT_TOKEN": "42:BENCHMARK",
+        "TELEGRAM_API_URL": telegram_url,
+        "SUPABASE_URL": db_url,
+        "SUPABASE_KEY": "benchmark",
+        "AUTH_KING_IDS": str(ADMIN_ID),
+        "RANDOM_INDEX_ENABLED": "1" if args.random_index else "0",
+        "CRAWL_JITTER": "0",
+        "CRAWL_CONCURRENCY": str(args.crawl_concurrency),
+        "DOWNLOAD_CONCURRENCY": str(args.download_workers),
+        "MEMORY_TRACEMALLOC": "0",
+        "RATE_LIMIT_BACKEND": "memory",
+        "URL_PASSTHROUGH": "0" if args.no_url_passthrough else "1",
+    })
+    if args.unthrottled:
+        os.environ.update({"TELEGRAM_GLOBAL_RATE": "100000", "TELEGRAM_CHAT_RATE": "100000",
+                           "TELEGRAM_GROUP_PER_MINUTE": "6000000", "BROADCAST_RATE": "100000"})
+    # Caches, downloads and CSVs are relative to the working directory, keep them out of the repo
+    os.chdir(workdir)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("scenarios", nargs="*", help=f"any of {', '.join(SCENARIOS)} (default: all of them)")
+    parser.add_argument("--requests", type=int, default=200, help="updates per /r and /download scenario")
+    parser.add_argument("--rate", type=float, default=0, help="updates per second, 0 = all at once")
+    parser.add_argument("--chats", type=int, default=200, help="chats /send broadcasts to")
+    parser.add_argument("--users", type=int, default=50, help="TikTok creators in the fake database")
+    parser.add_argument("--videos-per-user", type=int, default=200)
+    parser.add_argument("--video-mb", type=float, default=5, help="size of every fake download")
+    parser.add_argument("--download-delay", type=float, default=0.5, help="seconds per fake download")
+    parser.add_argument("--download-workers", type=int, default=2)
+    parser.add_argument("--crawl-delay", type=float, default=1.0, help="seconds per fake profile listing")
+    parser.add_argument("--crawl-videos", type=int, default=30, help="new videos per creator and crawl")
+    parser.add_argument("--crawl-concurrency", type=int, default=3)
+    parser.add_argument("--telegram-latency", type=float, default=0.02, help="seconds per Bot API call")
+    parser.add_argument("--db-latency", type=float, default=0.01, help="seconds per PostgREST call")
+    parser.add_argument("--retry-after-rate", type=float, default=0.0,
+                        help="share of sends answered with a 429 flood error")
+    parser.add_argument("--random-index", action="store_true", help="load the in-process random index first")
+    parser.add_argument("--no-url-passthrough", action="store_true",
+                        help="always download and upload instead of sending small videos by URL")
+    parser.add_argument("--unthrottled", action="store_true", help="lift Telegram's flood limits")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error(f"unknown scenario {name!r}, choose from {', '.join(SCENARIOS)}")
+    if args.json:
+        args.json = os.path.abspath(args.json)
+
+    telegram_port, db_port = _free_port(), _free_port()
+    telegram_url, db_url = f"http://127.0.0.1:{telegram_port}", f"http://127.0.0.1:{db_port}"
+    fakes = multiprocessing.get_context("spawn").Process(target=serve, daemon=True, args=({
+        "users": args.users, "videos_per_user": args.videos_per_user, "chats": args.chats, "admin_id": ADMIN_ID,
+        "telegram_latency": args.telegram_latency, "retry_after_rate": args.retry_after_rate,
+        "db_latency": args.db_latency, "telegram_port": telegram_port, "db_port": db_port,
+    },))
+    fakes.start()
+    try:
+        _wait_for(f"{telegram_url}/_stats")
+        _wait_for(f"{db_url}/_stats")
+        with tempfile.TemporaryDirectory(prefix="tiktok-bot-bench-") as workdir:
+            _configure_environment(args, workdir, telegram_url, db_url)
+            results = asyncio.run(LoadTest(args, telegram_url, db_url).run(args.scenarios or SCENARIOS))
+            os.chdir(PROJECT_ROOT)
+    finally:
+        fakes.terminate()
+        fakes.join()
+
+    # The bot logs a lot while it runs, repeat the numbers at the end
+    print()
+    for result in results:
+        print(result.text())
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump([result.as_dict() for result in results], f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
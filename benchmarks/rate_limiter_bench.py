@@ -0,0 +1,45 @@
+"""Micro-benchmark of RateLimiter.check_cooldown.
+
+Run from the project root:
+    python -m benchmarks.rate_limiter_bench [--calls 200000] [--users 10000]
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from app.decorator.rate_limiter import RateLimiter, MemoryBackend, SqliteBackend
+
+
+def run(limiter: RateLimiter, calls: int, users: int) -> float:
+    user_ids = [random.randrange(users) for _ in range(calls)]
+    commands = ["get_random_video_command", "handle_download", "handle_hello"]
+
+    started = time.perf_counter()
+    for i, user_id in enumerate(user_ids):
+        limiter.check_cooldown(user_id, commands[i % 3], 10)
+    return time.perf_counter() - started
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--calls", type=int, default=200_000)
+    parser.add_argument("--users", type=int, default=10_000)
+    args = parser.parse_args()
+
+    memory = MemoryBackend()
+    elapsed = run(RateLimiter(memory), args.calls, args.users)
+    print(f"memory: {args.calls / elapsed:,.0f} checks/s ({elapsed / args.calls * 1e6:.2f} us/check), "
+          f"{len(memory)} live buckets")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        sqlite = SqliteBackend(os.path.join(tmp, "rate_limits.sqlite3"))
+        calls = max(args.calls // 10, 1)
+        elapsed = run(RateLimiter(sqlite), calls, args.users)
+        print(f"sqlite: {calls / elapsed:,.0f} checks/s ({elapsed / calls * 1e6:.2f} us/check), "
+              f"{len(sqlite)} live buckets")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,59 +1,166 @@
 import asyncio
 import logging
 import os
-import threading
+import signal
+from datetime import date
 
 import schedule
-from flask import Flask
 
 from app.bot import bot, dp
-from app.download_services import process_10
+from app.chat_registry import chat_registry
+from app.cluster import CLUSTER_METRICS_PORT, CLUSTER_SHARD, CLUSTER_WORKERS, ShardRouter, cluster_enabled, serve_shard
+from app.db_services import close_supabase_client
+from app.download_services import process_10, run_cache_janitor, video_cache, ytdlp_pool, crawl_pool
 from app.periodic_tasks import start_hello_task
-
-app = Flask(__name__)
-
-
-@app.route('/')
-def home():
-    return "Bot is running!"
-
-
-def run_flask():
-    app.run(host='0.0.0.0', port=int(os.environ.get('PORT', 8080)))
-
+from app.memory_monitor import start_memory_monitor
+from app.metrics import run_loop_lag_monitor
+from app.prefetcher import video_prefetcher
+from app.random_index import random_index
+from app.shared_state import leader_election, shared_events, shared_state
+from app.stats_service import stats_service
+from app.throttling import throttle_middleware
+from app.web_server import WEB_WORKER_ID, WEB_WORKERS, WEBHOOK_PATH, WEBHOOK_SECRET, create_web_app, setup_webhook, \
+    set_webhook, start_web_app, spawn_workers, stop_workers, webhook_enabled
 
 logging.basicConfig(level=logging.INFO)
 
 
 def schedule_handler():
-    asyncio.create_task(process_10())
+    # Leadership moving around the scheduled time must not run the crawl twice
+    if shared_state.claim(f"job:process_10:{date.today()}", 24 * 60 * 60):
+        asyncio.create_task(process_10())
 
 
 async def run_scheduler():
-    schedule.every().sunday.at("23:59:59").do(schedule_handler)
-    while True:
-        schedule.run_pending()
-        await asyncio.sleep(1)
+    job = schedule.every().sunday.at("23:59:59").do(schedule_handler)
+    try:
+        while True:
+            schedule.run_pending()
+            await asyncio.sleep(1)
+    finally:
+        # Cancelled when leadership is lost, the next election registers it again
+        schedule.cancel_job(job)
 
 
 async def on_startup() -> None:
-    asyncio.create_task(start_hello_task(bot))
-    asyncio.create_task(run_scheduler())
+    # Scheduled jobs (crawls included), prefetching and the shared download cache janitor run in one process only
+    asyncio.create_task(leader_election.run(
+        [lambda: start_hello_task(bot), run_scheduler, run_cache_janitor, video_prefetcher.run]
+    ))
+    asyncio.create_task(chat_registry.run())
+    asyncio.create_task(shared_events.run())
+    asyncio.create_task(stats_service.run())
+    asyncio.create_task(random_index.run())
+    asyncio.create_task(run_loop_lag_monitor())
+    # Shed load before the container runs out of memory
+    start_memory_monitor()
+
+
+async def on_shutdown() -> None:
+    leader_election.resign()
+    await random_index.flush_views()
+    await chat_registry.flush()
+    await asyncio.gather(ytdlp_pool.aclose(), crawl_pool.aclose())
+    await close_supabase_client()
+
+
+async def run_polling() -> None:
+    # Health route on the same event loop as the dispatcher
+    runner = await start_web_app(create_web_app())
+    try:
+        # Polling fails while a webhook is set, this also skips updates sent while we were down
+        await bot.delete_webhook(drop_pending_updates=True)
+        await dp.start_polling(bot)
+    finally:
+        await runner.cleanup()
+
+
+async def run_webhook() -> None:
+    app = create_web_app()
+    setup_webhook(app, dp, bot)
+    runner = await start_web_app(app)
+    try:
+        if WEB_WORKER_ID == 0:
+            await set_webhook(bot, dp)
+        # Serve until cancelled
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+async def run_router() -> None:
+    """Receive updates and shard them across the CLUSTER_WORKERS handler processes by chat id."""
+    router = ShardRouter(secret_token=WEBHOOK_SECRET)
+    app = create_web_app()
+    if webhook_enabled():
+        app.router.add_post(WEBHOOK_PATH, router.handle_webhook)
+    runner = await start_web_app(app)
+    try:
+        if not webhook_enabled():
+            await bot.delete_webhook(drop_pending_updates=True)
+            await router.poll(bot, dp.resolve_used_update_types())
+        else:
+            if WEB_WORKER_ID == 0:
+                await set_webhook(bot, dp)
+            await asyncio.Event().wait()
+    finally:
+        await router.close()
+        await runner.cleanup()
+        await bot.session.close()
+
+
+async def run_shard() -> None:
+    runner = None
+    if CLUSTER_METRICS_PORT:
+        runner = await start_web_app(create_web_app(), port=CLUSTER_METRICS_PORT + CLUSTER_SHARD)
+    await dp.emit_startup(bot=bot)
+    try:
+        await serve_shard(CLUSTER_SHARD, dp, bot, shared_state)
+    finally:
+        await dp.emit_shutdown(bot=bot)
+        await bot.session.close()
+        if runner is not None:
+            await runner.cleanup()
 
 
 async def main() -> None:
     print("Starting bot...")
-    threading.Thread(target=run_flask, daemon=True).start()
 
     # Hook startup functionality
     dp.startup.register(on_startup)
-
-    # Start monitoring memory usage as an asyncio task
-    # start_memory_monitor(interval=5)
-
-    # Start polling updates
-    await dp.start_polling(bot, skip_updates=True)
+    dp.shutdown.register(on_shutdown)
+    # Every process handling updates downloads into the same DOWNLOAD_DIR
+    video_cache.shared = cluster_enabled() or WEB_WORKERS > 1
+    # ... and sends with the same bot token, so Telegram's global limit is split between them
+    throttle_middleware.share_global_rate(CLUSTER_WORKERS if cluster_enabled() else WEB_WORKERS)
+
+    if CLUSTER_SHARD >= 0:
+        await run_shard()
+        return
+
+    script = os.path.abspath(__file__)
+    workers = []
+    if WEB_WORKER_ID == 0:
+        if cluster_enabled():
+            workers += spawn_workers(script, CLUSTER_WORKERS, "CLUSTER_SHARD", first=0)
+        if webhook_enabled():
+            workers += spawn_workers(script)
+    try:
+        if cluster_enabled():
+            await run_router()
+        elif webhook_enabled():
+            await run_webhook()
+        else:
+            # Start polling updates
+            await run_polling()
+    finally:
+        stop_workers(workers)
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    # Turn SIGTERM into KeyboardInterrupt so worker processes are stopped too
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        print("Bot stopped.")
@@ -0,0 +1,10 @@
+-- Called by the broadcaster (app/broadcast.py) for chats the bot can no longer post to:
+-- blocked by the user, kicked from the group, or the chat was deleted.
+-- Rows referencing the chat (e.g. the chat/user pairs written by add_chat_id_and_user_id)
+-- must be declared ON DELETE CASCADE, or be removed here first.
+create or replace function delete_chat_id(p_chat_id text)
+returns void
+language sql
+as $$
+    delete from chat where chat_id::text = p_chat_id;
+$$;
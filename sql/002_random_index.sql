@@ -0,0 +1,42 @@
+-- Backs the in-process random index (app/random_index.py).
+-- get_videos_updated_since pages through video by (updated_at, video_id); the index only
+-- sees a deactivation, relink or new row if updated_at moved.
+alter table video add column if not exists updated_at timestamptz not null default now();
+alter table video add column if not exists frequency integer not null default 0;
+
+create index if not exists video_updated_at_video_id on video (updated_at, video_id);
+
+create or replace function set_video_updated_at()
+returns trigger
+language plpgsql
+as $$
+begin
+    new.updated_at := now();
+    return new;
+end;
+$$;
+
+-- Only changes the index cares about; view counts must not push every watched row into the next sync
+drop trigger if exists video_set_updated_at on video;
+create trigger video_set_updated_at
+    before update on video
+    for each row
+    when (old.active is distinct from new.active
+          or old.link is distinct from new.link
+          or old.tiktok_user is distinct from new.tiktok_user)
+    execute function set_video_updated_at();
+
+-- Views of videos picked from the index, flushed in batches; an id appears once per view.
+create or replace function increment_video_frequency(p_video_ids text[])
+returns void
+language sql
+as $$
+    update video v
+    set frequency = coalesce(v.frequency, 0) + views.count
+    from (
+        select video_id, count(*) as count
+        from unnest(p_video_ids) as video_id
+        group by video_id
+    ) views
+    where v.video_id::text = views.video_id;
+$$;
@@ -0,0 +1,16 @@
+-- Called by the broadcaster (app/broadcast.py) when Telegram reports that a group was
+-- upgraded to a supergroup and now lives under a new chat id.
+-- Rows referencing the chat must be declared ON UPDATE CASCADE to follow it. If the new
+-- id was already registered (someone used the bot in the supergroup), the old row goes.
+create or replace function migrate_chat_id(p_old_chat_id text, p_new_chat_id bigint)
+returns void
+language plpgsql
+as $$
+begin
+    if exists (select 1 from chat where chat_id::text = p_new_chat_id::text) then
+        delete from chat where chat_id::text = p_old_chat_id;
+    else
+        update chat set chat_id = p_new_chat_id where chat_id::text = p_old_chat_id;
+    end if;
+end;
+$$;
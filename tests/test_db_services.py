@@ -0,0 +1,102 @@
+"""Pooled PostgREST client of app.db_services, against httpx.MockTransport."""
+import asyncio
+import json
+
+import httpx
+import pytest
+
+from app import db_services
+
+SUPABASE_URL = "https://project.supabase.co"
+SUPABASE_KEY = "service-key"
+
+
+@pytest.fixture
+def transport(monkeypatch):
+    """Route every client db_services builds to a handler set per test, recording requests."""
+    state = {"handler": lambda request: httpx.Response(204), "requests": []}
+
+    def handle(request: httpx.Request) -> httpx.Response:
+        state["requests"].append(request)
+        return state["handler"](request)
+
+    async_client = httpx.AsyncClient
+    monkeypatch.setattr(db_services.httpx, "AsyncClient",
+                        lambda **kwargs: async_client(transport=httpx.MockTransport(handle), **kwargs))
+    monkeypatch.setattr(db_services, "SUPABASE_URL", SUPABASE_URL)
+    monkeypatch.setattr(db_services, "SUPABASE_KEY", SUPABASE_KEY)
+    monkeypatch.setattr(db_services, "_supabase_client", None)
+    yield state
+    asyncio.run(db_services.close_supabase_client())
+
+
+def test_client_is_reused_until_closed(transport):
+    async def scenario():
+        first = db_services.get_supabase_client()
+        assert db_services.get_supabase_client() is first
+        await db_services.get_random_video()
+        await db_services.get_random_video()
+        assert db_services.get_supabase_client() is first
+
+        await db_services.close_supabase_client()
+        assert first.is_closed
+        assert db_services._supabase_client is None
+
+        second = db_services.get_supabase_client()
+        assert second is not first
+        assert not second.is_closed
+
+    asyncio.run(scenario())
+
+
+def test_rpc_request_and_decoded_result(transport):
+    transport["handler"] = lambda request: httpx.Response(200, json="https://www.tiktok.com/@a/video/1")
+
+    result = asyncio.run(db_services.get_random_user_video("a"))
+
+    assert result == "https://www.tiktok.com/@a/video/1"
+    request = transport["requests"][0]
+    assert request.method == "POST"
+    assert str(request.url) == f"{SUPABASE_URL}/rest/v1/rpc/get_random_user_video"
+    assert request.headers["apikey"] == SUPABASE_KEY
+    assert request.headers["authorization"] == f"Bearer {SUPABASE_KEY}"
+    assert json.loads(request.content) == {"p_tiktok_user": "a"}
+
+
+def test_void_rpcs_report_success(transport):
+    # Functions returning void answer 204 without a body
+    assert asyncio.run(db_services.delete_video("https://www.tiktok.com/@a/video/1")) is True
+    assert asyncio.run(db_services.add_chat_id_and_user_id("1", "2")) is True
+
+
+@pytest.mark.parametrize("failure", [
+    lambda request: httpx.Response(500, json={"message": "boom"}),
+    lambda request: (_ for _ in ()).throw(httpx.ConnectError("unreachable", request=request)),
+])
+def test_errors_map_to_the_old_fallback_values(transport, failure):
+    transport["handler"] = failure
+
+    async def scenario():
+        return (
+            await db_services.get_random_video(),
+            await db_services.get_user_not_fetch(),
+            await db_services.delete_video("link"),
+            await db_services.get_current_tele_user_info("1"),
+            await db_services.get_list_chat_id(),
+            await db_services.get_tiktok_user_video_counts(),
+            await db_services.upsert_videos([{"video_id": "1"}]),
+        )
+
+    assert asyncio.run(scenario()) == (None, "", False, False, False, None, False)
+
+
+def test_upsert_videos_ignores_duplicates(transport):
+    transport["handler"] = lambda request: httpx.Response(201)
+    videos = [{"video_id": "1", "link": "l", "tiktok_user": "a"}]
+
+    assert asyncio.run(db_services.upsert_videos(videos)) is True
+    request = transport["requests"][0]
+    assert request.url.path == "/rest/v1/video"
+    assert request.url.params["on_conflict"] == "video_id"
+    assert request.headers["prefer"] == "resolution=ignore-duplicates,return=minimal"
+    assert json.loads(request.content) == videos